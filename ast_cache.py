@@ -0,0 +1,149 @@
+import os
+import pickle
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+# On disk cache of parsed ASTs. Entries are pickled c_ast.FileASTs named after
+# their key, the modification time of an entry is bumped every time it's used
+# so the least recently used ones can be evicted once the cache grows past
+# maxSize bytes.
+class AstCache:
+    # Bump if the pickled format changes in a way that breaks old entries
+    VERSION = 1
+    SUFFIX = '.ast'
+
+    def __init__(self, directory, maxSize=256 * 1024 * 1024):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        # Scanning the directory on every write would make filling the cache
+        # quadratic, so only evict once enough has been written since the last
+        # time (and on the first write of each process)
+        self._writtenSinceEvict = maxSize
+
+    # The key covers everything that can change the AST of a given source:
+    # the text itself, the parser version and anything else the caller
+    # passes in (compiler version, constant and syscall tables)
+    def getKey(self, text, *dependencies):
+        h = hashlib.sha256()
+        h.update(str(AstCache.VERSION).encode('utf-8'))
+        for dependency in dependencies:
+            h.update(b'\x00' + repr(dependency).encode('utf-8'))
+        h.update(b'\x00' + text.encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def _write(self, key, data):
+        fd, tempPath = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tempPath, self._path(key))
+        except:
+            os.remove(tempPath)
+            raise
+        self._writtenSinceEvict += len(data)
+        if self._writtenSinceEvict >= self.maxSize // 16:
+            self.evict()
+
+    def _load(self, data):
+        try:
+            return pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+    def get(self, key):
+        data = self._read(key)
+        value = self._load(data) if data != None else None
+        if value == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._write(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    # Remove the least recently used entries until the cache fits in maxSize
+    def evict(self):
+        self._writtenSinceEvict = 0
+        entries = []
+        totalSize = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    totalSize += stat.st_size
+        if totalSize <= self.maxSize:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            totalSize -= size
+            if totalSize <= self.maxSize:
+                break
+
+# Cache of compiled functions, see Compiler.compileFunction. Besides the disk
+# cache the most recently used fragments are kept in memory so a long running
+# compiler (watch mode, server) doesn't have to touch the disk for them. Every
+# get returns a fresh copy since the caller mutates the commands it gets back.
+class FragmentCache(AstCache):
+    SUFFIX = '.frag'
+
+    def __init__(self, directory, maxSize=256 * 1024 * 1024, maxMemoryEntries=4096):
+        AstCache.__init__(self, directory, maxSize)
+        self.maxMemoryEntries = maxMemoryEntries
+        self.memory = OrderedDict()
+
+    def _remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxMemoryEntries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data != None:
+            self.memory.move_to_end(key)
+        else:
+            data = self._read(key)
+            if data != None:
+                self._remember(key, data)
+        value = self._load(data) if data != None else None
+        if value == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        self._write(key, data)
+
+    # The memory cache isn't worth sending to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memory'] = OrderedDict()
+        return state
@@ -0,0 +1,64 @@
+# Compares running scripts with MscVM, which looks at each command as it
+# runs it, against ThreadedMscVM, which decodes them into functions first.
+# The programs are the loops from unit_tests/while.c and unit_tests/for.c
+# with more iterations, both engines have to execute the same commands.
+#
+# usage: python benchmarks/dispatch.py [-n iterations] [--repeat N]
+import os, sys, time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msclang import Compiler
+from msc import MscVM, ThreadedMscVM
+
+PROGRAMS = {
+    "while.c" : """
+void main(){
+    int i = %(n)i;
+    while (i > 0){
+        printf("oof");
+        i--;
+    }
+    do {
+        printf("OOF");
+        i++;
+    } while(i < %(n)i);
+}""",
+    "for.c" : """
+void main(){
+    for(int i=0; i<%(n)i; i++){
+        printf("%%i", i);
+    }
+}"""
+}
+
+def ignorePrintf(vm, formatString, args):
+    pass
+
+def main():
+    parser = ArgumentParser(description="Benchmark naive against pre-decoded dispatch")
+    parser.add_argument('-n', dest='iterations', type=int, default=100000, help='Iterations of each loop')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='Runs of each program, the fastest is used')
+    args = parser.parse_args()
+
+    for name, source in sorted(PROGRAMS.items()):
+        compiler = Compiler()
+        compiler.compile(source % {"n" : args.iterations})
+        results = {}
+        for engine in [MscVM, ThreadedMscVM]:
+            start = time.perf_counter()
+            vm = engine(compiler.msc, printf=ignorePrintf)
+            decodeTime = time.perf_counter() - start
+            runs = []
+            for _ in range(args.repeat):
+                vm.stats.seconds = 0.0
+                vm.run()
+                runs.append(vm.stats.seconds)
+            results[engine] = (vm.stats.instructions() // args.repeat, min(runs))
+            print("%-8s %-14s %10i instructions  %8.4fs  %6.2f M instructions/s  (setup %.4fs)" %
+                  (name, engine.__name__, results[engine][0], min(runs), results[engine][0] / min(runs) / 1e6, decodeTime))
+        assert results[MscVM][0] == results[ThreadedMscVM][0], "engines executed different numbers of instructions"
+        print("%-8s speedup %.2fx" % (name, results[MscVM][1] / results[ThreadedMscVM][1]))
+
+if __name__ == "__main__":
+    main()
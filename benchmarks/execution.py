@@ -0,0 +1,66 @@
+# Runs the unit tests on the MSC emulator with the optimizations on and off
+# and compares how many instructions each one executes and how long it took.
+# Output from printf is checked to be the same either way.
+#
+# usage: python benchmarks/execution.py [files...] [--opcodes] [--autocast]
+import os, sys, glob
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from msclang import Compiler, preprocess, BUILTIN_PREPROCESSOR
+from msc import MscVM, formatPrintf
+
+UNOPTIMIZED = {
+    "peepholeRules" : [],
+    "irPasses" : [],
+    "foldConstants" : False,
+    "reduceStrength" : False,
+    "branchConditions" : False,
+    "switchStrategy" : "linear",
+    "shareSlots" : False,
+    "inlineThreshold" : 0,
+    "removeUnused" : False,
+    "tailCalls" : False
+}
+
+# Compile and run a file, returns the vm and what it printed. Anything
+# passed to set_main is run for a few frames.
+def run(file, options, frames, maxInstructions):
+    compiler = Compiler(**options)
+    compiler.compile(preprocess(file, BUILTIN_PREPROCESSOR))
+    output = []
+    vm = MscVM(compiler.msc, printf=lambda vm, formatString, args: output.append(formatPrintf(formatString, args, vm.msc.strings)),
+               maxInstructions=maxInstructions)
+    vm.run()
+    if vm.mainLoop != None:
+        vm.runMainLoop(frames)
+    return vm, output
+
+def main():
+    parser = ArgumentParser(description="Benchmark executed instructions with and without optimizations")
+    parser.add_argument('files', nargs='*', help='C files to run (default: unit_tests/*.c)')
+    parser.add_argument('--autocast', dest='autocast', action='store_true', help='Compile with --autocast')
+    parser.add_argument('--frames', dest='frames', type=int, default=10, help='Frames to run a main loop set with set_main for')
+    parser.add_argument('--max-instructions', dest='maxInstructions', type=int, default=10000000, help='Give up on a file after this many instructions')
+    parser.add_argument('--opcodes', dest='opcodes', action='store_true', help='Print how often each command ran')
+    args = parser.parse_args()
+
+    files = args.files if len(args.files) > 0 else sorted(glob.glob(os.path.join(ROOT, 'unit_tests', '*.c')))
+    totals = [0, 0]
+    print("%-28s %12s %12s %8s" % ("file", "unoptimized", "optimized", "change"))
+    for file in files:
+        unoptimized, unoptimizedOutput = run(file, dict(UNOPTIMIZED, autocast=args.autocast), args.frames, args.maxInstructions)
+        optimized, optimizedOutput = run(file, {"autocast" : args.autocast}, args.frames, args.maxInstructions)
+        assert unoptimizedOutput == optimizedOutput, "%s prints something different when optimized" % file
+        before, after = unoptimized.stats.instructions(), optimized.stats.instructions()
+        totals[0] += before
+        totals[1] += after
+        print("%-28s %12i %12i %+7.1f%%  (%.4fs -> %.4fs)" % (os.path.basename(file), before, after, 100.0 * (after - before) / max(before, 1),
+                                                         unoptimized.stats.seconds, optimized.stats.seconds))
+        if args.opcodes:
+            print(optimized.stats)
+    print("%-28s %12i %12i %+7.1f%%" % ("total", totals[0], totals[1], 100.0 * (totals[1] - totals[0]) / max(totals[0], 1)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Times a full build of a generated file with many functions against a rebuild
+# after editing a single function, with and without the function cache.
+#
+# usage: python benchmarks/incremental.py [-n functions]
+import os, sys, time, tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msclang import Compiler
+from ast_cache import AstCache, FragmentCache
+
+FUNCTION = '''
+int state_%i(int frame, float speed){
+    int counter = 0;
+    float total = 0.0;
+    for(int i = 0; i < frame; i++){
+        if(i %% 3 == 0 && speed > 1.5){
+            total += speed * 2.0;
+            counter++;
+        }
+        else if(i %% 5 == 0 || frame > %i){
+            printf("state %i frame %%i", i);
+        }
+        else{
+            total -= 1.0;
+        }
+    }
+    while(counter > 0){
+        counter--;
+        globalCounter += %i;
+    }
+    return counter + frame * %i;
+}
+'''
+
+def makeSource(functionCount, edited=None):
+    parts = ["int globalCounter;\n"]
+    for i in range(functionCount):
+        parts.append(FUNCTION % (i, i, i, i + (1 if i == edited else 0), i))
+    parts.append("void main(){\n    int result = state_0(3, 2.0);\n}\n")
+    return ''.join(parts)
+
+# Returns (parse time, code generation time)
+def timeCompile(compiler, text):
+    start = time.perf_counter()
+    ast = compiler.parse(text)
+    parsed = time.perf_counter()
+    compiler.compileAST(ast)
+    return parsed - start, time.perf_counter() - parsed
+
+def formatTimes(times):
+    return "parse %.1fms + codegen %.1fms" % (times[0] * 1000, times[1] * 1000)
+
+def main():
+    parser = ArgumentParser(description="Benchmark incremental compilation")
+    parser.add_argument('-n', dest='functions', type=int, default=300, help='Number of functions to generate')
+    args = parser.parse_args()
+
+    original = makeSource(args.functions)
+    edited = makeSource(args.functions, edited=args.functions // 2)
+    with tempfile.TemporaryDirectory() as cacheDir:
+        astCache = AstCache(os.path.join(cacheDir, 'ast'))
+        os.makedirs(astCache.directory)
+        fragmentDir = os.path.join(cacheDir, 'functions')
+        os.makedirs(fragmentDir)
+
+        print("%i functions" % args.functions)
+        full = timeCompile(Compiler(astCache=astCache), original)
+        edit = timeCompile(Compiler(astCache=astCache), edited)
+        print("no function cache:   full build %s" % formatTimes(full))
+        print("                     after edit %s" % formatTimes(edit))
+
+        fragmentCache = FragmentCache(fragmentDir)
+        timeCompile(Compiler(astCache=astCache, fragmentCache=fragmentCache), original)
+        # A fresh cache object so nothing is served from memory
+        coldEdit = timeCompile(Compiler(astCache=astCache, fragmentCache=FragmentCache(fragmentDir)), makeSource(args.functions, edited=1))
+        warmEdit = timeCompile(Compiler(astCache=astCache, fragmentCache=fragmentCache), edited)
+        print("with function cache: after edit %s (fragments from disk)" % formatTimes(coldEdit))
+        print("                     after edit %s (fragments in memory)" % formatTimes(warmEdit))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Compares the old regex based comment stripper against removeComments on
+# synthetic sources of increasing size. The time per byte of removeComments
+# should stay flat as the input grows, the regex one grows with the size of
+# the input since its lookahead rescans to the end of the file.
+#
+# usage: python benchmarks/remove_comments.py [--max-mb N] [--max-regex-kb N]
+import os, sys, re, time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msclang import removeComments
+
+def regexRemoveComments(text):
+    return re.sub(
+       '(?:\\/\\*(?=(?:[^"]*"[^"]*")*[^"]*$)(?:.|\\n)*?\\*\\/)|(?:\\/\\/(?=(?:[^"]*"[^"]*")*[^"]*$).*)',
+       '',
+       text
+    )
+
+BLOCK = '''/* Generated state handler
+ * with a block comment */
+int state_%i(int frame){
+    // line comment with a "quote" in it
+    printf("frame %%i // not a comment", frame);
+    printf("escaped \\" /* still a string */");
+    int c = '"';
+    return frame / 2; /* trailing */
+}
+'''
+
+def makeSource(size):
+    parts = []
+    total = 0
+    i = 0
+    while total < size:
+        part = BLOCK % i
+        parts.append(part)
+        total += len(part)
+        i += 1
+    return ''.join(parts)
+
+def timeIt(func, text):
+    start = time.perf_counter()
+    func(text)
+    return time.perf_counter() - start
+
+def main():
+    parser = ArgumentParser(description="Benchmark comment stripping")
+    parser.add_argument('--max-mb', dest='maxMb', type=int, default=8, help='Largest input for removeComments in MB')
+    parser.add_argument('--max-regex-kb', dest='maxRegexKb', type=int, default=128, help='Largest input for the regex in KB')
+    args = parser.parse_args()
+
+    print("%10s %12s %14s %12s %14s" % ("size", "new", "new ns/byte", "regex", "regex ns/byte"))
+    size = 16 * 1024
+    while size <= args.maxMb * 1024 * 1024:
+        text = makeSource(size)
+        newTime = timeIt(removeComments, text)
+        if size <= args.maxRegexKb * 1024:
+            regexTime = timeIt(regexRemoveComments, text)
+            regexColumns = "%10.1fms %14.1f" % (regexTime * 1000, regexTime * 1e9 / len(text))
+        else:
+            regexColumns = "%12s %14s" % ("-", "-")
+        print("%8iKB %10.1fms %14.1f %s" % (len(text) // 1024, newTime * 1000, newTime * 1e9 / len(text), regexColumns))
+        size *= 2
+
+if __name__ == "__main__":
+    main()
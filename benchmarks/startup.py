@@ -0,0 +1,62 @@
+# Measures cold and warm compile latency over the unit_tests corpus
+#
+# cold = a fresh interpreter importing msclang, building the parser and
+#        compiling the file once
+# warm = compiling the same file again in a process that already has a parser
+#
+# usage: python benchmarks/startup.py [-n repeats] [files...]
+import os, sys, glob, time, statistics, subprocess
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+COLD_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+from msclang import Compiler, getParser
+parserStart = time.perf_counter()
+getParser()
+parserEnd = time.perf_counter()
+with open({file!r}) as f:
+    Compiler().compile(f.read())
+end = time.perf_counter()
+print(parserStart - start, parserEnd - parserStart, end - parserEnd)
+"""
+
+def coldCompile(file):
+    output = subprocess.check_output([sys.executable, '-c', COLD_SCRIPT.format(root=ROOT, file=file)])
+    return [float(x) for x in output.split()]
+
+def warmCompile(compiler, text, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        compiler.compile(text)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def main():
+    parser = ArgumentParser(description="Benchmark msclang startup and compile latency")
+    parser.add_argument('files', nargs='*', default=sorted(glob.glob(os.path.join(ROOT, 'unit_tests', '*.c'))))
+    parser.add_argument('-n', dest='repeats', type=int, default=20, help='Warm compiles per file')
+    args = parser.parse_args()
+
+    from msclang import Compiler
+    compiler = Compiler()
+    print("%-28s %10s %10s %10s %10s" % ("file", "import", "parser", "cold", "warm"))
+    totals = [0.0, 0.0, 0.0, 0.0]
+    for file in args.files:
+        importTime, parserTime, coldTime = coldCompile(file)
+        with open(file) as f:
+            warmTime = warmCompile(compiler, f.read(), args.repeats)
+        for i, t in enumerate((importTime, parserTime, coldTime, warmTime)):
+            totals[i] += t
+        print("%-28s %8.2fms %8.2fms %8.2fms %8.2fms" % (os.path.basename(file), importTime * 1000,
+              parserTime * 1000, coldTime * 1000, warmTime * 1000))
+    count = max(len(args.files), 1)
+    print("%-28s %8.2fms %8.2fms %8.2fms %8.2fms" % ("average", *[t * 1000 / count for t in totals]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Compares the switch strategies by how many instructions it takes to get from
+# the top of a switch to the case that matches, and how big the dispatch code
+# is. The dispatch code is run with profiling.runDispatch, a small interpreter
+# for the handful of commands it uses, every value has to end up at the same
+# case with either strategy.
+#
+# usage: python benchmarks/switch.py [-n cases] [--misses N]
+import os, sys, random
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msclang import Compiler, Label, SWITCH_STRATEGIES, getSwitchRanges
+from peephole import commandSize
+from profiling import runDispatch
+
+# Case values of each shape with the label of the case they go to, cases in
+# a group share a label like case 1: case 2: would
+def makeCases(shape, count, r):
+    if shape == "dense":
+        values = list(range(count))
+        groupSize = 1
+    elif shape == "sparse":
+        values = sorted(r.sample(range(-1000, 100000), count))
+        groupSize = 1
+    else:
+        values = list(range(count))
+        groupSize = 4
+    labels = [Label() for _ in range((count + groupSize - 1) // groupSize)]
+    return [(value, labels[i // groupSize]) for i, value in enumerate(values)]
+
+def main():
+    parser = ArgumentParser(description="Benchmark the switch lowering strategies")
+    parser.add_argument('-n', dest='cases', type=int, default=32, help='Number of cases in each switch')
+    parser.add_argument('--misses', dest='misses', type=int, default=32, help='Number of values that go to default')
+    args = parser.parse_args()
+
+    r = random.Random(0)
+    for shape in ["dense", "sparse", "grouped"]:
+        cases = makeCases(shape, args.cases, r)
+        defaultLabel = Label()
+        values = [value for value, label in cases]
+        caseValues = set(values)
+        while len(values) < len(cases) + args.misses:
+            value = r.randrange(-2000, 110000)
+            if not value in caseValues:
+                values.append(value)
+
+        results = {}
+        for strategy in SWITCH_STRATEGIES:
+            compiler = Compiler(switchStrategy=strategy)
+            cmds = compiler.compileSwitchDispatch((0, 0), getSwitchRanges(cases), defaultLabel)
+            runs = [runDispatch(cmds, value) for value in values]
+            results[strategy] = runs
+            counts = [executed for target, executed in runs]
+            print("%-8s %-7s %5i bytes  %6.1f instructions per dispatch (max %i)" %
+                  (shape, strategy, commandSize(cmds), sum(counts) / len(counts), max(counts)))
+        targets = [[target for target, executed in runs] for runs in results.values()]
+        assert all(t == targets[0] for t in targets), "strategies disagree"
+
+if __name__ == "__main__":
+    main()
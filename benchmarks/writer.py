@@ -0,0 +1,120 @@
+# Compares the old writer, which built the file with repeated bytes
+# concatenation and a struct.pack per parameter, against Compiler.getBytes on
+# a synthetic program. Both have to produce the same file.
+#
+# usage: python benchmarks/writer.py [-n instructions] [--scripts N]
+import os, sys, copy, time, random, struct
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msclang import Compiler, FileRefs, Label
+from msc import MscFile, MscScript, Command, MSC_MAGIC, COMMAND_IDS
+
+def oldGetBytes(compiler):
+    currentPos = 0x10
+    for script in compiler.msc.scripts:
+        currentPos += script.size()
+
+    maxStringLength = 0
+    for string in compiler.msc.strings:
+        if len(string) > maxStringLength:
+            maxStringLength = len(string)
+    if maxStringLength % 0x10 != 0:
+        maxStringLength += 0x10 - (maxStringLength % 0x10)
+
+    fileBytes = MSC_MAGIC
+    fileBytes += struct.pack('<L', currentPos)
+    fileBytes += struct.pack('<L', 0x10 if not 'main' in compiler.refs.functions else compiler.refs.scriptPositions[compiler.refs.functions.index('main')])
+    fileBytes += struct.pack('<L', len(compiler.msc.scripts))
+    fileBytes += struct.pack('<L', 0x16)
+    fileBytes += struct.pack('<L', maxStringLength)
+    fileBytes += struct.pack('<L', len(compiler.msc.strings))
+    fileBytes += struct.pack('<L', 0)
+    fileBytes += struct.pack('<L', 0)
+    fileBytes += b'\x00' * 0x10
+
+    for script in compiler.msc.scripts:
+        for cmd in script:
+            if type(cmd) == Command:
+                for i in range(len(cmd.parameters)):
+                    if type(cmd.parameters[i]) == float:
+                        cmd.parameters[i] = struct.unpack('>L', struct.pack('>f', cmd.parameters[i]))[0]
+                fileBytes += cmd.write()
+
+    if len(fileBytes) % 0x10 != 0:
+        fileBytes += b'\x00' * (0x10 - (len(fileBytes) % 0x10))
+    for i in range(len(compiler.msc.scripts)):
+        fileBytes += struct.pack('<L',compiler.refs.scriptPositions[i])
+    if len(fileBytes) % 0x10 != 0:
+        fileBytes += b'\x00' * (0x10 - (len(fileBytes) % 0x10))
+    for string in compiler.msc.strings:
+        fileBytes += string.encode('utf-8')
+        fileBytes += b'\x00' * (maxStringLength - len(string))
+    return fileBytes
+
+# A mix of the commands the compiler emits most, with their parameters
+COMMANDS = [
+    ("pushInt", lambda r: [r.randrange(0x10000, 0x7fffffff)]),
+    ("pushShort", lambda r: [r.randrange(0x10000)]),
+    ("pushVar", lambda r: [r.randrange(2), r.randrange(32)]),
+    ("setVar", lambda r: [r.randrange(2), r.randrange(32)]),
+    ("pushInt", lambda r: [r.uniform(-100.0, 100.0)]),
+    ("addi", lambda r: []),
+    ("multf", lambda r: []),
+    ("lessThan", lambda r: []),
+    ("if", lambda r: [r.randrange(0x10, 0x100000)]),
+    ("jump", lambda r: [r.randrange(0x10, 0x100000)]),
+    ("sys", lambda r: [r.randrange(4), r.randrange(0x4d)]),
+    ("callFunc", lambda r: [r.randrange(4)]),
+    ("printf", lambda r: [r.randrange(4)]),
+]
+
+def makeCompiler(instructions, scriptCount):
+    r = random.Random(0)
+    compiler = Compiler()
+    compiler.refs = FileRefs(functions=['func_%i' % i for i in range(scriptCount - 1)] + ['main'])
+    compiler.msc = MscFile()
+    compiler.msc.strings = ['string number %i' % i for i in range(200)]
+    position = 0x10
+    for i in range(scriptCount):
+        script = MscScript()
+        script.cmds = [Command(COMMAND_IDS["begin"], [0, 0])]
+        for j in range(instructions // scriptCount - 2):
+            name, params = r.choice(COMMANDS)
+            script.cmds.append(Command(COMMAND_IDS[name], params(r), r.random() < 0.5))
+            if j % 50 == 0:
+                script.cmds.append(Label())
+        script.cmds.append(Command(COMMAND_IDS["end"]))
+        compiler.refs.scriptPositions.append(position)
+        position += script.size()
+        compiler.msc.scripts.append(script)
+    return compiler
+
+def timeIt(func, compiler, repeats):
+    best = None
+    for _ in range(repeats):
+        # Writing converts float parameters in place, start from a clean copy
+        compilerCopy = copy.deepcopy(compiler)
+        start = time.perf_counter()
+        result = func(compilerCopy)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+    return best, bytes(result)
+
+def main():
+    parser = ArgumentParser(description="Benchmark the MSCSB writer")
+    parser.add_argument('-n', dest='instructions', type=int, default=50000, help='Number of instructions to generate')
+    parser.add_argument('--scripts', dest='scripts', type=int, default=100, help='Number of scripts to split them over')
+    parser.add_argument('-r', dest='repeats', type=int, default=3, help='Number of runs to take the best of')
+    args = parser.parse_args()
+
+    compiler = makeCompiler(args.instructions, args.scripts)
+    oldTime, oldBytes = timeIt(oldGetBytes, compiler, args.repeats)
+    newTime, newBytes = timeIt(Compiler.getBytes, compiler, args.repeats)
+    assert oldBytes == newBytes, "writers disagree"
+    print("%i instructions, %i bytes" % (args.instructions, len(newBytes)))
+    print("old writer: %8.1fms" % (oldTime * 1000))
+    print("new writer: %8.1fms (%.1fx faster)" % (newTime * 1000, oldTime / newTime))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import json
+from msc import Command, COMMAND_IDS, COMMAND_STACKPOPS, VM_RETURNS
+from peephole import JUMPS, BRANCHES
+
+# Static analysis of compiled scripts: how deep each one's stack can get
+# and an estimate of what it costs to run, without running it. Works on the
+# commands of an MscFile once their positions are known, so it can be used on
+# the compiler's output or on a file read from disk.
+#
+# Costs come from a table of what each command costs, every block counts
+# LOOP_ITERATIONS times more for each loop it's in, and a function's
+# inclusive cost adds the inclusive cost of the functions it calls directly
+# at each call site.
+
+# Relative cost of each command, anything not listed costs 1. Calls set up a
+# frame and syscalls and printf leave the script to do their work.
+DEFAULT_COSTS = {
+    0x2c : 8,
+    0x2d : 8,
+    0x2f : 4,
+    0x30 : 4,
+    0x31 : 4,
+    0x11 : 2,
+    0x12 : 2,
+    0x3d : 2
+}
+LOOP_ITERATIONS = 10
+
+ALL_JUMPS = JUMPS + [0x5]
+EXITS = VM_RETURNS + [0x4d]
+CALLS = [0x2f, 0x30, 0x31]
+
+# A json object of command names (or numbers) to costs, on top of the defaults
+def loadCostTable(path):
+    with open(path, 'r') as f:
+        table = json.load(f)
+    costs = dict(DEFAULT_COSTS)
+    for command, cost in table.items():
+        costs[COMMAND_IDS[command] if command in COMMAND_IDS else int(command, 0)] = cost
+    return costs
+
+# The basic blocks of a script's commands as (first, last) indices and the
+# blocks each one can go to next. Jumps out of the script are left out.
+def getBasicBlocks(cmds):
+    index = dict((cmd.commandPosition, i) for i, cmd in enumerate(cmds))
+    leaders = set([0])
+    for i, cmd in enumerate(cmds):
+        if cmd.command in ALL_JUMPS + BRANCHES:
+            if cmd.parameters[0] in index:
+                leaders.add(index[cmd.parameters[0]])
+            leaders.add(i + 1)
+        elif cmd.command in EXITS:
+            leaders.add(i + 1)
+    leaders = sorted(leader for leader in leaders if leader < len(cmds))
+    blocks = [(start, end - 1) for start, end in zip(leaders, leaders[1:] + [len(cmds)])]
+    blockAt = dict((start, i) for i, (start, end) in enumerate(blocks))
+    successors = []
+    for start, end in blocks:
+        cmd = cmds[end]
+        following = []
+        if cmd.command in ALL_JUMPS + BRANCHES and cmd.parameters[0] in index:
+            following.append(blockAt[index[cmd.parameters[0]]])
+        if not cmd.command in ALL_JUMPS + EXITS and end + 1 < len(cmds):
+            following.append(blockAt[end + 1])
+        successors.append(following)
+    return blocks, successors
+
+# The blocks that every path from the first block to each block goes through
+def getDominators(successors):
+    predecessors = [[] for _ in successors]
+    for i, following in enumerate(successors):
+        for j in following:
+            predecessors[j].append(i)
+    everything = set(range(len(successors)))
+    dominators = [set([0])] + [everything for _ in successors[1:]]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(1, len(successors)):
+            dominating = set(everything)
+            for j in predecessors[i]:
+                dominating &= dominators[j]
+            dominating = (dominating if len(predecessors[i]) > 0 else set()) | set([i])
+            if dominating != dominators[i]:
+                dominators[i] = dominating
+                changed = True
+    return dominators, predecessors
+
+# Loops as (header block, blocks in the loop), found from the jumps back to
+# a block that dominates the jump. Loops sharing a header are merged.
+def getLoops(successors):
+    dominators, predecessors = getDominators(successors)
+    loops = {}
+    for i, following in enumerate(successors):
+        for header in following:
+            if header in dominators[i]:
+                body = loops.setdefault(header, set([header]))
+                stack = [i]
+                while len(stack) > 0:
+                    block = stack.pop()
+                    if not block in body:
+                        body.add(block)
+                        stack += predecessors[block]
+    return sorted(loops.items())
+
+# The most values the script has on its stack at once following every path
+# through it, and whether every path agrees on the depth where they meet. The
+# value a call returns is pushed if the try before it has its push bit set.
+def getMaxStackDepth(cmds):
+    index = dict((cmd.commandPosition, i) for i, cmd in enumerate(cmds))
+    states = {}
+    maxDepth = 0
+    consistent = True
+    worklist = [(0, 0, ())]
+    while len(worklist) > 0:
+        i, depth, tries = worklist.pop()
+        if i >= len(cmds):
+            continue
+        if i in states:
+            consistent = consistent and states[i] == (depth, tries)
+            continue
+        states[i] = (depth, tries)
+        cmd = cmds[i]
+        depth -= COMMAND_STACKPOPS.get(cmd.command, lambda params: 0)(cmd.parameters)
+        if cmd.command == 0x2e:
+            tries = tries + (cmd.pushBit,)
+        elif cmd.command == 0x2f and len(tries) > 0:
+            depth += 1 if tries[-1] else 0
+            tries = tries[:-1]
+        elif cmd.pushBit and not cmd.command in CALLS:
+            depth += 1
+        consistent = consistent and depth >= 0
+        maxDepth = max(maxDepth, depth)
+        if cmd.command in ALL_JUMPS + BRANCHES and cmd.parameters[0] in index:
+            worklist.append((index[cmd.parameters[0]], depth, tries))
+        if not cmd.command in ALL_JUMPS + EXITS:
+            worklist.append((i + 1, depth, tries))
+    return maxDepth, consistent
+
+# What analyzing a script found. blocks are (position, cost, loop depth),
+# loops are (header position, loop depth, cost of one time round) and calls
+# are (position of the function called, how many times a run calls it).
+class ScriptCost:
+    def __init__(self, name):
+        self.name = name
+        self.blocks = []
+        self.loops = []
+        self.calls = []
+        self.cost = 0
+        self.inclusiveCost = 0
+        self.maxStackDepth = 0
+        self.stackConsistent = True
+
+def analyzeScript(name, cmds, costs=DEFAULT_COSTS):
+    result = ScriptCost(name)
+    if len(cmds) == 0:
+        return result
+    blocks, successors = getBasicBlocks(cmds)
+    loops = getLoops(successors)
+    loopDepths = [sum(1 for header, body in loops if i in body) for i in range(len(blocks))]
+    blockCosts = [sum(costs.get(cmd.command, 1) for cmd in cmds[start:end + 1]) for start, end in blocks]
+    for i, (start, end) in enumerate(blocks):
+        result.blocks.append((cmds[start].commandPosition, blockCosts[i], loopDepths[i]))
+        weight = LOOP_ITERATIONS ** loopDepths[i]
+        result.cost += blockCosts[i] * weight
+        for j in range(start + 1, end + 1):
+            # Direct calls push the function's position right before calling.
+            # set_main (callFunc2) only saves it for later, so isn't a call.
+            if cmds[j].command in [0x2f, 0x31] and cmds[j - 1].command in [0xa, 0xd] and cmds[j - 1].pushBit:
+                result.calls.append((cmds[j - 1].parameters[0], weight))
+    for header, body in loops:
+        depth = loopDepths[header]
+        result.loops.append((cmds[blocks[header][0]].commandPosition, depth,
+                             sum(blockCosts[i] * LOOP_ITERATIONS ** (loopDepths[i] - depth) for i in body)))
+    result.maxStackDepth, result.stackConsistent = getMaxStackDepth(cmds)
+    return result
+
+# Analyze every script of an MscFile, names are the scripts' names in order
+# (the compiler's refs.functions). Returns a ScriptCost for each script.
+def analyzeFile(msc, names=None, costs=DEFAULT_COSTS):
+    results = []
+    starts = {}
+    for i, script in enumerate(msc.scripts):
+        cmds = [cmd for cmd in script.cmds if type(cmd) == Command]
+        result = analyzeScript(names[i] if names != None else script.name, cmds, costs)
+        if len(cmds) > 0:
+            starts[cmds[0].commandPosition] = result
+        results.append(result)
+
+    # Recursion only counts the function's own cost once round
+    def getInclusiveCost(result, visiting):
+        cost = result.cost
+        for position, weight in result.calls:
+            callee = starts.get(position)
+            if callee != None and not callee in visiting:
+                cost += weight * getInclusiveCost(callee, visiting | set([callee]))
+        return cost
+    for result in results:
+        result.inclusiveCost = getInclusiveCost(result, set([result]))
+    return results
+
+# The functions from most to least expensive (including what they call) with
+# the loops in each
+def formatReport(results, limit=None):
+    ranked = sorted(results, key=lambda result: -result.inclusiveCost)[:limit]
+    lines = ["%-24s %10s %10s %6s %7s %6s" % ("function", "cost", "inclusive", "stack", "blocks", "loops")]
+    for result in ranked:
+        lines.append("%-24s %10i %10i %5i%s %7i %6i" % (result.name, result.cost, result.inclusiveCost, result.maxStackDepth,
+                                                       " " if result.stackConsistent else "*", len(result.blocks), len(result.loops)))
+        for position, depth, cost in result.loops:
+            lines.append("    loop at 0x%X, depth %i: %i per iteration" % (position, depth, cost))
+    if any(not result.stackConsistent for result in ranked):
+        lines.append("* paths through the function leave different amounts on the stack or pop more than was pushed")
+    return '\n'.join(lines)
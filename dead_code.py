@@ -0,0 +1,44 @@
+from peephole import isCommand
+from liveness import READS, WRITES, READ_WRITES
+
+# Removal of the functions and globals a file doesn't need, working on the
+# compiled commands of every function before they're added to the file.
+# Functions are only referenced by name in a pushInt, whether it's for a
+# call, a function pointer (&f or just f) or set_main/callFunc3, so anything
+# main never pushes the name of, directly or through the functions it does,
+# can't run. Calls that were inlined don't count.
+
+def getReferencedFunctions(cmds, functions):
+    return set(cmd.parameters[0] for cmd in cmds
+               if isCommand(cmd) and cmd.command == 0xA and type(cmd.parameters[0]) == str and cmd.parameters[0] in functions)
+
+# Names of the functions reachable from entry, functionCmds maps each
+# function's name to its commands
+def getReachableFunctions(functionCmds, entry):
+    reachable = set()
+    stack = [entry]
+    while len(stack) > 0:
+        name = stack.pop()
+        if name in reachable:
+            continue
+        reachable.add(name)
+        stack += getReferencedFunctions(functionCmds[name], functionCmds)
+    return reachable
+
+def isGlobalCommand(cmd):
+    return isCommand(cmd) and cmd.command in READS + WRITES + READ_WRITES and cmd.parameters[0] == 1
+
+# Indices of the globals any of the lists of commands use, in order
+def getUsedGlobals(cmdLists):
+    used = set()
+    for cmds in cmdLists:
+        for cmd in cmds:
+            if isGlobalCommand(cmd):
+                used.add(cmd.parameters[1])
+    return sorted(used)
+
+# Change the index of every global used by cmds using newIndices, in place
+def renumberGlobals(cmds, newIndices):
+    for cmd in cmds:
+        if isGlobalCommand(cmd):
+            cmd.parameters = [1, newIndices[cmd.parameters[1]]]
@@ -0,0 +1,328 @@
+import copy
+import math
+import struct
+from pycparser import c_ast
+
+# Constant folding and algebraic simplification of a function's AST before
+# it's compiled. Folding follows what the game would compute at runtime:
+# ints wrap around at 32 bits and every float operation is rounded to a 32
+# bit float. Anything whose result isn't well defined (division by zero,
+# overflowing shifts, float results that aren't finite...) is left alone.
+#
+# Nodes are never modified in place, anything that changes is copied, so
+# the AST passed in (which may be cached) stays as it was.
+
+_FLOAT = struct.Struct('>f')
+
+def toFloat32(value):
+    return _FLOAT.unpack(_FLOAT.pack(value))[0]
+
+def toInt32(value):
+    value &= 0xFFFFFFFF
+    return value - 0x100000000 if value & 0x80000000 else value
+
+# Same as msclang.toInt, which doesn't treat a leading 0 as octal
+def parseInt(text):
+    try:
+        return int(text, 0)
+    except ValueError:
+        return int(text)
+
+# C integer division and remainder truncate towards zero
+def _divide(a, b):
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def _remainder(a, b):
+    return a - b * _divide(a, b)
+
+def _shiftLeft(a, b):
+    return a << b if 0 <= b < 32 else None
+
+def _shiftRight(a, b):
+    # Only fold shifts that are the same whether the game shifts arithmetically or not
+    return a >> b if 0 <= b < 32 and a >= 0 else None
+
+INT_OPERATIONS = {
+    "+"  : lambda a, b: a + b,
+    "-"  : lambda a, b: a - b,
+    "*"  : lambda a, b: a * b,
+    "/"  : lambda a, b: _divide(a, b) if b != 0 and not (a == -0x80000000 and b == -1) else None,
+    "%"  : lambda a, b: _remainder(a, b) if b != 0 and not (a == -0x80000000 and b == -1) else None,
+    "&"  : lambda a, b: a & b,
+    "|"  : lambda a, b: a | b,
+    "^"  : lambda a, b: a ^ b,
+    "<<" : _shiftLeft,
+    ">>" : _shiftRight,
+    "==" : lambda a, b: int(a == b),
+    "!=" : lambda a, b: int(a != b),
+    "<"  : lambda a, b: int(a < b),
+    "<=" : lambda a, b: int(a <= b),
+    ">"  : lambda a, b: int(a > b),
+    ">=" : lambda a, b: int(a >= b)
+}
+
+# Comparisons of floats give ints, the bitwise operations and % work on the
+# bits of a float so they aren't folded
+FLOAT_OPERATIONS = {
+    "+"  : lambda a, b: a + b,
+    "-"  : lambda a, b: a - b,
+    "*"  : lambda a, b: a * b,
+    "/"  : lambda a, b: a / b if b != 0 else None,
+    "==" : lambda a, b: int(a == b),
+    "!=" : lambda a, b: int(a != b),
+    "<"  : lambda a, b: int(a < b),
+    "<=" : lambda a, b: int(a <= b),
+    ">"  : lambda a, b: int(a > b),
+    ">=" : lambda a, b: int(a >= b)
+}
+
+# Operations with an int constant on one side that leave the other side as
+# is, when the other side is an int too. A float on the other side would be
+# combined with the bits of the int constant (or an int instruction used on
+# its bits) by the game, unless autocast converts the constant for the
+# arithmetic operations.
+RIGHT_IDENTITIES = {"+" : 0, "-" : 0, "*" : 1, "/" : 1, "|" : 0, "^" : 0, "<<" : 0, ">>" : 0}
+LEFT_IDENTITIES = {"+" : 0, "*" : 1, "|" : 0, "^" : 0}
+# Operations with an int constant on either side that always give that
+# constant, when the other side is an int
+ABSORBING = {"*" : 0, "&" : 0}
+ARITHMETIC_OPERATIONS = ["+", "-", "*", "/"]
+
+# Unary operations that write to or take the address of their operand, which
+# has to stay a variable
+ADDRESS_OPERATIONS = ["&", "p++", "p--", "++", "--"]
+
+# How often each kind of simplification was done
+class FoldStats:
+    def __init__(self):
+        self.counts = {}
+
+    def record(self, kind):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def add(self, other):
+        for kind, count in other.counts.items():
+            self.counts[kind] = self.counts.get(kind, 0) + count
+
+    def __str__(self):
+        lines = ["%-18s %6i" % (kind, self.counts[kind]) for kind in sorted(self.counts)]
+        lines.append("%-18s %6i" % ("total", sum(self.counts.values())))
+        return '\n'.join(lines)
+
+# Apply function to every child of node, returns node itself if nothing
+# changed or a copy of it with the new children. Children named in skip are
+# left alone.
+def mapChildren(node, function, skip=()):
+    changed = {}
+    for name in node.__slots__:
+        if name in ('coord', '__weakref__') or name in skip:
+            continue
+        value = getattr(node, name, None)
+        if isinstance(value, c_ast.Node):
+            newValue = function(value)
+        elif isinstance(value, list):
+            newValue = [function(item) if isinstance(item, c_ast.Node) else item for item in value]
+            if all(new is old for new, old in zip(newValue, value)):
+                continue
+        else:
+            continue
+        if not newValue is value:
+            changed[name] = newValue
+    if len(changed) == 0:
+        return node
+    node = copy.copy(node)
+    for name, value in changed.items():
+        setattr(node, name, value)
+    return node
+
+def getDeclaredNames(node):
+    names = set()
+    def visit(node):
+        if isinstance(node, c_ast.Decl) and node.name != None:
+            names.add(node.name)
+        for _, child in node.children():
+            visit(child)
+    visit(node)
+    return names
+
+class ConstantFolder:
+    # variables are the names that shadow global constants (locals and
+    # globals). Folding ints and floats together is only done with autocast
+    # since otherwise the game does float math on the bits of the int.
+    # getType gives "int", "float" or None for an expression, without it
+    # nothing is known to be an int.
+    def __init__(self, globalConstants, variables=(), autocast=False, stats=None, getType=None):
+        self.globalConstants = globalConstants
+        self.variables = set(variables)
+        self.autocast = autocast
+        self.stats = stats if stats != None else FoldStats()
+        self.getType = getType
+
+    def isInt(self, node):
+        return self.getType != None and self.getType(node) == "int"
+
+    # Whether an identity with an int constant can drop the constant from an
+    # operation on node
+    def canDropConstant(self, op, node):
+        return self.isInt(node) or (self.autocast and op in ARITHMETIC_OPERATIONS)
+
+    # Returns ('int', value) or ('float', value) for a constant node, None
+    # for anything else
+    def getValue(self, node):
+        if isinstance(node, c_ast.Constant):
+            try:
+                if node.type == "int":
+                    return ("int", toInt32(parseInt(node.value)))
+                if node.type == "float" or node.type == "double":
+                    return ("float", toFloat32(float(node.value.rstrip('fF'))))
+            except ValueError:
+                # Suffixes like 10u aren't handled by the compiler either
+                return None
+        return None
+
+    def makeConstant(self, value, coord):
+        valueType, number = value
+        if valueType == "int":
+            return c_ast.Constant("int", str(number), coord)
+        if math.isinf(number) or math.isnan(number):
+            return None
+        return c_ast.Constant("float", repr(number), coord)
+
+    def isPure(self, node):
+        if isinstance(node, (c_ast.Constant, c_ast.ID)):
+            return True
+        if isinstance(node, c_ast.BinaryOp):
+            return self.isPure(node.left) and self.isPure(node.right)
+        if isinstance(node, c_ast.UnaryOp):
+            return not node.op in ADDRESS_OPERATIONS and self.isPure(node.expr)
+        if isinstance(node, c_ast.Cast):
+            return self.isPure(node.expr)
+        return False
+
+    def fold(self, node):
+        if isinstance(node, c_ast.ID):
+            return self.foldID(node)
+        if isinstance(node, (c_ast.FuncCall, c_ast.Assignment, c_ast.StructRef, c_ast.Switch)):
+            return mapChildren(node, self.fold, self.getUnfoldedChildren(node))
+        if isinstance(node, c_ast.UnaryOp):
+            if node.op in ADDRESS_OPERATIONS:
+                return node
+            return self.foldUnaryOp(mapChildren(node, self.fold))
+        if isinstance(node, c_ast.BinaryOp):
+            return self.foldBinaryOp(mapChildren(node, self.fold))
+        if isinstance(node, c_ast.Cast):
+            return self.foldCast(mapChildren(node, self.fold))
+        if isinstance(node, c_ast.TernaryOp):
+            return self.foldTernaryOp(mapChildren(node, self.fold))
+        return mapChildren(node, self.fold)
+
+    # Children that have to stay as they are, names of functions and
+    # syscalls, variables being assigned to and the variable of a switch
+    def getUnfoldedChildren(self, node):
+        if isinstance(node, c_ast.FuncCall):
+            return ["name"]
+        if isinstance(node, c_ast.Assignment):
+            return ["lvalue"]
+        if isinstance(node, c_ast.Switch):
+            return ["cond"]
+        return ["name", "field"]
+
+    def foldID(self, node):
+        if node.name in self.variables or not node.name in self.globalConstants:
+            return node
+        value = self.globalConstants[node.name]
+        constant = self.makeConstant(("float", toFloat32(value)) if type(value) == float else ("int", toInt32(value)), node.coord)
+        if constant == None:
+            return node
+        self.stats.record("global constant")
+        return constant
+
+    def foldUnaryOp(self, node):
+        value = self.getValue(node.expr)
+        if value != None:
+            valueType, number = value
+            result = None
+            if node.op == "-":
+                result = ("int", toInt32(-number)) if valueType == "int" else ("float", -number)
+            elif node.op == "~" and valueType == "int":
+                result = ("int", ~number)
+            elif node.op == "!" and valueType == "int":
+                result = ("int", int(number == 0))
+            if result != None:
+                constant = self.makeConstant(result, node.coord)
+                if constant != None:
+                    self.stats.record("constant")
+                    return constant
+        # -(-x) and ~(~x)
+        if node.op in ["-", "~"] and isinstance(node.expr, c_ast.UnaryOp) and node.expr.op == node.op:
+            self.stats.record("identity")
+            return node.expr.expr
+        return node
+
+    def foldBinaryOp(self, node):
+        left = self.getValue(node.left)
+        right = self.getValue(node.right)
+        if left != None and right != None:
+            result = self.evaluate(node.op, left, right)
+            if result != None:
+                constant = self.makeConstant(result, node.coord)
+                if constant != None:
+                    self.stats.record("constant")
+                    return constant
+            return node
+
+        if right != None and right[0] == "int":
+            if RIGHT_IDENTITIES.get(node.op) == right[1] and self.canDropConstant(node.op, node.left):
+                self.stats.record("identity")
+                return node.left
+            if ABSORBING.get(node.op) == right[1] and self.isInt(node.left) and self.isPure(node.left):
+                self.stats.record("identity")
+                return node.right
+        if left != None and left[0] == "int":
+            if LEFT_IDENTITIES.get(node.op) == left[1] and self.canDropConstant(node.op, node.right):
+                self.stats.record("identity")
+                return node.right
+            if ABSORBING.get(node.op) == left[1] and self.isInt(node.right) and self.isPure(node.right):
+                self.stats.record("identity")
+                return node.left
+        return node
+
+    def evaluate(self, op, left, right):
+        if left[0] == "int" and right[0] == "int":
+            if not op in INT_OPERATIONS:
+                return None
+            result = INT_OPERATIONS[op](left[1], right[1])
+            return ("int", toInt32(result)) if result != None else None
+        if not op in FLOAT_OPERATIONS or (left[0] != right[0] and not self.autocast):
+            return None
+        result = FLOAT_OPERATIONS[op](toFloat32(left[1]), toFloat32(right[1]))
+        if result == None:
+            return None
+        return ("int", result) if type(result) == int else ("float", toFloat32(result))
+
+    def foldCast(self, node):
+        value = self.getValue(node.expr)
+        if value == None:
+            return node
+        valueType, number = value
+        if node.to_type.type.type.names[-1] == "float":
+            result = ("float", toFloat32(number))
+        elif valueType == "float":
+            if math.isinf(number) or math.isnan(number) or not -0x80000000 <= math.trunc(number) <= 0x7FFFFFFF:
+                return node
+            result = ("int", math.trunc(number))
+        else:
+            result = value
+        constant = self.makeConstant(result, node.coord)
+        if constant == None:
+            return node
+        self.stats.record("constant")
+        return constant
+
+    def foldTernaryOp(self, node):
+        value = self.getValue(node.cond)
+        if value == None or value[0] != "int":
+            return node
+        self.stats.record("constant")
+        return node.iftrue if value[1] != 0 else node.iffalse
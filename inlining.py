@@ -0,0 +1,100 @@
+from pycparser import c_ast
+from strength_reduction import STATEMENT_SLOTS
+
+# Helpers for inlining small functions into their callers. The compiler
+# compiles an inlined call by storing the arguments in new locals of the
+# caller and compiling the callee's body in their place, with the expression
+# of its final return as the value of the call.
+#
+# Only functions shaped so that works are inlined: no returns except a last
+# one, no gotos or labels (they'd be duplicated at every call site) and not
+# recursive, directly or through other functions.
+
+def getCalledFunctions(node, functions):
+    called = set()
+    def visit(node):
+        if isinstance(node, c_ast.FuncCall) and isinstance(node.name, c_ast.ID) and node.name.name in functions:
+            called.add(node.name.name)
+        for _, child in node.children():
+            visit(child)
+    visit(node)
+    return called
+
+# The user functions each function calls directly, by name
+def getCallGraph(funcDefs):
+    return dict((name, getCalledFunctions(func.body, funcDefs)) for name, func in funcDefs.items())
+
+def getReachable(callGraph, name, follow=None):
+    reachable = set()
+    stack = list(callGraph.get(name, ()))
+    while len(stack) > 0:
+        callee = stack.pop()
+        if callee in reachable or (follow != None and not callee in follow):
+            continue
+        reachable.add(callee)
+        stack += callGraph.get(callee, ())
+    return reachable
+
+def isRecursive(callGraph, name):
+    return name in getReachable(callGraph, name)
+
+def getNodeSize(node):
+    return 1 + sum(getNodeSize(child) for _, child in node.children())
+
+def containsType(node, types):
+    if isinstance(node, types):
+        return True
+    return any(containsType(child, types) for _, child in node.children())
+
+# Whether a function's body can be compiled in place of a call to it.
+# Conditions, || and && push their result whatever the call's value is used
+# for, so they can't be the returned value.
+def canInline(func, returnType):
+    items = func.body.block_items if func.body.block_items != None else []
+    last = items[-1] if len(items) > 0 else None
+    if containsType(func.body, (c_ast.Label, c_ast.Goto)):
+        return False
+    if any(containsType(item, c_ast.Return) for item in items[:-1]):
+        return False
+    if isinstance(last, c_ast.Return):
+        if (last.expr == None) != (returnType == "void"):
+            return False
+        if isinstance(last.expr, c_ast.TernaryOp) or (isinstance(last.expr, c_ast.BinaryOp) and last.expr.op in ["&&", "||"]):
+            return False
+        return True
+    # Falling off the end only gives a value to use if the function is void
+    return returnType == "void" and (last == None or not containsType(last, c_ast.Return))
+
+# Function calls and prefix increments and decrements whose value isn't
+# used because they're a statement of their own, as ids of the nodes
+def getStatementExpressions(body):
+    expressions = set()
+    def visit(node):
+        if type(node) in STATEMENT_SLOTS:
+            for name in STATEMENT_SLOTS[type(node)]:
+                value = getattr(node, name)
+                for statement in value if isinstance(value, list) else [value]:
+                    if isinstance(statement, c_ast.FuncCall) or (isinstance(statement, c_ast.UnaryOp) and statement.op in ["++", "--"]):
+                        expressions.add(id(statement))
+        for _, child in node.children():
+            visit(child)
+    visit(body)
+    return expressions
+
+# Call sites inlined and how many bytes bigger (or smaller) they are than
+# the calls they replaced
+class InlineStats:
+    def __init__(self):
+        self.callSites = 0
+        self.bytesAdded = 0
+
+    def record(self, bytesAdded):
+        self.callSites += 1
+        self.bytesAdded += bytesAdded
+
+    def add(self, other):
+        self.callSites += other.callSites
+        self.bytesAdded += other.bytesAdded
+
+    def __str__(self):
+        return "%i call sites inlined, %+i bytes" % (self.callSites, self.bytesAdded)
@@ -0,0 +1,433 @@
+import time
+from msc import Command, COMMAND_STACKPOPS, VM_RETURNS, VM_INT_OPERATIONS, VM_FLOAT_OPERATIONS, VM_FLOAT_COMPARISONS, VM_UNARY_OPERATIONS
+from peephole import isCommand, JUMPS, BRANCHES
+from liveness import READS, WRITES, getLocal, getCopySource
+from cost_analysis import getLoops
+
+# Intermediate representation of a script as basic blocks, between compiling
+# a function's AST (compileScript) and the peephole optimizer. The blocks are
+# built from the commands compileNode emits, passes work on the blocks and
+# lowering puts their commands and labels back into a single list.
+#
+# Every block keeps the labels it started with and jumps still point at
+# Label objects (or names, for gotos), so lowering only has to put the
+# blocks back in order. A block falls through to the one laid out after it
+# unless it ends with a jump or a return, passes that add or remove blocks
+# have to keep that working.
+#
+# A pass is a function taking an IRFunction and returning how many changes
+# it made. Passes are run in order and timed by optimize.
+
+ALL_JUMPS = JUMPS + [0x5]
+CALLS = [0x2f, 0x30, 0x31]
+# Commands that only compute a value from what they pop. Integer division and
+# modulo are left out since they can fail.
+PURE_OPERATIONS = [op for op in list(VM_INT_OPERATIONS) + list(VM_FLOAT_OPERATIONS) + list(VM_FLOAT_COMPARISONS) +
+                   list(VM_UNARY_OPERATIONS) if not op in [0x11, 0x12]]
+
+class Block:
+    def __init__(self, labels=None):
+        # Labels at the start of the block and its commands (none of them
+        # labels), the blocks control can go to next and come from and how
+        # many values are on the stack when it starts and ends, None if
+        # nothing reaches it
+        self.labels = labels if labels != None else []
+        self.cmds = []
+        self.successors = []
+        self.predecessors = []
+        self.stackIn = None
+        self.stackOut = None
+
+    def last(self):
+        return self.cmds[-1] if len(self.cmds) > 0 else None
+
+    # Whether control can go on to the block laid out after this one
+    def fallsThrough(self):
+        last = self.last()
+        return last == None or not last.command in ALL_JUMPS + VM_RETURNS
+
+    def __str__(self):
+        lines = [str(label) for label in self.labels]
+        lines.append("    ; stack %s -> %s" % (self.stackIn, self.stackOut))
+        lines += ["    " + str(cmd) for cmd in self.cmds]
+        return '\n'.join(lines)
+
+class IRFunction:
+    # makeLabel makes a new label for passes that add blocks
+    def __init__(self, blocks, makeLabel):
+        self.blocks = blocks
+        self.makeLabel = makeLabel
+        # Whether every path agrees on the depth of the stack where they meet
+        self.stackConsistent = True
+        self.update()
+
+    # Work out the successors, predecessors and stack depths of every block
+    # again, passes call this once they've changed the blocks
+    def update(self):
+        labelBlocks = {}
+        for block in self.blocks:
+            block.successors = []
+            block.predecessors = []
+            for label in block.labels:
+                labelBlocks[label] = block
+                if label.name != None:
+                    labelBlocks[label.name] = block
+        for i, block in enumerate(self.blocks):
+            last = block.last()
+            if last != None and last.command in ALL_JUMPS + BRANCHES and last.parameters[0] in labelBlocks:
+                block.successors.append(labelBlocks[last.parameters[0]])
+            if block.fallsThrough() and i + 1 < len(self.blocks) and not self.blocks[i + 1] in block.successors:
+                block.successors.append(self.blocks[i + 1])
+            for successor in block.successors:
+                successor.predecessors.append(block)
+        self.updateStackDepths()
+
+    # Follow the stack through every path from the start. The value a call
+    # returns is pushed if the try before it has its push bit set, so the
+    # push bits of the tries still waiting for their call are followed too.
+    def updateStackDepths(self):
+        for block in self.blocks:
+            block.stackIn = block.stackOut = None
+        self.stackConsistent = True
+        states = {}
+        worklist = [(self.blocks[0], 0, ())]
+        while len(worklist) > 0:
+            block, depth, tries = worklist.pop()
+            if block in states:
+                self.stackConsistent = self.stackConsistent and states[block] == (depth, tries)
+                continue
+            states[block] = (depth, tries)
+            block.stackIn = depth
+            for cmd in block.cmds:
+                depth, tries = getStackEffect(cmd, depth, tries)
+                self.stackConsistent = self.stackConsistent and depth >= 0
+            block.stackOut = depth
+            for successor in block.successors:
+                worklist.append((successor, depth, tries))
+
+    def lower(self):
+        cmds = []
+        for block in self.blocks:
+            cmds += block.labels + block.cmds
+        return cmds
+
+    def __str__(self):
+        return '\n'.join(str(block) for block in self.blocks)
+
+# The depth of the stack and the push bits of the tries waiting for their
+# call after cmd runs
+def getStackEffect(cmd, depth, tries):
+    depth -= COMMAND_STACKPOPS.get(cmd.command, lambda params: 0)(cmd.parameters)
+    if cmd.command == 0x2e:
+        tries = tries + (cmd.pushBit,)
+    elif cmd.command == 0x2f and len(tries) > 0:
+        depth += 1 if tries[-1] else 0
+        tries = tries[:-1]
+    elif cmd.pushBit and not cmd.command in CALLS:
+        depth += 1
+    return depth, tries
+
+# Split a script's commands into blocks at every label and after every jump,
+# branch and return
+def buildFunction(cmds, makeLabel):
+    blocks = [Block()]
+    for cmd in cmds:
+        if not isCommand(cmd):
+            if len(blocks[-1].cmds) > 0:
+                blocks.append(Block())
+            blocks[-1].labels.append(cmd)
+        else:
+            blocks[-1].cmds.append(cmd)
+            if cmd.command in ALL_JUMPS + BRANCHES + VM_RETURNS:
+                blocks.append(Block())
+    if len(blocks) > 1 and len(blocks[-1].labels) == 0 and len(blocks[-1].cmds) == 0:
+        blocks.pop()
+    return IRFunction(blocks, makeLabel)
+
+# (values popped, values pushed) by a command that only pushes a constant or
+# a variable or computes a value from what it pops, None for anything else
+def getPureEffect(cmd):
+    if cmd.command in [0x38, 0x39]:
+        return (1, 1) if cmd.parameters[0] == 0 else None
+    if not cmd.pushBit:
+        return None
+    if cmd.command in [0xa, 0xd, 0xb]:
+        return (0, 1)
+    if cmd.command in PURE_OPERATIONS:
+        return (COMMAND_STACKPOPS[cmd.command](cmd.parameters), 1)
+    return None
+
+# Index of the first of the pure commands right before cmds[end] that push
+# the count values it pops, None if they aren't all pure
+def getValueStart(cmds, end, count):
+    needed = count
+    i = end
+    while needed > 0:
+        i -= 1
+        if i < 0:
+            return None
+        effect = getPureEffect(cmds[i])
+        if effect == None:
+            return None
+        needed += effect[0] - effect[1]
+    return i
+
+def getLiveBefore(cmd, live):
+    local = getLocal(cmd)
+    if local == None:
+        return live
+    if cmd.command in WRITES:
+        return live & ~(1 << local)
+    return live | (1 << local)
+
+# The locals live at the start and end of each block as bitsets
+def getLiveLocals(function):
+    liveIn = dict((block, 0) for block in function.blocks)
+    liveOut = dict((block, 0) for block in function.blocks)
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(function.blocks):
+            out = 0
+            for successor in block.successors:
+                out |= liveIn[successor]
+            live = out
+            for cmd in reversed(block.cmds):
+                live = getLiveBefore(cmd, live)
+            if live != liveIn[block] or out != liveOut[block]:
+                liveIn[block], liveOut[block] = live, out
+                changed = True
+    return liveIn, liveOut
+
+# The local a command writes without pushing anything, None if it doesn't
+def getStoredLocal(cmd):
+    local = getLocal(cmd)
+    if local == None or cmd.command in READS or cmd.pushBit:
+        return None
+    return local
+
+def getReferencedLabels(blocks):
+    return set(param for block in blocks for cmd in block.cmds for param in cmd.parameters
+               if not isinstance(param, (int, float, str)))
+
+# Replace reads of a local that's a copy of another with reads of the
+# original, so the copy can be removed if nothing else needs it. A copy
+# (pushVar a; setVar b) is followed into every block that can only be
+# reached after it, until either local is written again.
+def propagateCopies(function):
+    def run(block, copies, rewrite):
+        copies = dict(copies)
+        changes = 0
+        for i, cmd in enumerate(block.cmds):
+            local = getLocal(cmd)
+            if local == None:
+                continue
+            if cmd.command in READS:
+                if rewrite and local in copies:
+                    block.cmds[i] = Command(0xb, [0, copies[local]], cmd.pushBit)
+                    changes += 1
+                continue
+            copies = dict((destination, source) for destination, source in copies.items()
+                          if destination != local and source != local)
+            source = getCopySource(block.cmds, i - 1) if i > 0 else None
+            if source != None and source != local and getStoredLocal(cmd) != None:
+                copies[local] = source
+        return copies, changes
+
+    # Copies available at the end of each block, None until it's been run
+    copiesIn = {}
+    copiesOut = dict((block, None) for block in function.blocks)
+    changed = True
+    while changed:
+        changed = False
+        for i, block in enumerate(function.blocks):
+            known = [copiesOut[predecessor] for predecessor in block.predecessors if copiesOut[predecessor] != None]
+            copies = {}
+            if i > 0 and len(known) > 0:
+                copies = dict((destination, source) for destination, source in known[0].items()
+                              if all(other.get(destination) == source for other in known[1:]))
+            copiesIn[block] = copies
+            out = run(block, copies, False)[0]
+            if out != copiesOut[block]:
+                copiesOut[block] = out
+                changed = True
+    return sum(run(block, copiesIn[block], True)[1] for block in function.blocks)
+
+# Move assignments of a value that can't change during a loop out of it,
+# into a new block run once before the loop starts. The value has to be
+# made from constants and locals the loop doesn't write, and the local it's
+# assigned to has to be written only there and not be read in the loop
+# before it's assigned. Nothing the value is made from can fail, so it's
+# fine to compute it even if the loop runs zero times.
+def hoistInvariants(function):
+    changes = 0
+    changed = True
+    while changed:
+        changed = False
+        liveIn, liveOut = getLiveLocals(function)
+        for header, body in getLoops([[function.blocks.index(successor) for successor in block.successors]
+                                      for block in function.blocks]):
+            hoisted = hoistLoop(function, function.blocks[header], [function.blocks[i] for i in sorted(body)], liveIn)
+            if hoisted > 0:
+                changes += hoisted
+                changed = True
+                function.update()
+                break
+    return changes
+
+# Hoist what can be hoisted out of one loop, returns how many commands moved
+def hoistLoop(function, header, loop, liveIn):
+    headerIndex = function.blocks.index(header)
+    if headerIndex == 0 or header.stackIn == None:
+        return 0
+    # Jumps back to the header are moved to a label of its own, anything else
+    # using its labels can't be
+    others = [cmd for block in loop for cmd in block.cmds
+              if not (cmd is block.last() and cmd.command in ALL_JUMPS + BRANCHES)]
+    if any(param in header.labels for cmd in others for param in cmd.parameters):
+        return 0
+
+    written = {}
+    for block in loop:
+        for cmd in block.cmds:
+            local = getLocal(cmd)
+            if local != None and not cmd.command in READS:
+                written[local] = written.get(local, 0) + 1
+    def isInvariant(cmd):
+        return cmd.command != 0xb or (cmd.parameters[0] == 0 and written.get(cmd.parameters[1], 0) == 0)
+
+    hoisted = []
+    changed = True
+    while changed:
+        changed = False
+        for block in loop:
+            for i, cmd in enumerate(block.cmds):
+                local = getStoredLocal(cmd)
+                if local == None or not cmd.command in WRITES or written[local] != 1 or liveIn[header] & (1 << local):
+                    continue
+                start = getValueStart(block.cmds, i, 1)
+                if start != None and all(isInvariant(valueCmd) for valueCmd in block.cmds[start:i]):
+                    hoisted += block.cmds[start:i + 1]
+                    del block.cmds[start:i + 1]
+                    written[local] = 0
+                    changed = True
+                    break
+    if len(hoisted) == 0:
+        return 0
+
+    # The new block takes the header's labels so everything entering the
+    # loop from outside goes through it
+    labels = header.labels
+    preheader = Block(labels)
+    preheader.cmds = hoisted
+    loopLabel = function.makeLabel()
+    header.labels = [loopLabel]
+    names = [label.name for label in labels if label.name != None]
+    for block in loop:
+        last = block.last()
+        if last != None and last.command in ALL_JUMPS + BRANCHES and (last.parameters[0] in labels or last.parameters[0] in names):
+            block.cmds[-1] = Command(last.command, [loopLabel], last.pushBit)
+    function.blocks.insert(headerIndex, preheader)
+    # A block of the loop falling into the header has to jump over the new
+    # block now. The jump gets a block of its own since a block only has
+    # one jump, at its end.
+    previous = function.blocks[headerIndex - 1]
+    if previous in loop and previous.fallsThrough():
+        jump = Block()
+        jump.cmds.append(Command(0x4, [loopLabel]))
+        function.blocks.insert(headerIndex, jump)
+    return len(hoisted)
+
+# Remove blocks nothing can reach and assignments to locals that are never
+# read afterwards, along with the commands that made the value
+def removeDeadCode(function):
+    changes = removeUnreachableBlocks(function)
+    changed = True
+    while changed:
+        changed = False
+        liveIn, liveOut = getLiveLocals(function)
+        for block in function.blocks:
+            live = liveOut[block]
+            kept = []
+            i = len(block.cmds) - 1
+            while i >= 0:
+                cmd = block.cmds[i]
+                local = getStoredLocal(cmd)
+                if local != None and not live & (1 << local):
+                    start = getValueStart(block.cmds, i, COMMAND_STACKPOPS[cmd.command](cmd.parameters))
+                    if start != None:
+                        changes += i - start + 1
+                        changed = True
+                        i = start - 1
+                        continue
+                live = getLiveBefore(cmd, live)
+                kept.append(cmd)
+                i -= 1
+            block.cmds = kept[::-1]
+    return changes
+
+# Blocks with a label something still uses are kept, like the return
+# address a try pushes
+def removeUnreachableBlocks(function):
+    reachable = set()
+    stack = [function.blocks[0]]
+    while True:
+        while len(stack) > 0:
+            block = stack.pop()
+            if not block in reachable:
+                reachable.add(block)
+                stack += block.successors
+        referenced = getReferencedLabels(reachable)
+        stack = [block for block in function.blocks
+                 if not block in reachable and any(label in referenced for label in block.labels)]
+        if len(stack) == 0:
+            break
+    removed = [block for block in function.blocks if not block in reachable]
+    changes = sum(len(block.cmds) for block in removed)
+    # The end of the script is kept since it marks where the script stops
+    end = function.blocks[-1]
+    if not end in reachable and end.last() != None and end.last().command == 0x3:
+        changes -= 1
+        end.cmds = [end.last()]
+        reachable.add(end)
+    function.blocks = [block for block in function.blocks if block in reachable]
+    return changes
+
+DEFAULT_PASSES = [propagateCopies, hoistInvariants, removeDeadCode]
+PASSES = dict((irPass.__name__, irPass) for irPass in DEFAULT_PASSES)
+
+# Changes made and time taken per pass
+class IRStats:
+    def __init__(self):
+        self.changes = {}
+        self.seconds = {}
+
+    def record(self, passName, changes, seconds):
+        self.changes[passName] = self.changes.get(passName, 0) + changes
+        self.seconds[passName] = self.seconds.get(passName, 0.0) + seconds
+
+    def add(self, other):
+        for passName, changes in other.changes.items():
+            self.record(passName, changes, other.seconds[passName])
+
+    def __str__(self):
+        lines = ["%-18s %6i changes %8.4fs" % (passName, self.changes[passName], self.seconds[passName])
+                 for passName in sorted(self.changes)]
+        lines.append("%-18s %6i changes %8.4fs" % ("total", sum(self.changes.values()), sum(self.seconds.values())))
+        return '\n'.join(lines)
+
+# Build the IR of a script's commands, run the passes over it and lower it
+# back to commands
+def optimize(cmds, makeLabel, passes=DEFAULT_PASSES, stats=None):
+    if len(passes) == 0 or len(cmds) == 0:
+        return cmds
+    if stats == None:
+        stats = IRStats()
+    function = buildFunction(cmds, makeLabel)
+    for irPass in passes:
+        start = time.perf_counter()
+        changes = irPass(function)
+        if changes > 0:
+            function.update()
+        stats.record(irPass.__name__, changes, time.perf_counter() - start)
+    return function.lower()
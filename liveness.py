@@ -0,0 +1,157 @@
+import copy
+from msc import Command
+from peephole import isCommand, JUMPS, BRANCHES
+
+# Local variable slot allocation for a script's commands, before references
+# are resolved. Every declaration gets its own slot while compiling, this
+# works out where each one is live and gives locals that are never live at
+# the same time the same slot, which shrinks the frame begin asks for.
+#
+# Arguments keep the slots the caller puts them in. A local that's read
+# before it's written is live from the start of the script, so it never
+# shares a slot with anything written before that read.
+
+# Commands with a [scope, index] variable as parameters, by what they do to it
+READS = [0xb]
+WRITES = [0x1c, 0x41]
+READ_WRITES = [0x14, 0x15, 0x3f, 0x40] + list(range(0x1d, 0x25)) + list(range(0x42, 0x46))
+# Nothing runs after these
+EXITS = [0x3, 0x6, 0x7]
+
+# The local variable cmd uses, None if it doesn't use one
+def getLocal(cmd):
+    if isCommand(cmd) and cmd.command in READS + WRITES + READ_WRITES and cmd.parameters[0] == 0:
+        return cmd.parameters[1]
+    return None
+
+# Indices of the commands that can run right after each one. Labels are
+# found by object or, for gotos, by name.
+def getSuccessors(cmds):
+    labelIndex = {}
+    for i, cmd in enumerate(cmds):
+        if not isCommand(cmd):
+            labelIndex[cmd] = i
+            if cmd.name != None:
+                labelIndex[cmd.name] = i
+    successors = []
+    for i, cmd in enumerate(cmds):
+        following = [i + 1] if i + 1 < len(cmds) else []
+        if not isCommand(cmd):
+            successors.append(following)
+        elif cmd.command in JUMPS:
+            successors.append([labelIndex[cmd.parameters[0]]] if cmd.parameters[0] in labelIndex else [])
+        elif cmd.command in BRANCHES:
+            successors.append(following + ([labelIndex[cmd.parameters[0]]] if cmd.parameters[0] in labelIndex else []))
+        elif cmd.command in EXITS:
+            successors.append([])
+        else:
+            successors.append(following)
+    return successors
+
+# The locals live before and after each command as bitsets
+def getLiveness(cmds, successors):
+    liveIn = [0] * len(cmds)
+    liveOut = [0] * len(cmds)
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(cmds))):
+            out = 0
+            for j in successors[i]:
+                out |= liveIn[j]
+            live = out
+            local = getLocal(cmds[i])
+            if local != None:
+                if cmds[i].command in WRITES:
+                    live &= ~(1 << local)
+                else:
+                    live |= 1 << local
+            if live != liveIn[i] or out != liveOut[i]:
+                liveIn[i], liveOut[i] = live, out
+                changed = True
+    return liveIn, liveOut
+
+def getBits(bitset):
+    bits = []
+    i = 0
+    while bitset != 0:
+        if bitset & 1:
+            bits.append(i)
+        bitset >>= 1
+        i += 1
+    return bits
+
+# Which locals can't share a slot with each other: anything written while
+# another local is live, and the arguments with everything live on entry
+def getInterference(cmds, argCount, liveIn, liveOut):
+    interference = {}
+    def addEdge(a, b):
+        if a != b:
+            interference.setdefault(a, set()).add(b)
+            interference.setdefault(b, set()).add(a)
+    for i, cmd in enumerate(cmds):
+        local = getLocal(cmd)
+        if local != None and not cmd.command in READS:
+            for other in getBits(liveOut[i]):
+                addEdge(local, other)
+    entry = getBits(liveIn[0]) if len(cmds) > 0 else []
+    for arg in range(argCount):
+        for other in entry:
+            addEdge(arg, other)
+    return interference
+
+# The local cmds[i] copies into cmds[i + 1], None if they aren't a copy
+# from one local to another
+def getCopySource(cmds, i):
+    if i + 1 >= len(cmds) or getLocal(cmds[i]) == None or getLocal(cmds[i + 1]) == None:
+        return None
+    if cmds[i].command in READS and cmds[i].pushBit and cmds[i + 1].command in WRITES:
+        return getLocal(cmds[i])
+    return None
+
+# Give every local a slot, returns the new list of commands with begin
+# asking for only as many slots as are used. A local that's a copy of
+# another gets the same slot if it can, which makes the copy do nothing so
+# it's removed.
+def allocateSlots(cmds):
+    begin = next((cmd for cmd in cmds if isCommand(cmd) and cmd.command == 0x2), None)
+    if begin == None:
+        return cmds
+    argCount = begin.parameters[0]
+    liveIn, liveOut = getLiveness(cmds, getSuccessors(cmds))
+    interference = getInterference(cmds, argCount, liveIn, liveOut)
+
+    copies = {}
+    for i in range(len(cmds)):
+        source = getCopySource(cmds, i)
+        if source != None:
+            copies.setdefault(getLocal(cmds[i + 1]), []).append(source)
+
+    slots = dict((arg, arg) for arg in range(argCount))
+    for cmd in cmds:
+        local = getLocal(cmd)
+        if local == None or local in slots:
+            continue
+        used = set(slots[other] for other in interference.get(local, ()) if other in slots)
+        preferred = [slots[source] for source in copies.get(local, []) if source in slots and not slots[source] in used]
+        if len(preferred) > 0:
+            slots[local] = preferred[0]
+            continue
+        slot = 0
+        while slot in used:
+            slot += 1
+        slots[local] = slot
+
+    out = []
+    for cmd in cmds:
+        local = getLocal(cmd)
+        if cmd is begin:
+            cmd = Command(0x2, [argCount, max([argCount] + [slot + 1 for slot in slots.values()])], cmd.pushBit)
+        elif local != None and slots[local] != local:
+            cmd = copy.copy(cmd)
+            cmd.parameters = [0, slots[local]]
+        out.append(cmd)
+    return [cmd for i, cmd in enumerate(out) if not isSelfCopy(out, i) and not isSelfCopy(out, i - 1)]
+
+def isSelfCopy(cmds, i):
+    return i >= 0 and getCopySource(cmds, i) != None and getCopySource(cmds, i) == getLocal(cmds[i + 1])
@@ -6,10 +6,14 @@
 from sys import version_info
 isPython3 = version_info >= (3,)
 assert isPython3 #If this fails switch to python 3
-import struct, tempfile
+import struct, tempfile, time, math, re
 
 MSC_MAGIC = b'\xB2\xAC\xBC\xBA\xE6\x90\x32\x01\xFD\x02\x00\x00\x00\x00\x00\x00'
 
+# Magic, end of the scripts, entry point, script count, unknown, string size,
+# string count and two unused words followed by 0x10 bytes of padding
+MSC_HEADER = struct.Struct('<16s8L16x')
+
 COMMAND_IDS = {
     "nop"            : 0x0,
     "begin"          : 0x2,
@@ -269,6 +273,23 @@ TYPE_SIZES = {
     'I' : 4
 }
 
+# Precompiled struct for each command, the opcode byte followed by its
+# parameters. byte and long aren't real commands so they have no opcode byte.
+COMMAND_STRUCTS = {}
+COMMAND_PARAM_COUNTS = {}
+for k, v in COMMAND_FORMAT.items():
+    COMMAND_STRUCTS[k] = struct.Struct('>' + v if k in [0xFFFE, 0xFFFF] else '>B' + v)
+    COMMAND_PARAM_COUNTS[k] = len(v)
+
+_FLOAT = struct.Struct('>f')
+_FLOAT_BITS = struct.Struct('>L')
+
+def floatToBits(f):
+    return _FLOAT_BITS.unpack(_FLOAT.pack(f))[0]
+
+def bitsToFloat(bits):
+    return _FLOAT.unpack(_FLOAT_BITS.pack(bits & 0xffffffff))[0]
+
 def getSizeFromFormat(formatString):
     s = 0
     for char in formatString:
@@ -373,6 +394,19 @@ class Command:
             self.parameters = [self.command]
             self.command = 0xFFFE #unknown command, display as "byte X"
 
+    # Pack the command into buffer at offset, returns the offset after it.
+    # Float parameters are written as their bits.
+    def writeInto(self, buffer, offset):
+        command = self.command
+        commandStruct = COMMAND_STRUCTS[command]
+        params = [param & 0xffffffff if type(param) != float else floatToBits(param)
+                  for param in self.parameters[:COMMAND_PARAM_COUNTS[command]]]
+        if command < 0x80:
+            commandStruct.pack_into(buffer, offset, command | 0x80 if self.pushBit else command, *params)
+        else:
+            commandStruct.pack_into(buffer, offset, *params)
+        return offset + commandStruct.size
+
     def write(self, endian='>'):
         if self.command in [0xFFFE, 0xFFFF]:
             returnBytes = bytes()
@@ -412,6 +446,7 @@ class MscScript:
         self.name = 'Unnamed Script'
         self.bounds = [0,0]
         self._iterationPosition = 0
+        self._indices = {}
 
     def __getitem__(self, key):
         return self.cmds[key]
@@ -450,12 +485,18 @@ class MscScript:
         else:
             return str(cmds[index])
 
+    # Looked up in a map of positions to indices, which is rebuilt when the
+    # commands have moved
     def getIndexOfInstruction(self, location):
-        for i in range(len(self.cmds)):
-            cmd = self.cmds[i]
-            if cmd.commandPosition == location:
-                return i
-        return None
+        i = self._indices.get(location)
+        if i == None or i >= len(self.cmds) or getattr(self.cmds[i], 'commandPosition', None) != location:
+            self._indices = {}
+            for i in reversed(range(len(self.cmds))):
+                position = getattr(self.cmds[i], 'commandPosition', None)
+                if position != None:
+                    self._indices[position] = i
+            i = self._indices.get(location)
+        return i
 
     def getInstructionOfIndex(self, index):
         return cmd[index].commandPosition
@@ -603,3 +644,650 @@ class MscFile:
                                 print("script_"+str(scriptNum))
                                 command.parameters.insert(0, "script_"+str(scriptNum))
                             break
+
+# Emulation of MSC bytecode, for running scripts outside of the game. Values
+# on the stack and in variables are 32 bit ints, floats are kept as their
+# bits and only turned into floats by the float commands, the same as the
+# game does.
+
+class MscVMError(Exception):
+    pass
+
+def toSigned(value):
+    value &= 0xffffffff
+    return value - 0x100000000 if value & 0x80000000 else value
+
+# The bits of f rounded to a single precision float, as a value
+def floatValue(f):
+    if f != f:
+        return toSigned(floatToBits(f))
+    if abs(f) > 3.4028234663852886e38:
+        f = math.copysign(float('inf'), f)
+    return toSigned(floatToBits(f))
+
+# A command's parameter as a value, the compiler leaves float constants as
+# floats until they're written
+def paramValue(param):
+    if type(param) == float:
+        return floatValue(param)
+    if type(param) != int:
+        raise MscVMError("Unresolved parameter %s" % str(param))
+    return toSigned(param)
+
+def _intDivide(a, b):
+    if b == 0:
+        raise MscVMError("Integer division by zero")
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+def _intModulo(a, b):
+    return a - b * _intDivide(a, b)
+
+def _floatDivide(a, b):
+    if b == 0:
+        if a == 0 or a != a:
+            return float('nan')
+        return math.copysign(float('inf'), a) * math.copysign(1.0, b)
+    return a / b
+
+def _floatToInt(f):
+    if f != f:
+        return 0
+    if abs(f) == float('inf'):
+        return 0x7fffffff if f > 0 else -0x80000000
+    return toSigned(int(f))
+
+# Commands that pop two values and push the result of an operation on them,
+# a being the one pushed first
+VM_INT_OPERATIONS = {
+    0xe  : lambda a, b: a + b,
+    0xf  : lambda a, b: a - b,
+    0x10 : lambda a, b: a * b,
+    0x11 : _intDivide,
+    0x12 : _intModulo,
+    0x16 : lambda a, b: a & b,
+    0x17 : lambda a, b: a | b,
+    0x19 : lambda a, b: a ^ b,
+    0x1a : lambda a, b: a << (b & 0x1f),
+    0x1b : lambda a, b: a >> (b & 0x1f),
+    0x25 : lambda a, b: int(a == b),
+    0x26 : lambda a, b: int(a != b),
+    0x27 : lambda a, b: int(a < b),
+    0x28 : lambda a, b: int(a <= b),
+    0x29 : lambda a, b: int(a > b),
+    0x2a : lambda a, b: int(a >= b)
+}
+VM_FLOAT_OPERATIONS = {
+    0x3a : lambda a, b: a + b,
+    0x3b : lambda a, b: a - b,
+    0x3c : lambda a, b: a * b,
+    0x3d : _floatDivide
+}
+VM_FLOAT_COMPARISONS = {
+    0x46 : lambda a, b: int(a == b),
+    0x47 : lambda a, b: int(a != b),
+    0x48 : lambda a, b: int(a < b),
+    0x49 : lambda a, b: int(a <= b),
+    0x4a : lambda a, b: int(a > b),
+    0x4b : lambda a, b: int(a >= b)
+}
+VM_UNARY_OPERATIONS = {
+    0x13 : lambda a: toSigned(-a),
+    0x18 : lambda a: toSigned(~a),
+    0x2b : lambda a: int(a == 0),
+    0x3e : lambda a: floatValue(-bitsToFloat(a))
+}
+# Assignment operators, the operation they do on the variable and what's
+# popped
+VM_ASSIGN_OPERATIONS = {
+    0x1d : 0xe, 0x1e : 0xf, 0x1f : 0x10, 0x20 : 0x11, 0x21 : 0x12, 0x22 : 0x16, 0x23 : 0x17, 0x24 : 0x19
+}
+VM_FLOAT_ASSIGN_OPERATIONS = {
+    0x42 : 0x3a, 0x43 : 0x3b, 0x44 : 0x3c, 0x45 : 0x3d
+}
+VM_RETURNS = [0x3, 0x6, 0x7, 0x8, 0x9]
+VM_VALUE_RETURNS = [0x6, 0x8]
+
+_PRINTF_FORMAT = re.compile(r'%([-+ #0]*\d*(?:\.\d+)?)[hlLqjzt]*([diouxXeEfFgGcs%])')
+
+# Fill in a printf format string with values, floats and strings (as the
+# index of one in strings) are converted back for the conversions that use
+# them
+def formatPrintf(formatString, args, strings=None):
+    args = list(args)
+    strings = strings if strings != None else []
+    def convert(match):
+        flags, conversion = match.groups()
+        if conversion == '%':
+            return '%'
+        value = args.pop(0) if len(args) > 0 else 0
+        if conversion in 'eEfFgG':
+            return ('%' + flags + conversion) % bitsToFloat(value)
+        if conversion in 'ouxX':
+            return ('%' + flags + conversion.replace('u', 'd')) % (value & 0xffffffff)
+        if conversion == 'c':
+            return chr(value & 0xff)
+        if conversion == 's':
+            return ('%' + flags + 's') % (strings[value] if 0 <= value < len(strings) else '')
+        return ('%' + flags + 'd') % toSigned(value)
+    return _PRINTF_FORMAT.sub(convert, formatString)
+
+def printfStub(vm, formatString, args):
+    print(formatPrintf(formatString, args, vm.msc.strings))
+
+def syscallStub(vm, args):
+    return 0
+
+# Executed instructions by command and how long it took, over every run of
+# a vm
+class VMStats:
+    def __init__(self):
+        self.counts = {}
+        self.seconds = 0.0
+
+    def instructions(self):
+        return sum(self.counts.values())
+
+    def add(self, other):
+        for command, count in other.counts.items():
+            self.counts[command] = self.counts.get(command, 0) + count
+        self.seconds += other.seconds
+
+    def __str__(self):
+        lines = ["%-20s %10i" % (COMMAND_NAMES.get(command, hex(command)), count)
+                 for command, count in sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))]
+        lines.append("%-20s %10i instructions in %.4fs" % ("total", self.instructions(), self.seconds))
+        return '\n'.join(lines)
+
+# Runs the scripts of an MscFile, either read from a file or from a compiler.
+# syscalls maps a syscall's number to a function taking the vm and the list
+# of arguments, whatever it returns is the syscall's value (ints and floats
+# both work). printf is given the vm, the format string and the values to
+# print. callFunc2 (set_main) saves the script it's given in mainLoop instead
+# of running it, runMainLoop runs it like the game would each frame.
+class MscVM:
+    def __init__(self, msc, syscalls=None, printf=printfStub, defaultSyscall=syscallStub, maxInstructions=None):
+        self.msc = msc
+        self.syscalls = syscalls if syscalls != None else {}
+        self.printf = printf
+        self.defaultSyscall = defaultSyscall
+        self.maxInstructions = maxInstructions
+        self.globals = {}
+        self.mainLoop = None
+        self.stats = VMStats()
+        # Labels (from the compiler) don't run, so only the commands are kept.
+        # Every command's (commands, index) by its position.
+        self.scripts = [[cmd for cmd in script.cmds if isinstance(cmd, Command)] for script in msc.scripts]
+        self.positions = {}
+        for cmds in self.scripts:
+            for i, cmd in enumerate(cmds):
+                self.positions[cmd.commandPosition] = (cmds, i)
+
+    def getEntryPoint(self):
+        if self.msc.entryPoint in self.positions:
+            return self.msc.entryPoint
+        if len(self.scripts) == 0 or len(self.scripts[0]) == 0:
+            raise MscVMError("No script to run")
+        return self.scripts[0][0].commandPosition
+
+    def getInstruction(self, position):
+        if not position in self.positions:
+            raise MscVMError("No instruction at 0x%X" % position)
+        return self.positions[position]
+
+    def getVariable(self, localVars, params):
+        if params[0] == 0:
+            return localVars[params[1]]
+        return self.globals.get(params[1], 0)
+
+    def setVariable(self, localVars, params, value):
+        if params[0] == 0:
+            localVars[params[1]] = value
+        else:
+            self.globals[params[1]] = value
+
+    def runMainLoop(self, frames=1):
+        if self.mainLoop == None:
+            raise MscVMError("No main loop set")
+        for _ in range(frames):
+            self.run(*self.mainLoop)
+
+    # Run the script at position (the entry point if None) with args, returns
+    # the value it returns or None if it doesn't return one
+    def run(self, position=None, args=None):
+        cmds, pc = self.getInstruction(position if position != None else self.getEntryPoint())
+        args = [paramValue(arg) for arg in args] if args != None else []
+        localVars = []
+        stack = []
+        # The caller's commands, where to return to, its locals, whether the
+        # return value is pushed and how big the stack was
+        frames = []
+        # Where the calls after each try return to and whether they push
+        tries = []
+        counts = {}
+        executed = 0
+        start = time.perf_counter()
+        try:
+            while True:
+                cmd = cmds[pc]
+                pc += 1
+                command = cmd.command
+                executed += 1
+                if self.maxInstructions != None and executed > self.maxInstructions:
+                    raise MscVMError("Ran more than %i instructions" % self.maxInstructions)
+                counts[command] = counts.get(command, 0) + 1
+                params = cmd.parameters
+
+                if command == 0xa or command == 0xd:
+                    if cmd.pushBit:
+                        stack.append(paramValue(params[0]) if command == 0xa else params[0] & 0xffff)
+                elif command == 0xb:
+                    if cmd.pushBit:
+                        stack.append(self.getVariable(localVars, params))
+                elif command in VM_INT_OPERATIONS:
+                    b = stack.pop()
+                    a = stack.pop()
+                    if cmd.pushBit:
+                        stack.append(toSigned(VM_INT_OPERATIONS[command](a, b)))
+                elif command in VM_FLOAT_OPERATIONS:
+                    b = bitsToFloat(stack.pop())
+                    a = bitsToFloat(stack.pop())
+                    if cmd.pushBit:
+                        stack.append(floatValue(VM_FLOAT_OPERATIONS[command](a, b)))
+                elif command in VM_FLOAT_COMPARISONS:
+                    b = bitsToFloat(stack.pop())
+                    a = bitsToFloat(stack.pop())
+                    if cmd.pushBit:
+                        stack.append(VM_FLOAT_COMPARISONS[command](a, b))
+                elif command in VM_UNARY_OPERATIONS:
+                    a = stack.pop()
+                    if cmd.pushBit:
+                        stack.append(VM_UNARY_OPERATIONS[command](a))
+                elif command == 0x1c or command == 0x41:
+                    self.setVariable(localVars, params, stack.pop())
+                elif command in VM_ASSIGN_OPERATIONS:
+                    value = VM_INT_OPERATIONS[VM_ASSIGN_OPERATIONS[command]](self.getVariable(localVars, params), stack.pop())
+                    self.setVariable(localVars, params, toSigned(value))
+                elif command in VM_FLOAT_ASSIGN_OPERATIONS:
+                    value = VM_FLOAT_OPERATIONS[VM_FLOAT_ASSIGN_OPERATIONS[command]](bitsToFloat(self.getVariable(localVars, params)),
+                                                                                      bitsToFloat(stack.pop()))
+                    self.setVariable(localVars, params, floatValue(value))
+                elif command == 0x14 or command == 0x15:
+                    self.setVariable(localVars, params, toSigned(self.getVariable(localVars, params) + (1 if command == 0x14 else -1)))
+                elif command == 0x3f or command == 0x40:
+                    value = bitsToFloat(self.getVariable(localVars, params)) + (1 if command == 0x3f else -1)
+                    self.setVariable(localVars, params, floatValue(value))
+                elif command == 0x38:
+                    stack[-1 - params[0]] = floatValue(float(stack[-1 - params[0]]))
+                elif command == 0x39:
+                    stack[-1 - params[0]] = _floatToInt(bitsToFloat(stack[-1 - params[0]]))
+                elif command in [0x4, 0x5, 0x36]:
+                    cmds, pc = self.getInstruction(params[0])
+                elif command == 0x34:
+                    if stack.pop() == 0:
+                        cmds, pc = self.getInstruction(params[0])
+                elif command == 0x35:
+                    if stack.pop() != 0:
+                        cmds, pc = self.getInstruction(params[0])
+                elif command == 0x2:
+                    argCount, varCount = params[0], params[1]
+                    localVars = (args[:argCount] + [0] * max(argCount, varCount))[:max(argCount, varCount)]
+                elif command in VM_RETURNS:
+                    value = stack.pop() if command in VM_VALUE_RETURNS else None
+                    if len(frames) == 0:
+                        return value
+                    cmds, pc, localVars, pushReturn, height = frames.pop()
+                    del stack[height:]
+                    if pushReturn:
+                        stack.append(value if value != None else 0)
+                elif command == 0x2e:
+                    tries.append((self.getInstruction(params[0])[1], cmd.pushBit))
+                elif command in [0x2f, 0x30, 0x31]:
+                    address = stack.pop()
+                    args = stack[len(stack) - params[0]:]
+                    del stack[len(stack) - params[0]:]
+                    if command == 0x30:
+                        self.mainLoop = (address, args)
+                        continue
+                    returnTo, pushReturn = tries.pop() if command == 0x2f and len(tries) > 0 else (pc, False)
+                    frames.append((cmds, returnTo, localVars, pushReturn, len(stack)))
+                    cmds, pc = self.getInstruction(address)
+                elif command == 0x2d:
+                    callArgs = stack[len(stack) - params[0]:]
+                    del stack[len(stack) - params[0]:]
+                    value = self.syscalls.get(params[1], self.defaultSyscall)(self, callArgs)
+                    if cmd.pushBit:
+                        stack.append(0 if value == None else floatValue(value) if type(value) == float else toSigned(value))
+                elif command == 0x2c:
+                    printArgs = stack[len(stack) - params[0]:]
+                    del stack[len(stack) - params[0]:]
+                    if len(printArgs) > 0:
+                        self.printf(self, self.msc.strings[printArgs[0]], printArgs[1:])
+                elif command == 0x32:
+                    stack.append(stack[-1])
+                elif command == 0x33:
+                    stack.pop()
+                elif command == 0x4d:
+                    return None
+                elif command != 0x0:
+                    raise MscVMError("Can't run %s at 0x%X" % (COMMAND_NAMES.get(command, hex(command)), cmd.commandPosition))
+        except IndexError:
+            raise MscVMError("Stack underflow or bad variable at 0x%X" % cmd.commandPosition)
+        finally:
+            stats = VMStats()
+            stats.counts = counts
+            stats.seconds = time.perf_counter() - start
+            self.stats.add(stats)
+
+# The same as MscVM, except every command is decoded once up front into a
+# function that does what it does and returns the index of the command to
+# run next, so running is just calling them one after another. Jumps are
+# resolved to indices when decoding, only calls through a function's
+# address are looked up while running. Unlike MscVM, run can't be called
+# again from inside a syscall or printf.
+class ThreadedMscVM(MscVM):
+    def __init__(self, msc, **kwargs):
+        MscVM.__init__(self, msc, **kwargs)
+        self.stack = []
+        # (index to return to, caller's locals, whether the return value is
+        # pushed, stack size) for each call being run
+        self.frames = []
+        self.tries = []
+        # The running script's locals and the arguments for the next begin
+        self.registers = [[], []]
+        self.result = None
+        self.commands = [cmd for cmds in self.scripts for cmd in cmds]
+        self.indices = dict((cmd.commandPosition, i) for i, cmd in reversed(list(enumerate(self.commands))))
+        self.code = [self.decode(cmd, i + 1) for i, cmd in enumerate(self.commands)]
+
+    def getIndex(self, position):
+        if not position in self.indices:
+            raise MscVMError("No instruction at 0x%X" % position)
+        return self.indices[position]
+
+    # Commands that can't run decode to this, so the error only happens if
+    # they're reached
+    def decode(self, cmd, nextIndex):
+        try:
+            return self.decodeCommand(cmd, nextIndex)
+        except MscVMError as e:
+            error = e
+            def fail():
+                raise error
+            return fail
+
+    # Functions that get and set the variable params refers to
+    def decodeVariable(self, params):
+        scope, index = params[0], params[1]
+        registers = self.registers
+        globalVars = self.globals
+        if scope == 0:
+            def load():
+                return registers[0][index]
+            def store(value):
+                registers[0][index] = value
+        else:
+            def load():
+                return globalVars.get(index, 0)
+            def store(value):
+                globalVars[index] = value
+        return load, store
+
+    def decodeCommand(self, cmd, nextIndex):
+        command = cmd.command
+        params = cmd.parameters
+        pushBit = cmd.pushBit
+        stack = self.stack
+        push = stack.append
+        pop = stack.pop
+        registers = self.registers
+        frames = self.frames
+        tries = self.tries
+        vm = self
+
+        def skip():
+            return nextIndex
+
+        if command == 0xa or command == 0xd:
+            value = paramValue(params[0]) if command == 0xa else params[0] & 0xffff
+            if not pushBit:
+                return skip
+            def pushConstant():
+                push(value)
+                return nextIndex
+            return pushConstant
+        elif command == 0xb:
+            if not pushBit:
+                return skip
+            if params[0] == 0:
+                index = params[1]
+                def pushLocal():
+                    push(registers[0][index])
+                    return nextIndex
+                return pushLocal
+            load = self.decodeVariable(params)[0]
+            def pushVariable():
+                push(load())
+                return nextIndex
+            return pushVariable
+        elif command == 0x1c or command == 0x41:
+            if params[0] == 0:
+                index = params[1]
+                def setLocal():
+                    registers[0][index] = pop()
+                    return nextIndex
+                return setLocal
+            store = self.decodeVariable(params)[1]
+            def setVariable():
+                store(pop())
+                return nextIndex
+            return setVariable
+        elif command in VM_INT_OPERATIONS:
+            operation = VM_INT_OPERATIONS[command]
+            if not pushBit:
+                def discardOperands():
+                    pop()
+                    pop()
+                    return nextIndex
+                return discardOperands
+            def intOperation():
+                b = pop()
+                stack[-1] = toSigned(operation(stack[-1], b))
+                return nextIndex
+            return intOperation
+        elif command in VM_FLOAT_OPERATIONS or command in VM_FLOAT_COMPARISONS:
+            if command in VM_FLOAT_OPERATIONS:
+                floatOperation = VM_FLOAT_OPERATIONS[command]
+                operation = lambda a, b: floatValue(floatOperation(a, b))
+            else:
+                operation = VM_FLOAT_COMPARISONS[command]
+            def floatBinaryOperation():
+                b = bitsToFloat(pop())
+                a = bitsToFloat(pop())
+                if pushBit:
+                    push(operation(a, b))
+                return nextIndex
+            return floatBinaryOperation
+        elif command in VM_UNARY_OPERATIONS:
+            operation = VM_UNARY_OPERATIONS[command]
+            def unaryOperation():
+                a = pop()
+                if pushBit:
+                    push(operation(a))
+                return nextIndex
+            return unaryOperation
+        elif command in VM_ASSIGN_OPERATIONS or command in VM_FLOAT_ASSIGN_OPERATIONS:
+            load, store = self.decodeVariable(params)
+            if command in VM_ASSIGN_OPERATIONS:
+                intOperation = VM_INT_OPERATIONS[VM_ASSIGN_OPERATIONS[command]]
+                operation = lambda a, b: toSigned(intOperation(a, b))
+            else:
+                floatOperation = VM_FLOAT_OPERATIONS[VM_FLOAT_ASSIGN_OPERATIONS[command]]
+                operation = lambda a, b: floatValue(floatOperation(bitsToFloat(a), bitsToFloat(b)))
+            def assignOperation():
+                store(operation(load(), pop()))
+                return nextIndex
+            return assignOperation
+        elif command in [0x14, 0x15, 0x3f, 0x40]:
+            step = 1 if command in [0x14, 0x3f] else -1
+            if command in [0x3f, 0x40]:
+                load, store = self.decodeVariable(params)
+                def floatStep():
+                    store(floatValue(bitsToFloat(load()) + step))
+                    return nextIndex
+                return floatStep
+            if params[0] == 0:
+                index = params[1]
+                def stepLocal():
+                    localVars = registers[0]
+                    localVars[index] = toSigned(localVars[index] + step)
+                    return nextIndex
+                return stepLocal
+            load, store = self.decodeVariable(params)
+            def stepVariable():
+                store(toSigned(load() + step))
+                return nextIndex
+            return stepVariable
+        elif command == 0x38 or command == 0x39:
+            index = -1 - params[0]
+            convert = (lambda value: floatValue(float(value))) if command == 0x38 else (lambda value: _floatToInt(bitsToFloat(value)))
+            def cast():
+                stack[index] = convert(stack[index])
+                return nextIndex
+            return cast
+        elif command in [0x4, 0x5, 0x36]:
+            target = self.getIndex(params[0])
+            def jump():
+                return target
+            return jump
+        elif command == 0x34:
+            target = self.getIndex(params[0])
+            def branchIfFalse():
+                return target if pop() == 0 else nextIndex
+            return branchIfFalse
+        elif command == 0x35:
+            target = self.getIndex(params[0])
+            def branchIfTrue():
+                return nextIndex if pop() == 0 else target
+            return branchIfTrue
+        elif command == 0x2:
+            argCount = params[0]
+            size = max(params[0], params[1])
+            def begin():
+                registers[0] = (registers[1][:argCount] + [0] * size)[:size]
+                return nextIndex
+            return begin
+        elif command in VM_RETURNS:
+            returnsValue = command in VM_VALUE_RETURNS
+            def scriptReturn():
+                value = pop() if returnsValue else None
+                if len(frames) == 0:
+                    vm.result = value
+                    return -1
+                returnTo, registers[0], pushReturn, height = frames.pop()
+                del stack[height:]
+                if pushReturn:
+                    push(value if value != None else 0)
+                return returnTo
+            return scriptReturn
+        elif command == 0x2e:
+            target = self.getIndex(params[0])
+            def tryCall():
+                tries.append((target, pushBit))
+                return nextIndex
+            return tryCall
+        elif command in [0x2f, 0x30, 0x31]:
+            argCount = params[0]
+            indices = self.indices
+            def call():
+                address = pop()
+                args = stack[len(stack) - argCount:]
+                del stack[len(stack) - argCount:]
+                if command == 0x30:
+                    vm.mainLoop = (address, args)
+                    return nextIndex
+                if not address in indices:
+                    raise MscVMError("No instruction at 0x%X" % address)
+                returnTo, pushReturn = tries.pop() if command == 0x2f and len(tries) > 0 else (nextIndex, False)
+                frames.append((returnTo, registers[0], pushReturn, len(stack)))
+                registers[1] = args
+                return indices[address]
+            return call
+        elif command == 0x2d:
+            argCount, syscall = params[0], params[1]
+            def callSyscall():
+                args = stack[len(stack) - argCount:]
+                del stack[len(stack) - argCount:]
+                value = vm.syscalls.get(syscall, vm.defaultSyscall)(vm, args)
+                if pushBit:
+                    push(0 if value == None else floatValue(value) if type(value) == float else toSigned(value))
+                return nextIndex
+            return callSyscall
+        elif command == 0x2c:
+            argCount = params[0]
+            def printf():
+                args = stack[len(stack) - argCount:]
+                del stack[len(stack) - argCount:]
+                if len(args) > 0:
+                    vm.printf(vm, vm.msc.strings[args[0]], args[1:])
+                return nextIndex
+            return printf
+        elif command == 0x32:
+            def duplicate():
+                push(stack[-1])
+                return nextIndex
+            return duplicate
+        elif command == 0x33:
+            def discard():
+                pop()
+                return nextIndex
+            return discard
+        elif command == 0x4d:
+            def exit():
+                vm.result = None
+                return -1
+            return exit
+        elif command == 0x0:
+            return skip
+        raise MscVMError("Can't run %s at 0x%X" % (COMMAND_NAMES.get(command, hex(command)), cmd.commandPosition))
+
+    def run(self, position=None, args=None):
+        pc = self.getIndex(position if position != None else self.getEntryPoint())
+        del self.stack[:]
+        del self.frames[:]
+        del self.tries[:]
+        self.registers[0] = []
+        self.registers[1] = [paramValue(arg) for arg in args] if args != None else []
+        self.result = None
+        code = self.code
+        # Times each command ran, turned into counts by command at the end
+        hits = [0] * len(code)
+        limit = self.maxInstructions
+        start = time.perf_counter()
+        try:
+            if limit == None:
+                while pc >= 0:
+                    hits[pc] += 1
+                    pc = code[pc]()
+            else:
+                executed = 0
+                while pc >= 0:
+                    executed += 1
+                    if executed > limit:
+                        raise MscVMError("Ran more than %i instructions" % limit)
+                    hits[pc] += 1
+                    pc = code[pc]()
+        except IndexError:
+            # pc is still the command that failed, unless the last command
+            # went on past the end of the code
+            cmd = self.commands[min(pc, len(self.commands) - 1)]
+            raise MscVMError("Stack underflow or bad variable at 0x%X" % cmd.commandPosition)
+        finally:
+            stats = VMStats()
+            stats.seconds = time.perf_counter() - start
+            for i, count in enumerate(hits):
+                if count > 0:
+                    command = self.commands[i].command
+                    stats.counts[command] = stats.counts.get(command, 0) + count
+            self.stats.add(stats)
+        return self.result
@@ -2,6 +2,7 @@ from msc import *
 from argparse import ArgumentParser
 # Try and install pycparser if it's not found 
 try:
+    import pycparser
     from pycparser import c_parser, c_ast, parse_file
 except ImportError:
     if input("Pycparser not found, install with pip? (y/n)").startswith('y'):
@@ -17,11 +18,33 @@ except ImportError:
     else:
         quit()
 import re
+import sys
 import math
+import time
 import struct
+import hashlib
+import tempfile
+import threading
+import importlib.util
 from subprocess import Popen, PIPE
+from concurrent.futures import ProcessPoolExecutor
 import os.path
 from xml_info import MscXmlInfo, VariableLabel, getXmlInfoPath
+import server
+from ast_cache import AstCache, FragmentCache
+import peephole
+import folding
+import strength_reduction
+import liveness
+import inlining
+import dead_code
+import tail_calls
+import profiling
+import cost_analysis
+import ir
+import msc
+import preprocessor
+from preprocessor import Preprocessor, PreprocessorError, PreprocessorCache, removeComments, preprocessWithCache
 
 # Add to this as you see reasonable
 global_constants = {
@@ -130,24 +153,66 @@ class CompilerError(Exception):
     def __init__(self,*args,**kwargs):
         Exception.__init__(self,*args,**kwargs)
 
-class PreprocessorError(Exception):
-    def __init__(self,*args,**kwargs):
-        Exception.__init__(self,*args,**kwargs)
-
 class FileRefs:
-    def __init__(self, functions=[], globalVariables=[], globalVariableTypes={},functionTypes={}):
-        self.functions = functions
-        self.globalVariables = globalVariables
-        self.globalVariableTypes = globalVariableTypes
-        self.functionTypes = functionTypes
-
-def removeComments(text):
-    text = re.sub(
-       '(?:\\/\\*(?=(?:[^"]*"[^"]*")*[^"]*$)(?:.|\\n)*?\\*\\/)|(?:\\/\\/(?=(?:[^"]*"[^"]*")*[^"]*$).*)', 
-       '',
-       text
-    )
-    return text
+    def __init__(self, functions=None, globalVariables=None, globalVariableTypes=None, functionTypes=None):
+        # Don't use mutable default arguments, every compile needs its own refs
+        self.functions = functions if functions != None else []
+        self.globalVariables = globalVariables if globalVariables != None else []
+        self.globalVariableTypes = globalVariableTypes if globalVariableTypes != None else {}
+        self.functionTypes = functionTypes if functionTypes != None else {}
+        self.scriptPositions = []
+
+# Directory used for anything msclang caches between runs, can be
+# overridden with the MSCLANG_CACHE_DIR environment variable
+def getCacheDir(*subdirs):
+    base = os.environ.get('MSCLANG_CACHE_DIR')
+    if base == None:
+        if sys.platform.startswith('win') and os.getenv('LOCALAPPDATA') != None:
+            base = os.path.join(os.getenv('LOCALAPPDATA'), 'msclang', 'cache')
+        else:
+            base = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'msclang')
+    path = os.path.join(base, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# Hash of the compiler's own source, anything cached between runs that
+# depends on how the compiler behaves is keyed on this
+_compilerVersion = None
+COMPILER_SOURCES = [__file__, msc.__file__, preprocessor.__file__, peephole.__file__, folding.__file__,
+                    strength_reduction.__file__, liveness.__file__, inlining.__file__, dead_code.__file__,
+                    tail_calls.__file__, profiling.__file__, ir.__file__]
+
+def getCompilerVersion():
+    global _compilerVersion
+    if _compilerVersion == None:
+        h = hashlib.sha256()
+        for source in COMPILER_SOURCES:
+            with open(os.path.abspath(source), 'rb') as f:
+                h.update(f.read())
+        _compilerVersion = h.hexdigest()
+    return _compilerVersion
+
+# Parsers are expensive to build (older pycparser versions generate their
+# lex/yacc tables if the bundled ones are missing) but aren't thread safe,
+# so each thread lazily builds one and keeps it for every later compile
+_parsers = threading.local()
+
+def getParser():
+    parser = getattr(_parsers, 'parser', None)
+    if parser == None:
+        if not hasattr(c_parser, 'yacc') or importlib.util.find_spec('pycparser.yacctab') != None:
+            # Newer pycparser versions don't use yacc, and the tables bundled
+            # with older versions can be used as is
+            parser = c_parser.CParser()
+        else:
+            # Generate the tables once into the cache directory and import
+            # them from there on every run afterwards
+            tableDir = getCacheDir('tables')
+            if not tableDir in sys.path:
+                sys.path.append(tableDir)
+            parser = c_parser.CParser(lextab='msclang_lextab', yacctab='msclang_yacctab', taboutputdir=tableDir)
+        _parsers.parser = parser
+    return parser
 
 # Define a bunch of dictionaries to help resolve text to commands
 assignmentOperationsInt = {
@@ -224,6 +289,13 @@ operationOpposite = {
 }
 
 floatOperations = list(range(0x3a,0x46)) + [0x38]
+SWITCH_STRATEGIES = ["tree", "linear"]
+# The tree switch strategy tests this many ranges or fewer one by one
+SWITCH_TREE_LEAF_SIZE = 3
+# Functions with up to this many AST nodes are inlined
+INLINE_THRESHOLD = 12
+# How much bigger a function can be and still be inlined if it's hot
+PROFILE_HOT_INLINE_FACTOR = 4
 FLOAT_RETURN_SYSCALLS = [0x08, 0x0a, 0x0f, 0x11, 0x13, 0x15, 0x17, 0x1b, 0x25, 0x28, 0x2b, 0x2c, 0x2f, 0x32, 0x34, 0x35, 0x3d, 0x3f, 0x40, 0x45]
 
 class Label:
@@ -236,6 +308,40 @@ class Label:
         else:
             return "Label "+hex(id(self))+":"
 
+# Mark the last command of cmds as pushing its result. Casts don't push on
+# their own, and for a function call it's the try before it that pushes the
+# return value.
+def pushLastCommand(cmds):
+    if len(cmds) > 0:
+        i = 1
+        while i <= len(cmds):
+            if type(cmds[-i]) == Command and not cmds[-i].command in range(0x2f,0x32) and not cmds[-i].command in range(0x38,0x3a):
+                cmds[-i].pushBit = True
+                return
+            elif type(cmds[-i]) == Command and not cmds[-i].command in range(0x38,0x3a):
+                while i <= len(cmds):
+                    if type(cmds[-i]) == Command and cmds[-i].command == 0x2e:
+                        cmds[-i].pushBit = True
+                        return
+                    i += 1
+            i += 1
+
+# Sort the (value, label) cases of a switch into (low, high, label) ranges,
+# consecutive values that go to the same label share a range
+def getSwitchRanges(cases):
+    ranges = []
+    for value, label in sorted(cases, key=lambda case: case[0]):
+        if len(ranges) > 0 and ranges[-1][1] + 1 == value and ranges[-1][2] is label:
+            ranges[-1] = (ranges[-1][0], value, label)
+        else:
+            ranges.append((value, value, label))
+    return ranges
+
+def alignTo(value, alignment):
+    if value % alignment != 0:
+        value += alignment - (value % alignment)
+    return value
+
 # This is to get around the fact python will throw an exception on
 # int('0900', 0) but not int('0900'). Sucks but whatever...
 def toInt(i):
@@ -244,20 +350,21 @@ def toInt(i):
     except:
         return int(i)
 
-#Returns variable scope, type and index in a tuple
-def resolveVariable(name):
-    global refs, localVars, localVarTypes
-    if name in localVars:
-        varScope = 0
-        varType = localVarTypes[name]
-        varIndex = localVars.index(name)
-    elif name in refs.globalVariables:
-        varScope = 1
-        varType = refs.globalVariableTypes[name]
-        varIndex = refs.globalVariables.index(name)
-    else:
-        raise CompilerError("Invalid reference")
-    return (varScope,varType,varIndex)
+# Text that only depends on the structure and values of an AST node and its
+# children (not on coords), so moving a function around in a file doesn't
+# change it
+def getNodeFingerprint(node):
+    out = []
+    def visit(node):
+        out.append(type(node).__name__)
+        for attr in node.attr_names:
+            out.append(repr(getattr(node, attr)))
+        out.append('(')
+        for _, child in node.children():
+            visit(child)
+        out.append(')')
+    visit(node)
+    return ' '.join(out)
 
 _C_ESCAPES = {
     "\\" : "\\",
@@ -301,643 +408,1664 @@ def apply_c_escapes(string):
         n += 1
     return new_string
 
-# Guess if a command returns a float or an int
-def isCommandFloat(cmd, lookingFor):
-    global refs, localVars, localVarTypes
-    if cmd.command == 0x2d and cmd.parameters[1] in FLOAT_RETURN_SYSCALLS:
+# Thanks Triptych https://stackoverflow.com/questions/1265665/python-check-if-a-string-represents-an-int-without-using-try-except
+def _RepresentsInt(s):
+    try:
+        int(s, 0)
         return True
-    if cmd.command == 0x2d:
-        return lookingFor
-    if cmd.command == 0x2f:
-        if cmd.functionName in refs.functions:
-            return (refs.functionTypes[cmd.functionName] == "float")
-    if cmd.command in floatOperations or (cmd.command == 0xA and type(cmd.parameters[0]) == float):
+    except:
+        return False
+
+def _RepresentsFloat(s):
+    try:
+        float(s.rstrip('f'))
         return True
-    if cmd.command == 0xb:
-        if cmd.parameters[0] == 0 and localVarTypes[localVars[cmd.parameters[1]]] == "float":
+    except:
+        return False
+
+class Compiler:
+    # peepholeRules defaults to peephole.DEFAULT_RULES and irPasses to
+    # ir.DEFAULT_PASSES, pass [] to disable them
+    def __init__(self, xmlInfo=None, autocast=False, usePushShort=True, astCache=None, fragmentCache=None, peepholeRules=None,
+                 foldConstants=True, reduceStrength=True, branchConditions=True, switchStrategy="tree",
+                 shareSlots=True, inlineThreshold=INLINE_THRESHOLD, removeUnused=True,
+                 tailCalls=True, profileGenerate=False, profile=None, costTable=None, irPasses=None):
+        # The xml info is only read, so a single MscXmlInfo can be shared
+        # between any number of compilers
+        self.xmlInfo = xmlInfo if xmlInfo != None else MscXmlInfo()
+        self.autocast = autocast
+        self.usePushShort = usePushShort
+        self.astCache = astCache
+        # Probes are numbered across the whole file, so functions compiled
+        # with them can't be reused
+        self.fragmentCache = fragmentCache if not profileGenerate else None
+        self.peepholeRules = peepholeRules if peepholeRules != None else peephole.DEFAULT_RULES
+        self.irPasses = irPasses if irPasses != None else ir.DEFAULT_PASSES
+        self.foldConstants = foldConstants
+        self.reduceStrength = reduceStrength
+        self.branchConditions = branchConditions
+        self.switchStrategy = switchStrategy
+        self.shareSlots = shareSlots
+        self.inlineThreshold = inlineThreshold
+        self.removeUnused = removeUnused
+        self.tailCalls = tailCalls
+        # Whether to put profiling probes in the code and the profiling.Profile
+        # to optimize with
+        self.profileGenerate = profileGenerate
+        self.profile = profile
+        # Costs of each command to analyze the output with, None to skip it
+        self.costTable = costTable
+        self.syscalls = dict(syscalls)
+        for s in self.xmlInfo.syscalls:
+            self.syscalls[s.name] = s.id
+        self.msc = None
+        self.refs = None
+        # Name and type of each local slot, and the slot each name in scope
+        # refers to from the outermost block in
+        self.localVars = []
+        self.localVarTypes = []
+        self.scopes = []
+        self.scriptStrings = []
+        # The functions of the file being compiled by name, the ones that
+        # can be inlined and their bodies ready to compile
+        self.functionDefs = {}
+        self.inlineFunctions = set()
+        self.inlineBodies = {}
+        self.statementExpressions = set()
+        # Self tail calls of the function being compiled, the label they jump
+        # back to and the locals that have to be reset when they do
+        self.selfTailCalls = set()
+        self.functionStart = None
+        self.uninitializedLocals = []
+        # What each probe of the last compile counts, the (name, fingerprint)
+        # the function being compiled has in profiles, its ifs and switches
+        # by position and its counts from the profile being used
+        self.profileProbes = []
+        self.profileFunction = None
+        self.profileSites = {}
+        self.functionProfile = None
+        # How long each phase of the last compile took, in seconds
+        self.timings = {}
+        # What the optimizations did in the last compile
+        self.peepholeStats = peephole.PeepholeStats()
+        self.irStats = ir.IRStats()
+        self.foldStats = folding.FoldStats()
+        self.inlineStats = inlining.InlineStats()
+        self.relaxedBytes = 0
+        # The cost_analysis.ScriptCost of each script of the last compile
+        self.costAnalysis = []
+
+    #Returns variable scope, type and index in a tuple
+    def resolveVariable(self, name):
+        scope = next((scope for scope in reversed(self.scopes) if name in scope), None)
+        if scope != None:
+            varScope = 0
+            varIndex = scope[name]
+            varType = self.localVarTypes[varIndex]
+        elif name in self.refs.globalVariables:
+            varScope = 1
+            varType = self.refs.globalVariableTypes[name]
+            varIndex = self.refs.globalVariables.index(name)
+        else:
+            raise CompilerError("Invalid reference")
+        return (varScope,varType,varIndex)
+
+    # Guess if a command returns a float or an int
+    def isCommandFloat(self, cmd, lookingFor):
+        if cmd.command == 0x2d and cmd.parameters[1] in FLOAT_RETURN_SYSCALLS:
             return True
-        if cmd.parameters[0] == 1 and refs.globalVariableTypes[refs.globalVariables[cmd.parameters[1]]] == "float":
+        if cmd.command == 0x2d:
+            return lookingFor
+        if cmd.command == 0x2f:
+            if cmd.functionName in self.refs.functions:
+                return (self.refs.functionTypes[cmd.functionName] == "float")
+        if cmd.command in floatOperations or (cmd.command == 0xA and type(cmd.parameters[0]) == float):
             return True
-    return False
+        if cmd.command == 0xb:
+            if cmd.parameters[0] == 0 and self.localVarTypes[cmd.parameters[1]] == "float":
+                return True
+            if cmd.parameters[0] == 1 and self.refs.globalVariableTypes[self.refs.globalVariables[cmd.parameters[1]]] == "float":
+                return True
+        return False
 
-# Take a abstract syntax tree node and recursively compile it
-def compileNode(node, loopParent=None, parentLoopCondition=None):
-    global refs, localVars, localVarTypes, args, xmlInfo
+    # Take a abstract syntax tree node and recursively compile it
+    # Compile node as a condition that jumps to target if it's true (jumpIf)
+    # or false and falls through otherwise. && and || jump straight to where
+    # they end up instead of pushing a 0 or 1 and testing that again.
+    def compileCondition(self, node, target, jumpIf, loopParent=None, parentLoopCondition=None):
+        nodeOut = []
+        if type(node) == c_ast.BinaryOp and node.op in ["&&", "||"]:
+            # && jumps as soon as a side is false, || as soon as a side is true
+            shortCircuit = node.op == "||"
+            if jumpIf == shortCircuit:
+                nodeOut += self.compileCondition(node.left, target, jumpIf, loopParent, parentLoopCondition)
+                nodeOut += self.compileCondition(node.right, target, jumpIf, loopParent, parentLoopCondition)
+            else:
+                skipLabel = Label()
+                nodeOut += self.compileCondition(node.left, skipLabel, shortCircuit, loopParent, parentLoopCondition)
+                nodeOut += self.compileCondition(node.right, target, jumpIf, loopParent, parentLoopCondition)
+                nodeOut.append(skipLabel)
+        elif type(node) == c_ast.UnaryOp and node.op == "!":
+            nodeOut += self.compileCondition(node.expr, target, not jumpIf, loopParent, parentLoopCondition)
+        elif type(node) == c_ast.Constant and node.type == "int":
+            if (toInt(node.value) != 0) == jumpIf:
+                nodeOut.append(Command(0x4, [target]))
+        else:
+            nodeOut += self.compileNode(node, loopParent, parentLoopCondition)
+            pushLastCommand(nodeOut)
+            nodeOut.append(Command(0x35 if jumpIf else 0x34, [target]))
+        return nodeOut
+
+    # The int a case label has to be, folded the same way as constants in
+    # expressions even if folding is turned off
+    def getCaseValue(self, expr):
+        folder = folding.ConstantFolder(global_constants, set(self.localVars) | set(self.refs.globalVariables), self.autocast)
+        value = folder.getValue(folder.fold(expr))
+        if value == None or value[0] != "int":
+            raise CompilerError("Error at %s: Case values must be integer constants"%str(expr.coord))
+        return value[1]
 
-    nodeOut = []
+    # Jump to the label of whichever of the (low, high, label) ranges holds the
+    # value of variable, or to defaultLabel if none of them do. valueCounts
+    # is how often each value was seen when profiling, if it's known.
+    def compileSwitchDispatch(self, variable, ranges, defaultLabel, valueCounts=None):
+        if valueCounts != None and sum(valueCounts.values()) > 0:
+            return self.compileProfiledSwitch(variable, ranges, defaultLabel, valueCounts)
+        if self.switchStrategy == "linear":
+            return self.compileSwitchTests(variable, ranges, defaultLabel)
+        return self.compileSwitchTree(variable, ranges, defaultLabel)
 
-    if isinstance(node, list):
-        for i in node:
-            nodeOut += compileNode(i, loopParent, parentLoopCondition)
+    # Switches that would test their cases one by one anyway test each case
+    # right before its statements instead, unless they were profiled or a
+    # case comes after the default
+    def canTestCasesInline(self, ranges, body, defaultLabel, valueCounts):
+        if valueCounts != None and sum(valueCounts.values()) > 0:
+            return False
+        if self.switchStrategy != "linear" and len(ranges) > SWITCH_TREE_LEAF_SIZE:
+            return False
+        caseLabels = [label for low, high, label in ranges]
+        return defaultLabel == None or not any(cmd in caseLabels and not cmd is defaultLabel
+                                                for cmd in body[body.index(defaultLabel) + 1:])
+
+    # Lay the switch out like a chain of ifs: each case's tests skip over its
+    # statements when the value doesn't match, so a value that matches no
+    # case ends up at the default (or the end) without a jump. Statements
+    # falling through into the next case jump over its tests.
+    def compileInlineSwitch(self, variable, ranges, body, defaultLabel):
+        nodeOut = []
+        skip = None
+        for cmd in body:
+            labelRanges = [(low, high) for low, high, label in ranges if label is cmd]
+            if cmd is defaultLabel and skip != None:
+                nodeOut.append(skip)
+                skip = None
+            if len(labelRanges) == 0 or cmd is defaultLabel:
+                nodeOut.append(cmd)
+                continue
+            last = nodeOut[-1] if len(nodeOut) > 0 else None
+            if last != None and not (type(last) == Command and last.command in peephole.TERMINATORS + [0x8, 0x9]):
+                nodeOut.append(Command(0x4, [cmd]))
+            if skip != None:
+                nodeOut.append(skip)
+            skip = Label()
+            # Without the jump to the default at the end
+            nodeOut += self.compileSwitchTests(variable, [(low, high, cmd) for low, high in labelRanges[:-1]], skip)[:-1]
+            low, high = labelRanges[-1]
+            if low == high:
+                nodeOut += self.compileSwitchCompare(variable, low, 0x25, skip, False)
+            else:
+                nodeOut += self.compileSwitchCompare(variable, low, 0x27, skip)
+                nodeOut += self.compileSwitchCompare(variable, high, 0x29, skip)
+            nodeOut.append(cmd)
+        if skip != None:
+            nodeOut.append(skip)
         return nodeOut
-    elif not isinstance(node, c_ast.Node):
-        raise ValueError("That's no node that's a "+str(type(node)))
-
-    # Macro for getting the last command (skip any labels)
-    def getLastCommand():
-        if len(nodeOut) > 0:
-            i = 1
-            while i <= len(nodeOut):
-                if type(nodeOut[-i]) == Command:
-                    return nodeOut[-i]
-                i += 1
-
-    # Macro for marking the last command as an argument for the current command
-    def addArg():
-        if len(nodeOut) > 0:
-            i = 1
-            while i <= len(nodeOut):
-                if type(nodeOut[-i]) == Command and not nodeOut[-i].command in range(0x2f,0x32) and not nodeOut[-i].command in range(0x38,0x3a):
-                    nodeOut[-i].pushBit = True
-                    return
-                elif type(nodeOut[-i]) == Command and not nodeOut[-i].command in range(0x38,0x3a):
-                    while i <= len(nodeOut):
-                        if type(nodeOut[-i]) == Command and nodeOut[-i].command == 0x2e:
-                            nodeOut[-i].pushBit = True
-                            return
-                        i += 1
-                i += 1
-
-    t = type(node)
-
-    # Check the type, depending on which type it is compile as it should
-    # If an argument needs to be compiled, recursively call compile on the node
-
-    # How to read the following code:
-    # 1. read as if t is NodeType
-    # 2. addArgs() = the last compiled command should be pushed to the stack
-    # 3. being appended to nodeOut is adding it to the compiled version of the node
-    # 4. Command(n, l) is defining a comamnd of id n with a list of args l
-    #    the definition for Command is in msc.py, a dictionary of command name to id
-    #    is also available in msc.py called "COMMAND_IDS" near the top
-    if t == c_ast.Decl:
-        if not node.name in localVars:
-            localVarNum = len(localVars)
-            localVars.append(node.name)
-            localVarTypes[node.name] = node.type.type.names[-1]
-        else:
-            localVarNum = localVars.index(node.name)
-        if node.init != None:
-            nodeOut += compileNode(node.init, loopParent, parentLoopCondition)
-            addArg()
-            if node.type.type.names[-1] == "float" and not isCommandFloat(getLastCommand(), True):
-                nodeOut.append(Command(0x38, [0]))
-            elif node.type.type.names[-1] != "float" and isCommandFloat(getLastCommand(), False):
-                nodeOut.append(Command(0x39, [0]))
-            nodeOut.append(Command(0x1C, [0, localVarNum]))
-    elif t == c_ast.Constant:
-        if node.type == "int" or node.type == "bool":
-            newValue = toInt(node.value) & 0xFFFFFFFF
-            nodeOut.append(Command(0xD if newValue <= 0xFFFF and args.usePushShort else 0xA, [newValue]))
-        elif node.type == "float" or node.type == "double":
-            nodeOut.append(Command(0xA, [float(node.value.rstrip('f'))]))
-        elif node.type == "string":
-            string = apply_c_escapes(node.value[1:-1])
-            if not string in msc.strings:
-                msc.strings.append(string)
-            nodeOut.append(Command(0xD, [msc.strings.index(string)]))
-    elif t == c_ast.Assignment:
-        nodeOut += compileNode(node.rvalue, loopParent, parentLoopCondition)
-        addArg()
-        if type(node.lvalue) != c_ast.ID:
-            raise CompilerError("Error at %s: Left hand side of assignment operation must be variable."%str(node.coord))
-        try:
-            varScope,varType,varIndex = resolveVariable(node.lvalue.name)
-        except CompilerError:
-            raise CompilerError("Error at %s: Left hand side of assignment operation must be a valid reference to a variable."%str(node.coord))
 
-        if args.autocast:
-            if varType == "float" and not isCommandFloat(getLastCommand(), True):
-                    nodeOut.append(Command(0x38, [0]))
-            elif varType != "float" and isCommandFloat(getLastCommand(), False):
-                    nodeOut.append(Command(0x39, [0]))
+    # Test the ranges that were hit the most first, one by one, then dispatch
+    # to the rest as usual. As many are tested first as makes the dispatch
+    # take the fewest instructions for the profiled values.
+    def compileProfiledSwitch(self, variable, ranges, defaultLabel, valueCounts):
+        hits = [sum(count for value, count in valueCounts.items() if low <= value <= high) for low, high, label in ranges]
+        order = sorted(range(len(ranges)), key=lambda i: -hits[i])
+        best = None
+        for peeled in range(len(ranges) + 1):
+            nodeOut = []
+            if peeled > 0:
+                # Without the jump to the default at the end
+                nodeOut = self.compileSwitchTests(variable, [ranges[i] for i in order[:peeled]], defaultLabel)[:-1]
+            nodeOut += self.compileSwitchDispatch(variable, [ranges[i] for i in sorted(order[peeled:])], defaultLabel)
+            cost = profiling.getDispatchCost(nodeOut, valueCounts)
+            if best == None or cost < best[0]:
+                best = (cost, nodeOut)
+            if peeled < len(ranges) and hits[order[peeled]] == 0:
+                break
+        return best[1]
 
-        if varType == "float":
-            operation = assignmentOperationsFloat[node.op]
-        else:
-            operation = assignmentOperationsInt[node.op]
-        nodeOut.append(Command(operation,[varScope,varIndex]))
-    elif t == c_ast.TernaryOp:
-        if (type(node.iftrue) == c_ast.TernaryOp and type(node.iffalse) == c_ast.Constant and
-            node.iffalse.type == "int" and int(node.iffalse.value, 0) == 0 and
-            type(node.iftrue.iftrue) == c_ast.Constant and node.iftrue.iftrue.type == "int" and
-            int(node.iftrue.iftrue.value, 0) == 1 and type(node.iftrue.iffalse) == c_ast.Constant and
-            node.iftrue.iffalse.type == "int" and int(node.iftrue.iffalse.value, 0) == 0):
-            # If tail end ternary combination is possible
-            endLabel = Label()
-            isFalseLabel = Label()
-            nodeOut += compileNode(node.cond, loopParent, parentLoopCondition)
-            addArg()
-            nodeOut.append(Command(0x34, [isFalseLabel]))
-            nodeOut += compileNode(node.iftrue.cond, loopParent, parentLoopCondition)
-            addArg()
-            nodeOut.append(Command(0x34, [isFalseLabel]))
-            nodeOut.append(Command(0xD if args.usePushShort else 0xA, [1], True))
-            nodeOut.append(Command(0x36, [endLabel]))
-            nodeOut.append(isFalseLabel)
-            nodeOut.append(Command(0xD if args.usePushShort else 0xA, [0], True))
-            nodeOut.append(endLabel)
-        else:
-            endLabel = Label()
-            isFalseLabel = Label()
-            nodeOut += compileNode(node.cond, loopParent, parentLoopCondition)
-            addArg()
-            nodeOut.append(Command(0x34, [isFalseLabel]))
-            nodeOut += compileNode(node.iftrue, loopParent, parentLoopCondition)
-            addArg()
-            nodeOut.append(Command(0x36, [endLabel]))
-            nodeOut.append(isFalseLabel)
-            nodeOut += compileNode(node.iffalse, loopParent, parentLoopCondition)
-            addArg()
-            nodeOut.append(endLabel)
-    elif t == c_ast.UnaryOp:
-        if node.op == "!":
-            nodeOut += compileNode(node.expr, loopParent, parentLoopCondition)
-            lastCommand = getLastCommand()
-            if lastCommand.command in operationOpposite:
-                lastCommand.command = operationOpposite[lastCommand.command]
+    # Compare the variable against value and branch to target if comparison
+    # gives jumpIf
+    def compileSwitchCompare(self, variable, value, comparison, target, jumpIf=True):
+        value &= 0xFFFFFFFF
+        return [Command(0xb, list(variable), True),
+                Command(0xD if value <= 0xFFFF and self.usePushShort else 0xA, [value], True),
+                Command(comparison, [], True),
+                Command(0x35 if jumpIf else 0x34, [target])]
+
+    # Test the ranges one after another. low and high are the bounds the value
+    # is already known to be within, None if it isn't bounded on that side.
+    def compileSwitchTests(self, variable, ranges, defaultLabel, low=None, high=None):
+        nodeOut = []
+        for rangeLow, rangeHigh, label in ranges:
+            checkLow = low == None or low < rangeLow
+            checkHigh = high == None or high > rangeHigh
+            if not checkLow and not checkHigh:
+                nodeOut.append(Command(0x4, [label]))
+                return nodeOut
+            if rangeLow == rangeHigh:
+                nodeOut += self.compileSwitchCompare(variable, rangeLow, 0x25, label)
+            elif checkLow and checkHigh:
+                outOfRange = Label()
+                nodeOut += self.compileSwitchCompare(variable, rangeLow, 0x27, outOfRange)
+                nodeOut += self.compileSwitchCompare(variable, rangeHigh, 0x28, label)
+                nodeOut.append(outOfRange)
+            elif checkLow:
+                nodeOut += self.compileSwitchCompare(variable, rangeLow, 0x2a, label)
             else:
+                nodeOut += self.compileSwitchCompare(variable, rangeHigh, 0x28, label)
+        nodeOut.append(Command(0x4, [defaultLabel]))
+        return nodeOut
+
+    # Binary search over the ranges, which are sorted, down to a few that are
+    # tested one by one
+    def compileSwitchTree(self, variable, ranges, defaultLabel, low=None, high=None):
+        if len(ranges) <= SWITCH_TREE_LEAF_SIZE:
+            return self.compileSwitchTests(variable, ranges, defaultLabel, low, high)
+        middle = len(ranges) // 2
+        pivot = ranges[middle][0]
+        lowerHalf = Label()
+        nodeOut = self.compileSwitchCompare(variable, pivot, 0x27, lowerHalf)
+        nodeOut += self.compileSwitchTree(variable, ranges[middle:], defaultLabel, pivot, high)
+        nodeOut.append(lowerHalf)
+        nodeOut += self.compileSwitchTree(variable, ranges[:middle], defaultLabel, low, pivot - 1)
+        return nodeOut
+
+    # Functions the profile says are hot can be bigger and still be inlined,
+    # ones it says are never called aren't inlined
+    def getInlineThreshold(self, name):
+        if self.profile == None or self.profile.getCalls(name) == None:
+            return self.inlineThreshold
+        if self.profile.getCalls(name) == 0:
+            return 0
+        return self.inlineThreshold * PROFILE_HOT_INLINE_FACTOR if self.profile.isHot(name) else self.inlineThreshold
+
+    def compileLoopCondition(self, cond, loopTop, loopParent=None, parentLoopCondition=None):
+        if self.branchConditions:
+            return self.compileCondition(cond, loopTop, True, loopParent, parentLoopCondition)
+        nodeOut = self.compileNode(cond, loopParent, parentLoopCondition)
+        pushLastCommand(nodeOut)
+        nodeOut.append(Command(0x35, [loopTop]))
+        return nodeOut
+
+    def compileNode(self, node, loopParent=None, parentLoopCondition=None):
+
+        nodeOut = []
+
+        if isinstance(node, list):
+            for i in node:
+                nodeOut += self.compileNode(i, loopParent, parentLoopCondition)
+            return nodeOut
+        elif not isinstance(node, c_ast.Node):
+            raise ValueError("That's no node that's a "+str(type(node)))
+
+        # Macro for getting the last command (skip any labels)
+        def getLastCommand():
+            if len(nodeOut) > 0:
+                i = 1
+                while i <= len(nodeOut):
+                    if type(nodeOut[-i]) == Command:
+                        return nodeOut[-i]
+                    i += 1
+
+        # Macro for marking the last command as an argument for the current command
+        def addArg():
+            pushLastCommand(nodeOut)
+
+        t = type(node)
+
+        # Check the type, depending on which type it is compile as it should
+        # If an argument needs to be compiled, recursively call compile on the node
+
+        # How to read the following code:
+        # 1. read as if t is NodeType
+        # 2. addArgs() = the last compiled command should be pushed to the stack
+        # 3. being appended to nodeOut is adding it to the compiled version of the node
+        # 4. Command(n, l) is defining a comamnd of id n with a list of args l
+        #    the definition for Command is in msc.py, a dictionary of command name to id
+        #    is also available in msc.py called "COMMAND_IDS" near the top
+        if t == c_ast.Decl:
+            # Declaring a name again in the same block reuses its slot
+            scope = self.scopes[-1]
+            if not node.name in scope:
+                scope[node.name] = len(self.localVars)
+                self.localVars.append(node.name)
+                self.localVarTypes.append(node.type.type.names[-1])
+            localVarNum = scope[node.name]
+            if node.init == None:
+                self.uninitializedLocals.append(localVarNum)
+            if node.init != None:
+                nodeOut += self.compileNode(node.init, loopParent, parentLoopCondition)
                 addArg()
-                nodeOut.append(Command(0x2b))
-        elif node.op == "~":
-            nodeOut += compileNode(node.expr, loopParent, parentLoopCondition)
+                if node.type.type.names[-1] == "float" and not self.isCommandFloat(getLastCommand(), True):
+                    nodeOut.append(Command(0x38, [0]))
+                elif node.type.type.names[-1] != "float" and self.isCommandFloat(getLastCommand(), False):
+                    nodeOut.append(Command(0x39, [0]))
+                nodeOut.append(Command(0x1C, [0, localVarNum]))
+        elif t == c_ast.Constant:
+            if node.type == "int" or node.type == "bool":
+                newValue = toInt(node.value) & 0xFFFFFFFF
+                nodeOut.append(Command(0xD if newValue <= 0xFFFF and self.usePushShort else 0xA, [newValue]))
+            elif node.type == "float" or node.type == "double":
+                nodeOut.append(Command(0xA, [float(node.value.rstrip('f'))]))
+            elif node.type == "string":
+                string = apply_c_escapes(node.value[1:-1])
+                if not string in self.scriptStrings:
+                    self.scriptStrings.append(string)
+                # The index is into the strings of the current script until
+                # addScript relocates it into the file's string table
+                stringCommand = Command(0xD, [self.scriptStrings.index(string)])
+                stringCommand.isString = True
+                nodeOut.append(stringCommand)
+        elif t == c_ast.Assignment:
+            nodeOut += self.compileNode(node.rvalue, loopParent, parentLoopCondition)
             addArg()
-            nodeOut.append(Command(0x18))
-        elif node.op == "p++":
-            if type(node.expr) != c_ast.ID:
-                CompilerError("Error at %s: Cannot increment non variable."%str(node.coord))
-            varScope,varType,varIndex = resolveVariable(node.expr.name)
-            op = 0x3F if varType == "float" else 0x14
-            nodeOut.append(Command(op, [varScope,varIndex]))
-        elif node.op == "p--":
-            if type(node.expr) != c_ast.ID:
-                CompilerError("Error at %s: Cannot decrement non variable."%str(node.coord))
-            varScope,varType,varIndex = resolveVariable(node.expr.name)
-            op = 0x40 if varType == "float" else 0x15
-            nodeOut.append(Command(op, [varScope,varIndex]))
-        elif node.op == "-":
-            if type(node.expr) == c_ast.Constant:
-                node = node.expr
-                if node.type == "int":
-                    newValue = (-toInt(node.value)) & 0xFFFFFFFF
-                    nodeOut.append(Command(0xD if newValue <= 0xFFFF and args.usePushShort else 0xA, [newValue]))
-                elif node.type == "float" or node.type == "double":
-                    nodeOut.append(Command(0xA, [-float(node.value.rstrip('f'))]))
+            if type(node.lvalue) != c_ast.ID:
+                raise CompilerError("Error at %s: Left hand side of assignment operation must be variable."%str(node.coord))
+            try:
+                varScope,varType,varIndex = self.resolveVariable(node.lvalue.name)
+            except CompilerError:
+                raise CompilerError("Error at %s: Left hand side of assignment operation must be a valid reference to a variable."%str(node.coord))
+
+            if self.autocast:
+                if varType == "float" and not self.isCommandFloat(getLastCommand(), True):
+                        nodeOut.append(Command(0x38, [0]))
+                elif varType != "float" and self.isCommandFloat(getLastCommand(), False):
+                        nodeOut.append(Command(0x39, [0]))
+
+            if varType == "float":
+                operation = assignmentOperationsFloat[node.op]
             else:
-                nodeOut += compileNode(node.expr, loopParent, parentLoopCondition)
-                addArg()
-                op = 0x3E if isCommandFloat(getLastCommand(), False) else 0x13
-                nodeOut.append(Command(op))
-        elif node.op == "&":
-            if type(node.expr) == c_ast.ID:
-                nodeOut.append(Command(0xA,[node.expr.name]))
+                operation = assignmentOperationsInt[node.op]
+            nodeOut.append(Command(operation,[varScope,varIndex]))
+        elif t == c_ast.TernaryOp:
+            if (type(node.iftrue) == c_ast.TernaryOp and type(node.iffalse) == c_ast.Constant and
+                node.iffalse.type == "int" and int(node.iffalse.value, 0) == 0 and
+                type(node.iftrue.iftrue) == c_ast.Constant and node.iftrue.iftrue.type == "int" and
+                int(node.iftrue.iftrue.value, 0) == 1 and type(node.iftrue.iffalse) == c_ast.Constant and
+                node.iftrue.iffalse.type == "int" and int(node.iftrue.iffalse.value, 0) == 0):
+                # If tail end ternary combination is possible
+                endLabel = Label()
+                isFalseLabel = Label()
+                if self.branchConditions:
+                    nodeOut += self.compileCondition(node.cond, isFalseLabel, False, loopParent, parentLoopCondition)
+                    nodeOut += self.compileCondition(node.iftrue.cond, isFalseLabel, False, loopParent, parentLoopCondition)
+                else:
+                    nodeOut += self.compileNode(node.cond, loopParent, parentLoopCondition)
+                    addArg()
+                    nodeOut.append(Command(0x34, [isFalseLabel]))
+                    nodeOut += self.compileNode(node.iftrue.cond, loopParent, parentLoopCondition)
+                    addArg()
+                    nodeOut.append(Command(0x34, [isFalseLabel]))
+                nodeOut.append(Command(0xD if self.usePushShort else 0xA, [1], True))
+                nodeOut.append(Command(0x36, [endLabel]))
+                nodeOut.append(isFalseLabel)
+                nodeOut.append(Command(0xD if self.usePushShort else 0xA, [0], True))
+                nodeOut.append(endLabel)
             else:
-                raise CompilerError("Error at %s: The addressing of non-functions is not allowed."%str(node.coord))
-        elif node.op == "sizeof":
-            nodeOut.append(Command(0xD,[0x4]))
-        else:
-            raise CompilerError("Operation %s not supported" % node.op)
-    elif t == c_ast.ID:
-        try:
-            varScope,varType,varIndex = resolveVariable(node.name)
-            nodeOut.append(Command(0xb,[varScope,varIndex]))
-        except CompilerError:
-            if node.name in global_constants:
-                nodeOut.append(Command(0xA, [global_constants[node.name]]))
-            elif node.name in refs.functions:
-                nodeOut.append(Command(0xA, [node.name]))
+                endLabel = Label()
+                isFalseLabel = Label()
+                if self.branchConditions:
+                    nodeOut += self.compileCondition(node.cond, isFalseLabel, False, loopParent, parentLoopCondition)
+                else:
+                    nodeOut += self.compileNode(node.cond, loopParent, parentLoopCondition)
+                    addArg()
+                    nodeOut.append(Command(0x34, [isFalseLabel]))
+                nodeOut += self.compileNode(node.iftrue, loopParent, parentLoopCondition)
+                addArg()
+                nodeOut.append(Command(0x36, [endLabel]))
+                nodeOut.append(isFalseLabel)
+                nodeOut += self.compileNode(node.iffalse, loopParent, parentLoopCondition)
+                addArg()
+                nodeOut.append(endLabel)
+        elif t == c_ast.UnaryOp:
+            if node.op == "!":
+                nodeOut += self.compileNode(node.expr, loopParent, parentLoopCondition)
+                lastCommand = getLastCommand()
+                if lastCommand.command in operationOpposite:
+                    lastCommand.command = operationOpposite[lastCommand.command]
+                else:
+                    addArg()
+                    nodeOut.append(Command(0x2b))
+            elif node.op == "~":
+                nodeOut += self.compileNode(node.expr, loopParent, parentLoopCondition)
+                addArg()
+                nodeOut.append(Command(0x18))
+            elif node.op == "p++":
+                if type(node.expr) != c_ast.ID:
+                    CompilerError("Error at %s: Cannot increment non variable."%str(node.coord))
+                varScope,varType,varIndex = self.resolveVariable(node.expr.name)
+                op = 0x3F if varType == "float" else 0x14
+                nodeOut.append(Command(op, [varScope,varIndex]))
+            elif node.op == "p--":
+                if type(node.expr) != c_ast.ID:
+                    CompilerError("Error at %s: Cannot decrement non variable."%str(node.coord))
+                varScope,varType,varIndex = self.resolveVariable(node.expr.name)
+                op = 0x40 if varType == "float" else 0x15
+                nodeOut.append(Command(op, [varScope,varIndex]))
+            elif node.op == "++" or node.op == "--":
+                # Unlike the postfix versions these give a value, the new one,
+                # which is only pushed if something uses it
+                if type(node.expr) != c_ast.ID:
+                    raise CompilerError("Error at %s: Cannot increment or decrement non variable."%str(node.coord))
+                varScope,varType,varIndex = self.resolveVariable(node.expr.name)
+                if varType == "float":
+                    op = 0x3F if node.op == "++" else 0x40
+                else:
+                    op = 0x14 if node.op == "++" else 0x15
+                nodeOut.append(Command(op, [varScope,varIndex]))
+                if not id(node) in self.statementExpressions:
+                    nodeOut.append(Command(0xb, [varScope,varIndex]))
+            elif node.op == "-":
+                if type(node.expr) == c_ast.Constant:
+                    node = node.expr
+                    if node.type == "int":
+                        newValue = (-toInt(node.value)) & 0xFFFFFFFF
+                        nodeOut.append(Command(0xD if newValue <= 0xFFFF and self.usePushShort else 0xA, [newValue]))
+                    elif node.type == "float" or node.type == "double":
+                        nodeOut.append(Command(0xA, [-float(node.value.rstrip('f'))]))
+                else:
+                    nodeOut += self.compileNode(node.expr, loopParent, parentLoopCondition)
+                    addArg()
+                    op = 0x3E if self.isCommandFloat(getLastCommand(), False) else 0x13
+                    nodeOut.append(Command(op))
+            elif node.op == "&":
+                if type(node.expr) == c_ast.ID:
+                    nodeOut.append(Command(0xA,[node.expr.name]))
+                else:
+                    raise CompilerError("Error at %s: The addressing of non-functions is not allowed."%str(node.coord))
+            elif node.op == "sizeof":
+                nodeOut.append(Command(0xD,[0x4]))
             else:
-                raise CompilerError("Error at %s: Invalid reference."%str(node.coord))
-    elif t == c_ast.Cast:
-        nodeOut += compileNode(node.expr, loopParent, parentLoopCondition)
-        addArg()
-        if node.to_type.type.type.names[-1] == "float":
-            nodeOut.append(Command(0x38,[0]))
-        else:
-            nodeOut.append(Command(0x39,[0]))
-    elif t == c_ast.Return:
-        if node.expr == None:
-            nodeOut.append(Command(0x7))
-        else:
-            nodeOut += compileNode(node.expr, loopParent, parentLoopCondition)
-            addArg()
-            nodeOut.append(Command(0x6))
-    elif t == c_ast.BinaryOp:
-        if node.op in ["&&", "||"]:
-            nodeOut += compileNode(node.left, loopParent, parentLoopCondition)
+                raise CompilerError("Operation %s not supported" % node.op)
+        elif t == c_ast.ID:
+            try:
+                varScope,varType,varIndex = self.resolveVariable(node.name)
+                nodeOut.append(Command(0xb,[varScope,varIndex]))
+            except CompilerError:
+                if node.name in global_constants:
+                    nodeOut.append(Command(0xA, [global_constants[node.name]]))
+                elif node.name in self.refs.functions:
+                    nodeOut.append(Command(0xA, [node.name]))
+                else:
+                    raise CompilerError("Error at %s: Invalid reference."%str(node.coord))
+        elif t == c_ast.Cast:
+            nodeOut += self.compileNode(node.expr, loopParent, parentLoopCondition)
             addArg()
-            if node.op == "||":
-                endOrLabel, trueLabel, falseLabel = Label(), Label(), Label()
-                nodeOut.append(Command(0x35, [trueLabel]))
-                nodeOut += compileNode(node.right, loopParent, parentLoopCondition)
-                addArg()
-                nodeOut.append(Command(0x34, [falseLabel]))
-                nodeOut.append(trueLabel)
-                nodeOut.append(Command(0xD if args.usePushShort else 0xA, [1]))
+            if node.to_type.type.type.names[-1] == "float":
+                nodeOut.append(Command(0x38,[0]))
+            else:
+                nodeOut.append(Command(0x39,[0]))
+        elif t == c_ast.Return:
+            if id(node.expr) in self.selfTailCalls:
+                nodeOut += self.compileSelfTailCall(node.expr)
+            elif node.expr == None:
+                nodeOut.append(Command(0x7))
+            else:
+                nodeOut += self.compileNode(node.expr, loopParent, parentLoopCondition)
                 addArg()
-                nodeOut.append(Command(0x36, [endOrLabel]))
+                nodeOut.append(Command(0x6))
+        elif t == c_ast.BinaryOp:
+            if node.op in ["&&", "||"] and self.branchConditions:
+                endLabel, falseLabel = Label(), Label()
+                nodeOut += self.compileCondition(node, falseLabel, False, loopParent, parentLoopCondition)
+                nodeOut.append(Command(0xD if self.usePushShort else 0xA, [1], True))
+                nodeOut.append(Command(0x36, [endLabel]))
                 nodeOut.append(falseLabel)
-                nodeOut.append(Command(0xD if args.usePushShort else 0xA, [0]))
+                nodeOut.append(Command(0xD if self.usePushShort else 0xA, [0], True))
+                nodeOut.append(endLabel)
+            elif node.op in ["&&", "||"]:
+                nodeOut += self.compileNode(node.left, loopParent, parentLoopCondition)
                 addArg()
-                nodeOut.append(endOrLabel)
+                if node.op == "||":
+                    endOrLabel, trueLabel, falseLabel = Label(), Label(), Label()
+                    nodeOut.append(Command(0x35, [trueLabel]))
+                    nodeOut += self.compileNode(node.right, loopParent, parentLoopCondition)
+                    addArg()
+                    nodeOut.append(Command(0x34, [falseLabel]))
+                    nodeOut.append(trueLabel)
+                    nodeOut.append(Command(0xD if self.usePushShort else 0xA, [1]))
+                    addArg()
+                    nodeOut.append(Command(0x36, [endOrLabel]))
+                    nodeOut.append(falseLabel)
+                    nodeOut.append(Command(0xD if self.usePushShort else 0xA, [0]))
+                    addArg()
+                    nodeOut.append(endOrLabel)
+                else:
+                    endAndLabel, falseLabel = Label(), Label()
+                    nodeOut.append(Command(0x34, [falseLabel]))
+                    nodeOut += self.compileNode(node.right, loopParent, parentLoopCondition)
+                    addArg()
+                    nodeOut.append(Command(0x34, [falseLabel]))
+                    nodeOut.append(Command(0xD if self.usePushShort else 0xA, [1]))
+                    addArg()
+                    nodeOut.append(Command(0x36, [endAndLabel]))
+                    nodeOut.append(falseLabel)
+                    nodeOut.append(Command(0xD if self.usePushShort else 0xA, [0]))
+                    addArg()
+                    nodeOut.append(endAndLabel)
             else:
-                endAndLabel, falseLabel = Label(), Label()
-                nodeOut.append(Command(0x34, [falseLabel]))
-                nodeOut += compileNode(node.right, loopParent, parentLoopCondition)
+                nodeOut += self.compileNode(node.left, loopParent, parentLoopCondition)
                 addArg()
-                nodeOut.append(Command(0x34, [falseLabel]))
-                nodeOut.append(Command(0xD if args.usePushShort else 0xA, [1]))
+                pos = len(nodeOut)
+                isFloat1 = self.isCommandFloat(getLastCommand(), False)
+                nodeOut += self.compileNode(node.right, loopParent, parentLoopCondition)
                 addArg()
-                nodeOut.append(Command(0x36, [endAndLabel]))
-                nodeOut.append(falseLabel)
-                nodeOut.append(Command(0xD if args.usePushShort else 0xA, [0]))
+                isFloat2 = self.isCommandFloat(getLastCommand(), isFloat1)
+                isFloat = isFloat1 or isFloat2
+                cmd = binaryOperationsFloat[node.op] if isFloat else binaryOperationsInt[node.op]
+                if not cmd in range(0x16, 0x1C) and isFloat and self.autocast:
+                    if not isFloat1:
+                        nodeOut.insert(pos, Command(0x38,[0]))
+                    if not isFloat2:
+                        nodeOut.append(Command(0x38,[0]))
+                nodeOut.append(Command(cmd))
+        elif t == c_ast.Goto:
+            nodeOut.append(Command(0x4,[node.name]))
+        elif t == c_ast.Label:
+            nodeOut.append(Label(node.name))
+            nodeOut += self.compileNode(node.stmt, loopParent, parentLoopCondition)
+        elif t == c_ast.If and self.isTrueSideHotter(node):
+            # The side that runs more often goes last, where it doesn't have
+            # to jump past the other one
+            swapped = c_ast.If(c_ast.UnaryOp("!", node.cond, node.cond.coord), node.iffalse, node.iftrue, node.coord)
+            nodeOut += self.compileNode(swapped, loopParent, parentLoopCondition)
+        elif t == c_ast.If:
+            ifFalseLabel = Label()
+            if node.iffalse != None:
+                endLabel = Label()
+            probed = self.profileGenerate and id(node) in self.profileSites
+            if probed:
+                nodeOut += self.compileProbe(profiling.PROBE_BRANCH, self.profileSites[id(node)])
+            if self.branchConditions:
+                nodeOut += self.compileCondition(node.cond, ifFalseLabel, False, loopParent, parentLoopCondition)
+            else:
+                nodeOut += self.compileNode(node.cond, loopParent, parentLoopCondition)
+                isIfNot = False
+                lastCommand = getLastCommand()
+                if lastCommand != None and lastCommand.command == 0x2b:
+                    nodeOut.remove(getLastCommand())
+                    isIfNot = True
                 addArg()
-                nodeOut.append(endAndLabel)
-        else:
-            nodeOut += compileNode(node.left, loopParent, parentLoopCondition)
-            addArg()
-            pos = len(nodeOut)
-            isFloat1 = isCommandFloat(getLastCommand(), False)
-            nodeOut += compileNode(node.right, loopParent, parentLoopCondition)
-            addArg()
-            isFloat2 = isCommandFloat(getLastCommand(), isFloat1)
-            isFloat = isFloat1 or isFloat2
-            cmd = binaryOperationsFloat[node.op] if isFloat else binaryOperationsInt[node.op]
-            if not cmd in range(0x16, 0x1C) and isFloat and args.autocast:
-                if not isFloat1:
-                    nodeOut.insert(pos, Command(0x38,[0]))
-                if not isFloat2:
-                    nodeOut.append(Command(0x38,[0]))
-            nodeOut.append(Command(cmd))
-    elif t == c_ast.Goto:
-        nodeOut.append(Command(0x4,[node.name]))
-    elif t == c_ast.Label:
-        nodeOut.append(Label(node.name))
-        nodeOut += compileNode(node.stmt, loopParent, parentLoopCondition)
-    elif t == c_ast.If:
-        nodeOut += compileNode(node.cond, loopParent, parentLoopCondition)
-        isIfNot = False
-        lastCommand = getLastCommand()
-        if lastCommand != None and lastCommand.command == 0x2b:
-            nodeOut.remove(getLastCommand())
-            isIfNot = True
-        addArg()
-        ifFalseLabel = Label()
-        if node.iffalse != None:
+                nodeOut.append(Command(0x35 if isIfNot else 0x34, [ifFalseLabel]))
+            if probed:
+                nodeOut += self.compileProbe(profiling.PROBE_TAKEN, self.profileSites[id(node)])
+            nodeOut += self.compileNode(node.iftrue, loopParent, parentLoopCondition)
+            if node.iffalse != None:
+                nodeOut.append(Command(0x36, [endLabel]))
+            nodeOut.append(ifFalseLabel)
+            if node.iffalse != None:
+                nodeOut += self.compileNode(node.iffalse, loopParent, parentLoopCondition)
+                nodeOut.append(endLabel)
+        elif t == c_ast.Compound:
+            self.scopes.append({})
+            if node.block_items != None:
+                for i in node.block_items:
+                    nodeOut += self.compileNode(i, loopParent, parentLoopCondition)
+            self.scopes.pop()
+        elif t == c_ast.While:
+            loopTop = Label()
             endLabel = Label()
-        nodeOut.append(Command(0x35 if isIfNot else 0x34, [ifFalseLabel]))
-        nodeOut += compileNode(node.iftrue, loopParent, parentLoopCondition)
-        if node.iffalse != None:
-            nodeOut.append(Command(0x36, [endLabel]))
-        nodeOut.append(ifFalseLabel)
-        if node.iffalse != None:
-            nodeOut += compileNode(node.iffalse, loopParent, parentLoopCondition)
+            conditionLabel = Label()
+            nodeOut.append(Command(0x36, [conditionLabel]))
+            nodeOut.append(loopTop)
+            nodeOut += self.compileNode(node.stmt, endLabel, conditionLabel)
+            nodeOut.append(conditionLabel)
+            nodeOut += self.compileLoopCondition(node.cond, loopTop, loopParent, parentLoopCondition)
             nodeOut.append(endLabel)
-    elif t == c_ast.Compound:
-        if node.block_items != None:
-            for i in node.block_items:
-                nodeOut += compileNode(i, loopParent, parentLoopCondition)
-    elif t == c_ast.While:
-        loopTop = Label()
-        endLabel = Label()
-        conditionLabel = Label()
-        nodeOut.append(Command(0x36, [conditionLabel]))
-        nodeOut.append(loopTop)
-        nodeOut += compileNode(node.stmt, endLabel, conditionLabel)
-        nodeOut.append(conditionLabel)
-        nodeOut += compileNode(node.cond, loopParent, parentLoopCondition)
-        addArg()
-        nodeOut.append(Command(0x35, [loopTop]))
-        nodeOut.append(endLabel)
-    elif t == c_ast.DoWhile:
-        loopTop = Label()
-        endLabel = Label()
-        conditionLabel = Label()
-        nodeOut.append(loopTop)
-        nodeOut += compileNode(node.stmt, endLabel, conditionLabel)
-        nodeOut.append(conditionLabel)
-        nodeOut += compileNode(node.cond, loopParent, parentLoopCondition)
-        addArg()
-        nodeOut.append(Command(0x35, [loopTop]))
-        nodeOut.append(endLabel)
-    elif t == c_ast.For:
-        for decl in node.init.decls:
-            nodeOut += compileNode(decl, loopParent, parentLoopCondition)
-        loopTop = Label()
-        endLabel = Label()
-        conditionLabel = Label()
-        nodeOut.append(loopTop)
-        nodeOut += compileNode(node.stmt, endLabel, conditionLabel)
-        nodeOut.append(conditionLabel)
-        nodeOut += compileNode(node.next, endLabel, conditionLabel)
-        nodeOut += compileNode(node.cond, loopParent, parentLoopCondition)
-        addArg()
-        nodeOut.append(Command(0x35, [loopTop]))
-        nodeOut.append(endLabel)
-    elif t == c_ast.Break:
-        nodeOut.append(Command(0x4, [loopParent]))
-    elif t == c_ast.Continue:
-        nodeOut.append(Command(0x4, [parentLoopCondition]))
-    elif t == c_ast.Switch:
-        if type(node.cond) == c_ast.ID:
-            compiledVariable = compileNode(node.cond,loopParent, parentLoopCondition)
-        else:
-            raise CompilerError("Error at %s: Switch statements must have a variable as the condition"%str(node.coord))
-        blockEnd = Label()
-        for i in node.stmt.block_items:
-            nextStatement = Label()
-            if type(i) == c_ast.Case:
-                nodeOut += compileNode(i.expr, loopParent, parentLoopCondition)
-                addArg()
-                nodeOut += compiledVariable
+        elif t == c_ast.DoWhile:
+            loopTop = Label()
+            endLabel = Label()
+            conditionLabel = Label()
+            nodeOut.append(loopTop)
+            nodeOut += self.compileNode(node.stmt, endLabel, conditionLabel)
+            nodeOut.append(conditionLabel)
+            nodeOut += self.compileLoopCondition(node.cond, loopTop, loopParent, parentLoopCondition)
+            nodeOut.append(endLabel)
+        elif t == c_ast.For:
+            # Variables declared in the for are only in scope in the loop
+            self.scopes.append({})
+            for decl in node.init.decls:
+                nodeOut += self.compileNode(decl, loopParent, parentLoopCondition)
+            loopTop = Label()
+            endLabel = Label()
+            conditionLabel = Label()
+            nodeOut.append(loopTop)
+            nodeOut += self.compileNode(node.stmt, endLabel, conditionLabel)
+            nodeOut.append(conditionLabel)
+            nodeOut += self.compileNode(node.next, endLabel, conditionLabel)
+            nodeOut += self.compileLoopCondition(node.cond, loopTop, loopParent, parentLoopCondition)
+            nodeOut.append(endLabel)
+            self.scopes.pop()
+        elif t == c_ast.Break:
+            nodeOut.append(Command(0x4, [loopParent]))
+        elif t == c_ast.Continue:
+            nodeOut.append(Command(0x4, [parentLoopCondition]))
+        elif t == c_ast.Switch:
+            # The value is only evaluated once, anything but a variable is
+            # stored in a hidden local first
+            variable = None
+            if type(node.cond) == c_ast.ID:
+                try:
+                    varScope,varType,varIndex = self.resolveVariable(node.cond.name)
+                    variable = (varScope, varIndex)
+                except CompilerError:
+                    pass
+            if variable == None:
+                nodeOut += self.compileNode(node.cond, loopParent, parentLoopCondition)
                 addArg()
-                nodeOut.append(Command(0x25,[],True))
-                nodeOut.append(Command(0x34,[nextStatement]))
-                nodeOut += compileNode(i.stmts, blockEnd, parentLoopCondition)
-                nodeOut.append(nextStatement)
-            elif type(i) == c_ast.Default:
-                nodeOut += compileNode(i.stmts, blockEnd, parentLoopCondition)
-            else:
-                CompilerError("Error at %s: Switch statements cannot have anything but cases and defaults"%str(i.coord))
-        nodeOut.append(blockEnd)
-    elif t == c_ast.FuncCall:
-        name = None if type(node.name) != c_ast.ID else node.name.name
-        if name == None and type(node.name) == c_ast.StructRef:
-            syscallName = node.name.name.name
-            methodName = node.name.field.name
-            syscallInfo = xmlInfo.getSyscall(syscallName)
-            if syscallInfo != None:
-                methodInfo = syscallInfo.getMethod(methodName)
-                if methodInfo == None:
-                    raise CompilerError("Syscall {}, method {} is not defined".format(syscallName, methodName))
-                nodeOut.append(Command(0xA, [methodInfo.id], pushBit=True))
-                if node.args != None:
-                    for arg in node.args.exprs:
-                        nodeOut += compileNode(arg, loopParent, parentLoopCondition)
-                        addArg()
-                    nodeOut.append(Command(0x2d, [len(node.args.exprs) + 1, syscallInfo.id]))
+                if self.isCommandFloat(getLastCommand(), False):
+                    nodeOut.append(Command(0x39, [0]))
+                tempName = "switch %i" % len(self.localVars)
+                self.localVars.append(tempName)
+                self.localVarTypes.append("int")
+                variable = (0, len(self.localVars) - 1)
+                nodeOut.append(Command(0x1C, [0, variable[1]]))
+
+            # Every case gets a label in front of its statements, which are
+            # laid out in order so cases without a break fall through
+            blockEnd = Label()
+            defaultLabel = None
+            cases = []
+            body = []
+            items = node.stmt.block_items if type(node.stmt) == c_ast.Compound else [node.stmt]
+            self.scopes.append({})
+            for i in items if items != None else []:
+                # Cases right after each other share a label so their values
+                # can be tested as a range
+                caseLabel = body[-1] if len(body) > 0 and type(body[-1]) == Label else Label()
+                if type(i) == c_ast.Case:
+                    value = self.getCaseValue(i.expr)
+                    if value in [case[0] for case in cases]:
+                        raise CompilerError("Error at %s: Duplicate case value %i"%(str(i.coord), value))
+                    cases.append((value, caseLabel))
+                elif type(i) == c_ast.Default:
+                    if defaultLabel != None:
+                        raise CompilerError("Error at %s: Switch statements can only have one default"%str(i.coord))
+                    defaultLabel = caseLabel
                 else:
-                    nodeOut.append(Command(0x2d, [1, syscallInfo.id]))
+                    raise CompilerError("Error at %s: Switch statements cannot have anything but cases and defaults"%str(i.coord))
+                if len(body) == 0 or not body[-1] is caseLabel:
+                    body.append(caseLabel)
+                body += self.compileNode(i.stmts, blockEnd, parentLoopCondition)
+            self.scopes.pop()
+            ordinal = self.profileSites.get(id(node))
+            if self.profileGenerate and ordinal != None:
+                nodeOut += self.compileProbe(profiling.PROBE_SWITCH, ordinal, variable)
+            ranges = getSwitchRanges(cases)
+            caseCounts = profiling.getCaseCounts(self.functionProfile, ordinal)
+            if self.canTestCasesInline(ranges, body, defaultLabel, caseCounts):
+                nodeOut += self.compileInlineSwitch(variable, ranges, body, defaultLabel)
             else:
-                raise CompilerError("Syscall {} not found".format(syscallName))
-        elif name == "printf":
-            for arg in node.args.exprs:
-                nodeOut += compileNode(arg, loopParent, parentLoopCondition)
-                addArg()
-            nodeOut.append(Command(0x2c, [len(node.args.exprs)]))
-        elif name == "set_main":
-            if len(node.args.exprs) == 0:
-                raise CompilerError("Error at %s: set_main requires at least 1 argument (function pointer)"%str(node.coord))
-            funcPtr = compileNode(node.args.exprs[0], loopParent, parentLoopCondition)
-            funcArgs = node.args.exprs[1:]
-            for arg in funcArgs:
-                nodeOut += compileNode(arg, loopParent, parentLoopCondition)
-                addArg()
-            nodeOut += funcPtr
-            addArg()
-            nodeOut.append(Command(0x30, [len(funcArgs)]))
-        elif name == "callFunc3":
-            if len(node.args.exprs) == 0:
-                raise CompilerError("Error at %s: callFunc3 requires at least 1 argument (function pointer)"%str(node.coord))
-            funcPtr = compileNode(node.args.exprs[0], loopParent, parentLoopCondition)
-            funcArgs = node.args.exprs[1:]
-            for arg in funcArgs:
-                nodeOut += compileNode(arg, loopParent, parentLoopCondition)
+                nodeOut += self.compileSwitchDispatch(variable, ranges, defaultLabel if defaultLabel != None else blockEnd, caseCounts)
+                nodeOut += body
+            nodeOut.append(blockEnd)
+        elif t == c_ast.FuncCall:
+            name = None if type(node.name) != c_ast.ID else node.name.name
+            if id(node) in self.selfTailCalls:
+                nodeOut += self.compileSelfTailCall(node)
+            elif name == None and type(node.name) == c_ast.StructRef:
+                syscallName = node.name.name.name
+                methodName = node.name.field.name
+                syscallInfo = self.xmlInfo.getSyscall(syscallName)
+                if syscallInfo != None:
+                    methodInfo = syscallInfo.getMethod(methodName)
+                    if methodInfo == None:
+                        raise CompilerError("Syscall {}, method {} is not defined".format(syscallName, methodName))
+                    nodeOut.append(Command(0xA, [methodInfo.id], pushBit=True))
+                    if node.args != None:
+                        for arg in node.args.exprs:
+                            nodeOut += self.compileNode(arg, loopParent, parentLoopCondition)
+                            addArg()
+                        nodeOut.append(Command(0x2d, [len(node.args.exprs) + 1, syscallInfo.id]))
+                    else:
+                        nodeOut.append(Command(0x2d, [1, syscallInfo.id]))
+                else:
+                    raise CompilerError("Syscall {} not found".format(syscallName))
+            elif name == "printf":
+                for arg in node.args.exprs:
+                    nodeOut += self.compileNode(arg, loopParent, parentLoopCondition)
+                    addArg()
+                nodeOut.append(Command(0x2c, [len(node.args.exprs)]))
+            elif name == "set_main":
+                if len(node.args.exprs) == 0:
+                    raise CompilerError("Error at %s: set_main requires at least 1 argument (function pointer)"%str(node.coord))
+                funcPtr = self.compileNode(node.args.exprs[0], loopParent, parentLoopCondition)
+                funcArgs = node.args.exprs[1:]
+                for arg in funcArgs:
+                    nodeOut += self.compileNode(arg, loopParent, parentLoopCondition)
+                    addArg()
+                nodeOut += funcPtr
                 addArg()
-            nodeOut += funcPtr
-            addArg()
-            nodeOut.append(Command(0x31, [len(funcArgs)]))
-        elif name in syscalls:
-            sysNum = syscalls[name]
-            for arg in node.args.exprs:
-                nodeOut += compileNode(arg, loopParent, parentLoopCondition)
+                nodeOut.append(Command(0x30, [len(funcArgs)]))
+            elif name == "callFunc3":
+                if len(node.args.exprs) == 0:
+                    raise CompilerError("Error at %s: callFunc3 requires at least 1 argument (function pointer)"%str(node.coord))
+                funcPtr = self.compileNode(node.args.exprs[0], loopParent, parentLoopCondition)
+                funcArgs = node.args.exprs[1:]
+                for arg in funcArgs:
+                    nodeOut += self.compileNode(arg, loopParent, parentLoopCondition)
+                    addArg()
+                nodeOut += funcPtr
                 addArg()
-            nodeOut.append(Command(0x2d, [len(node.args.exprs), sysNum]))
-        else:
-            endLabel = Label()
-            if name != None and not name in refs.functions:
-                raise CompilerError("Error at %s: function %s does not exist"%(str(node.coord),name))
-            elif name != None:
-                funcPtr = [Command(0xA, [name], True)]
-            elif type(node.name) == c_ast.UnaryOp and node.name.op == "*":
-                funcPtr = compileNode(node.name.expr, loopParent, parentLoopCondition)
-            nodeOut.append(Command(0x2e, [endLabel]))
-            if node.args != None:
+                nodeOut.append(Command(0x31, [len(funcArgs)]))
+            elif name in self.syscalls:
+                sysNum = self.syscalls[name]
                 for arg in node.args.exprs:
-                    nodeOut += compileNode(arg, loopParent, parentLoopCondition)
+                    nodeOut += self.compileNode(arg, loopParent, parentLoopCondition)
                     addArg()
-            nodeOut += funcPtr
-            addArg()
-            functionCallCommand = Command(0x2f, [len(node.args.exprs) if node.args != None else 0])
-            functionCallCommand.functionName = name
-            nodeOut.append(functionCallCommand)
-            nodeOut.append(endLabel)
-    else:
-        node.show()
-        print(node)
-        print(node.__slots__)
-        print()
-
-    return nodeOut
-
-def compileScript(func):
-    global msc, refs, localVars, localVarTypes
-    localVars = [x.name for x in func.decl.type.args.params] if func.decl.type.args != None else []
-    localVarTypes = dict([(x.name, x.type.type.names[-1]) for x in func.decl.type.args.params] if func.decl.type.args != None else [])
-    argCount = len(localVars)
-    script = []
-    if func.body.block_items != None:
-        for node in func.body.block_items:
-            script += compileNode(node)
-    script.insert(0, Command(2, [argCount, len(localVars)]))
-    script.append(Command(3))
-    return script
-
-# Fill in function pointers, labels with locations rather than strings
-def resolveReferences(msc):
-    global refs
-    scriptPositions = []
-    labelPostions = {}
-    namedLabelPositions = []
-    currentPos = 0x10
-    for i,script in enumerate(msc.scripts):
-        namedLabelPositions.append({})
-        scriptPositions.append(currentPos)
-        for cmd in script.cmds:
-            if type(cmd) == Command:
-                cmd.commandPosition = currentPos
-                currentPos += (0 if cmd.command in [0xFFFE, 0xFFFF] else 1) + getSizeFromFormat(COMMAND_FORMAT[cmd.command])
-            elif type(cmd) == Label:
-                if cmd.name != None:
-                    namedLabelPositions[i][cmd.name] = currentPos
-                labelPostions[cmd] = currentPos
-    refs.scriptPositions = scriptPositions
-    for j,script in enumerate(msc.scripts):
-        for cmd in script.cmds:
-            if type(cmd) == Command:
-                for i,arg in enumerate(cmd.parameters):
-                    if type(arg) == str:
-                        if arg in namedLabelPositions[j]:
-                            cmd.parameters[i] = namedLabelPositions[j][arg]
-                        else:
-                            cmd.parameters[i] = scriptPositions[refs.functions.index(arg)]
-                    elif type(arg) == Label:
-                        cmd.parameters[i] = labelPostions[arg]
+                nodeOut.append(Command(0x2d, [len(node.args.exprs), sysNum]))
+            else:
+                inlined = None
+                if name in self.inlineFunctions and (self.refs.functionTypes[name] != "void" or id(node) in self.statementExpressions):
+                    inlined = self.compileInlineCall(node, name)
+                if inlined != None:
+                    nodeOut += inlined
+                else:
+                    endLabel = Label()
+                    if name != None and not name in self.refs.functions:
+                        raise CompilerError("Error at %s: function %s does not exist"%(str(node.coord),name))
+                    elif name != None:
+                        funcPtr = [Command(0xA, [name], True)]
+                    elif type(node.name) == c_ast.UnaryOp and node.name.op == "*":
+                        funcPtr = self.compileNode(node.name.expr, loopParent, parentLoopCondition)
+                    nodeOut.append(Command(0x2e, [endLabel]))
+                    if node.args != None:
+                        for arg in node.args.exprs:
+                            nodeOut += self.compileNode(arg, loopParent, parentLoopCondition)
+                            addArg()
+                    nodeOut += funcPtr
+                    addArg()
+                    functionCallCommand = Command(0x2f, [len(node.args.exprs) if node.args != None else 0])
+                    functionCallCommand.functionName = name
+                    nodeOut.append(functionCallCommand)
+                    nodeOut.append(endLabel)
+        else:
+            node.show()
+            print(node)
+            print(node.__slots__)
+            print()
 
-# Thanks Triptych https://stackoverflow.com/questions/1265665/python-check-if-a-string-represents-an-int-without-using-try-except
-def _RepresentsInt(s):
+        return nodeOut
+
+    # A function's body after the passes on the AST, constant folding and
+    # strength reduction
+    def prepareBody(self, func, foldStats):
+        params = func.decl.type.args.params if func.decl.type.args != None else []
+        body = func.body
+        reducer = strength_reduction.StrengthReducer(strength_reduction.getLocalTypes(func), self.refs.globalVariableTypes,
+                                                     self.refs.functionTypes, global_constants, self.autocast)
+        if self.foldConstants:
+            variables = folding.getDeclaredNames(body) | set(x.name for x in params) | set(self.refs.globalVariables)
+            body = folding.ConstantFolder(global_constants, variables, self.autocast, foldStats, reducer.getType).fold(body)
+        if self.reduceStrength:
+            body = reducer.rewrite(body)
+        return body
+
+    # The prepared body of a function that's inlined and the calls in it that
+    # are statements, prepared once per file
+    def getInlineBody(self, name):
+        if not name in self.inlineBodies:
+            body = self.prepareBody(self.functionDefs[name], folding.FoldStats())
+            self.inlineBodies[name] = (body, inlining.getStatementExpressions(body))
+        return self.inlineBodies[name]
+
+    # Compile a call to one of the inlineFunctions as the function's body,
+    # the arguments go in new locals of the caller. Returns None if the value
+    # it gives wouldn't be the type a call gives.
+    def compileInlineCall(self, node, name):
+        func = self.functionDefs[name]
+        params = func.decl.type.args.params if func.decl.type.args != None else []
+        args = node.args.exprs if node.args != None else []
+        if len(params) != len(args):
+            return None
+        body, statementExpressions = self.getInlineBody(name)
+        items = body.block_items if body.block_items != None else []
+        value = None
+        if len(items) > 0 and type(items[-1]) == c_ast.Return:
+            items, value = items[:-1], items[-1].expr
+        localCount, stringCount = len(self.localVars), len(self.scriptStrings)
+
+        nodeOut = []
+        argSize = 0
+        scope = {}
+        for param, arg in zip(params, args):
+            argOut = self.compileNode(arg)
+            pushLastCommand(argOut)
+            argSize += peephole.commandSize(argOut)
+            scope[param.name] = len(self.localVars)
+            self.localVars.append(param.name)
+            self.localVarTypes.append(param.type.type.names[-1])
+            nodeOut += argOut
+            nodeOut.append(Command(0x1C, [0, scope[param.name]]))
+
+        # The body only sees its own variables and globals, and uses its own
+        # function's profile
+        scopes, outerStatementExpressions = self.scopes, self.statementExpressions
+        outerProfile = (self.profileFunction, self.profileSites, self.functionProfile)
+        self.scopes = [scope]
+        self.statementExpressions = outerStatementExpressions | statementExpressions
+        self.useProfileOf(name, body)
+        uninitializedCount = len(self.uninitializedLocals)
+        bodyOut = self.compileNode(items)
+        if value != None:
+            bodyOut += self.compileNode(value)
+        # Locals declared without a value start at 0 like in a real call,
+        # rather than keeping what they had at the last call inlined here
+        nodeOut += self.compileResets(self.uninitializedLocals[uninitializedCount:]) + bodyOut
+        self.scopes, self.statementExpressions = scopes, outerStatementExpressions
+        self.profileFunction, self.profileSites, self.functionProfile = outerProfile
+
+        if value != None:
+            isFloat = self.refs.functionTypes[name] == "float"
+            lastCommand = next(cmd for cmd in reversed(nodeOut) if type(cmd) == Command)
+            if self.isCommandFloat(lastCommand, isFloat) != isFloat:
+                del self.localVars[localCount:]
+                del self.localVarTypes[localCount:]
+                del self.scriptStrings[stringCount:]
+                del self.uninitializedLocals[uninitializedCount:]
+                return None
+        callSize = peephole.commandSize([Command(0x2e, [0]), Command(0xA, [0]), Command(0x2f, [0])])
+        self.scriptInlineStats.record(peephole.commandSize(nodeOut) - argSize - callSize)
+        return nodeOut
+
+    # Commands setting each of the local slots to 0
+    def compileResets(self, slots):
+        nodeOut = []
+        for slot in slots:
+            nodeOut += [Command(0xD if self.usePushShort else 0xA, [0], True), Command(0x1C, [0, slot])]
+        return nodeOut
+
+    # A call a function makes to itself as the last thing it does sets the
+    # parameters and jumps back to the start. All the arguments are pushed
+    # before any parameter changes since they can use them.
+    def compileSelfTailCall(self, node):
+        args = node.args.exprs if node.args != None else []
+        nodeOut = []
+        for arg in args:
+            nodeOut += self.compileNode(arg)
+            pushLastCommand(nodeOut)
+        for i in reversed(range(len(args))):
+            nodeOut.append(Command(0x1C, [0, i]))
+        nodeOut.append(Command(0x4, [self.functionStart]))
+        return nodeOut
+
+    def compileScript(self, func):
+        params = func.decl.type.args.params if func.decl.type.args != None else []
+        self.localVars = [x.name for x in params]
+        self.localVarTypes = [x.type.type.names[-1] for x in params]
+        # The function's own block shares a scope with its parameters
+        self.scopes = [dict((name, i) for i, name in enumerate(self.localVars))]
+        argCount = len(self.localVars)
+        body = self.prepareBody(func, self.scriptFoldStats)
+        self.useProfileOf(func.decl.name, body)
+        self.statementExpressions = inlining.getStatementExpressions(body)
+        self.selfTailCalls = tail_calls.getTailCalls(func, body) if self.tailCalls else set()
+        self.functionStart = Label()
+        self.uninitializedLocals = []
+        script = []
+        if body.block_items != None:
+            for node in body.block_items:
+                script += self.compileNode(node)
+        if any(type(cmd) == Command and self.functionStart in cmd.parameters for cmd in script):
+            # A real call would start with fresh locals, so ones that are
+            # declared without a value are zeroed every time round
+            script = [self.functionStart] + self.compileResets(self.uninitializedLocals) + script
+        if self.profileGenerate:
+            script = self.compileProbe(profiling.PROBE_CALL, 0) + script
+        script.insert(0, Command(2, [argCount, len(self.localVars)]))
+        script.append(Command(3))
+        return script
+
+    # Make the function named name with the prepared body the one profile
+    # probes and counts are for
+    def useProfileOf(self, name, body):
+        if not self.profileGenerate and self.profile == None:
+            return
+        fingerprint = hashlib.sha256(getNodeFingerprint(body).encode('utf-8')).hexdigest()
+        self.profileFunction = (name, fingerprint)
+        self.profileSites = profiling.getProfileSites(body)
+        self.functionProfile = self.profile.getFunction(name, fingerprint) if self.profile != None else None
+
+    # Commands that pass the probe's id, and the variable if there is one, to
+    # the profiling syscall
+    def compileProbe(self, kind, ordinal, variable=None):
+        probeId = len(self.profileProbes)
+        self.profileProbes.append(self.profileFunction + (kind, ordinal))
+        nodeOut = [Command(0xD if probeId <= 0xFFFF and self.usePushShort else 0xA, [probeId], True)]
+        if variable != None:
+            nodeOut.append(Command(0xb, list(variable), True))
+        nodeOut.append(Command(0x2d, [len(nodeOut), profiling.PROFILE_SYSCALL]))
+        return nodeOut
+
+    # Whether an if with an else was profiled to run its true side more often
+    def isTrueSideHotter(self, node):
+        counts = profiling.getBranchCounts(self.functionProfile, self.profileSites.get(id(node)))
+        return node.iffalse != None and counts != None and counts[1] > counts[0] - counts[1]
+
+    # Hash of everything besides a function's own code that can change what
+    # it compiles to, used to key the fragment cache
+    def getEnvironment(self):
+        xmlSyscalls = [(s.name, s.id, [(m.name, m.id) for m in s.methods]) for s in self.xmlInfo.syscalls]
+        environment = (getCompilerVersion(), self.autocast, self.usePushShort,
+                       [rule.__name__ for rule in self.peepholeRules], [irPass.__name__ for irPass in self.irPasses], self.foldConstants, self.reduceStrength,
+                       self.branchConditions, self.switchStrategy, self.shareSlots, self.inlineThreshold, self.tailCalls,
+                       self.profile.digest() if self.profile != None else None,
+                       self.refs.functions, sorted(self.refs.functionTypes.items()),
+                       self.refs.globalVariables, sorted(self.refs.globalVariableTypes.items()),
+                       sorted(self.syscalls.items()), xmlSyscalls, sorted(global_constants.items()))
+        return hashlib.sha256(repr(environment).encode('utf-8')).hexdigest()
+
+    # Compile a function to a relocatable fragment: its commands (labels and
+    # function references unresolved, run through the IR passes and the
+    # peephole optimizer), the strings it uses and the stats of the passes,
+    # the optimizer, constant folding and inlining. Fragments are reused from the cache if neither the function,
+    # the functions inlined into it (dependencies) nor the environment it was
+    # compiled in have changed.
+    def compileFunction(self, func, environment=None, dependencies=()):
+        if self.fragmentCache != None:
+            key = self.fragmentCache.getKey(getNodeFingerprint(func), environment, list(dependencies))
+            fragment = self.fragmentCache.get(key)
+            if fragment != None:
+                return fragment
+        self.scriptStrings = []
+        self.scriptFoldStats = folding.FoldStats()
+        self.scriptInlineStats = inlining.InlineStats()
+        stats = peephole.PeepholeStats()
+        irStats = ir.IRStats()
+        cmds = ir.optimize(self.compileScript(func), Label, self.irPasses, irStats)
+        cmds = peephole.optimize(cmds, self.peepholeRules, stats)
+        if self.shareSlots:
+            cmds = liveness.allocateSlots(cmds)
+        fragment = (cmds, self.scriptStrings, stats, irStats, self.scriptFoldStats, self.scriptInlineStats)
+        if self.fragmentCache != None:
+            self.fragmentCache.put(key, fragment)
+        return fragment
+
+    # Drop the (name, cmds, strings) fragments of functions main can't reach
+    # and renumber the globals so only the ones left in use get an index.
+    # Without a main every function is kept since any of them could be the
+    # entry point.
+    def removeUnusedCode(self, fragments):
+        if not 'main' in self.refs.functions:
+            return fragments
+        reachable = dead_code.getReachableFunctions(dict((name, cmds) for name, cmds, strings in fragments), 'main')
+        fragments = [fragment for fragment in fragments if fragment[0] in reachable]
+        self.refs.functions = [name for name, cmds, strings in fragments]
+
+        usedGlobals = dead_code.getUsedGlobals([cmds for name, cmds, strings in fragments])
+        newIndices = dict((old, new) for new, old in enumerate(usedGlobals))
+        for name, cmds, strings in fragments:
+            dead_code.renumberGlobals(cmds, newIndices)
+        self.refs.globalVariables = [self.refs.globalVariables[i] for i in usedGlobals]
+        return fragments
+
+    # Add a compiled function to the file, moving the strings it uses into the
+    # file's string table. Strings only used by code that was optimized away
+    # are left out.
+    def addScript(self, cmds, strings):
+        for cmd in cmds:
+            if type(cmd) == Command and getattr(cmd, 'isString', False):
+                string = strings[cmd.parameters[0]]
+                if not string in self.msc.strings:
+                    self.msc.strings.append(string)
+                cmd.parameters = [self.msc.strings.index(string)]
+        newScript = MscScript()
+        newScript.cmds = cmds
+        self.msc.scripts.append(newScript)
+
+    # Work out where every command, script and label goes
+    def layoutScripts(self):
+        scriptPositions = []
+        labelPostions = {}
+        namedLabelPositions = []
+        currentPos = 0x10
+        for i,script in enumerate(self.msc.scripts):
+            namedLabelPositions.append({})
+            scriptPositions.append(currentPos)
+            for cmd in script.cmds:
+                if type(cmd) == Command:
+                    cmd.commandPosition = currentPos
+                    currentPos += (0 if cmd.command in [0xFFFE, 0xFFFF] else 1) + getSizeFromFormat(COMMAND_FORMAT[cmd.command])
+                elif type(cmd) == Label:
+                    if cmd.name != None:
+                        namedLabelPositions[i][cmd.name] = currentPos
+                    labelPostions[cmd] = currentPos
+        return scriptPositions, labelPostions, namedLabelPositions
+
+    # Function references are compiled as pushInt since where the function
+    # goes isn't known yet. Any that point below 0x10000 become a pushShort,
+    # which moves everything after them down, so the layout is redone until
+    # nothing else fits. Addresses only ever go down so anything shrunk stays
+    # valid. Returns the layout and how many bytes were saved.
+    def relaxReferences(self):
+        bytesSaved = 0
+        while True:
+            layout = self.layoutScripts()
+            scriptPositions = dict(zip(self.refs.functions, layout[0]))
+            relaxed = False
+            if self.usePushShort:
+                for script in self.msc.scripts:
+                    for cmd in script.cmds:
+                        if (type(cmd) == Command and cmd.command == 0xA and type(cmd.parameters[0]) == str and
+                            cmd.parameters[0] in scriptPositions and scriptPositions[cmd.parameters[0]] <= 0xFFFF):
+                            cmd.command = 0xD
+                            bytesSaved += COMMAND_STRUCTS[0xA].size - COMMAND_STRUCTS[0xD].size
+                            relaxed = True
+            if not relaxed:
+                return layout, bytesSaved
+
+    # Fill in function pointers, labels with locations rather than strings
+    def resolveReferences(self):
+        (scriptPositions, labelPostions, namedLabelPositions), self.relaxedBytes = self.relaxReferences()
+        self.refs.scriptPositions = scriptPositions
+        for j,script in enumerate(self.msc.scripts):
+            for cmd in script.cmds:
+                if type(cmd) == Command:
+                    for i,arg in enumerate(cmd.parameters):
+                        if type(arg) == str:
+                            if arg in namedLabelPositions[j]:
+                                cmd.parameters[i] = namedLabelPositions[j][arg]
+                            else:
+                                cmd.parameters[i] = scriptPositions[self.refs.functions.index(arg)]
+                        elif type(arg) == Label:
+                            cmd.parameters[i] = labelPostions[arg]
+
+    # Assemble the resolved scripts into MSCSB format. The size of the file is
+    # known up front so everything is packed straight into one buffer:
+    #
+    #     header (0x30), scripts, padding, script positions, padding, strings
+    def getBytes(self):
+        codeSize = 0
+        for script in self.msc.scripts:
+            for cmd in script.cmds:
+                if type(cmd) == Command:
+                    codeSize += COMMAND_STRUCTS[cmd.command].size
+
+        # Strings are stored in fixed size slots sized after the longest one
+        encodedStrings = [string.encode('utf-8') for string in self.msc.strings]
+        maxStringLength = max([len(string) for string in encodedStrings] + [0])
+        maxStringLength = alignTo(maxStringLength, 0x10)
+
+        positionsStart = alignTo(MSC_HEADER.size + codeSize, 0x10)
+        stringsStart = alignTo(positionsStart + 4 * len(self.msc.scripts), 0x10)
+        fileBytes = bytearray(stringsStart + maxStringLength * len(encodedStrings))
+
+        entryPoint = 0x10 if not 'main' in self.refs.functions else self.refs.scriptPositions[self.refs.functions.index('main')]
+        self.msc.entryPoint = entryPoint
+        MSC_HEADER.pack_into(fileBytes, 0, MSC_MAGIC, 0x10 + codeSize, entryPoint, len(self.msc.scripts),
+                             0x16, #This probably doesn't matter?
+                             maxStringLength, len(encodedStrings), 0, 0)
+
+        # Write each script
+        pos = MSC_HEADER.size
+        for script in self.msc.scripts:
+            for cmd in script.cmds:
+                if type(cmd) == Command:
+                    pos = cmd.writeInto(fileBytes, pos)
+
+        # Write script positions (may be unused tbh)
+        struct.pack_into('<%iL' % len(self.msc.scripts), fileBytes, positionsStart, *self.refs.scriptPositions)
+
+        # Write the strings, the rest of their slot is already zeroed
+        for i, string in enumerate(encodedStrings):
+            pos = stringsStart + i * maxStringLength
+            fileBytes[pos:pos + len(string)] = string
+
+        return fileBytes
+
+    def compileAST(self, ast):
+        self.refs = FileRefs()
+        self.msc = MscFile()
+        for decl in ast.ext:
+            if isinstance(decl, c_ast.Decl):
+                if decl.init != None:
+                    raise CompilerError("Error at %s: Global Variables cannot have an initial value, instead include the declaration in another function." % str(decl.coord))
+                if decl.name in self.refs.globalVariables:
+                    raise CompilerError("Error at %s: Global variable %s cannot be redeclared." % (str(decl.coord),decl.name))
+                else:
+                    self.refs.globalVariables.append(decl.name)
+                    self.refs.globalVariableTypes[decl.name] = decl.type.type.names[-1]
+            elif isinstance(decl, c_ast.FuncDef):
+                if decl.decl.name in self.refs.functions:
+                    raise CompilerError("Error at %s: Function %s cannot be redeclared." % (str(decl.coord),decl.name))
+                else:
+                    self.refs.functions.append(decl.decl.name)
+                    self.refs.functionTypes[decl.decl.name] = decl.decl.type.type.type.names[0]
+            else:
+                raise CompilerError("Error at %s: unsupported statement, structure or declaration. Use --ignore-invalid to avoid this error." % str(decl.coord))
+
+        self.functionDefs = dict((decl.decl.name, decl) for decl in ast.ext if isinstance(decl, c_ast.FuncDef))
+        callGraph = inlining.getCallGraph(self.functionDefs)
+        self.inlineFunctions = set()
+        self.profileProbes = []
+        # Probes count calls to the function itself, so nothing is inlined
+        # when profiling
+        if self.inlineThreshold > 0 and not self.profileGenerate:
+            self.inlineFunctions = set(name for name, func in self.functionDefs.items()
+                                       if inlining.getNodeSize(func.body) <= self.getInlineThreshold(name) and
+                                       not inlining.isRecursive(callGraph, name) and
+                                       inlining.canInline(func, self.refs.functionTypes[name]))
+        self.inlineBodies = {}
+
+        environment = self.getEnvironment() if self.fragmentCache != None else None
+        self.peepholeStats = peephole.PeepholeStats()
+        self.irStats = ir.IRStats()
+        self.foldStats = folding.FoldStats()
+        self.inlineStats = inlining.InlineStats()
+        fragments = []
+        for decl in ast.ext:
+            if isinstance(decl, c_ast.FuncDef):
+                dependencies = []
+                if environment != None:
+                    inlined = inlining.getReachable(callGraph, decl.decl.name, self.inlineFunctions)
+                    dependencies = [getNodeFingerprint(self.functionDefs[name]) for name in sorted(inlined)]
+                cmds, strings, peepholeStats, irStats, foldStats, inlineStats = self.compileFunction(decl, environment, dependencies)
+                self.peepholeStats.add(peepholeStats)
+                self.irStats.add(irStats)
+                self.foldStats.add(foldStats)
+                self.inlineStats.add(inlineStats)
+                fragments.append((decl.decl.name, cmds, strings))
+        if self.removeUnused:
+            fragments = self.removeUnusedCode(fragments)
+        for name, cmds, strings in fragments:
+            self.addScript(cmds, strings)
+        self.resolveReferences()
+        fileBytes = self.getBytes()
+        if self.costTable != None:
+            self.costAnalysis = cost_analysis.analyzeFile(self.msc, self.refs.functions, self.costTable)
+        return fileBytes
+
+    # Parse and compile from a string, returns the MSCSB file as bytes
+    def compile(self, fileText):
+        start = time.perf_counter()
+        ast = self.parse(fileText)
+        parsed = time.perf_counter()
+        fileBytes = self.compileAST(ast)
+        self.timings = {"parse" : parsed - start, "codegen" : time.perf_counter() - parsed}
+        return fileBytes
+
+    def parse(self, fileText):
+        text = removeComments(fileText)
+        if self.astCache == None:
+            return getParser().parse(text, filename='<none>')
+        key = self.astCache.getKey(text, getCompilerVersion(), pycparser.__version__,
+                                   sorted(global_constants.items()), sorted(self.syscalls.items()))
+        ast = self.astCache.get(key)
+        if ast == None:
+            ast = getParser().parse(text, filename='<none>')
+            self.astCache.put(key, ast)
+        return ast
+
+    def compileFile(self, filepath):
+        with open(filepath, 'r') as f:
+            return self.compile(f.read())
+
+# The mode a new file gets, which can only be read by setting the umask
+def getNewFileMode():
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+# Write to a temporary file and move it over filename, so nothing ever sees
+# a partly written file. The temporary file is only readable by its owner,
+# so it's given the mode of the file it replaces (or a new file's mode).
+def writeToFile(filename, fileBytes):
+    fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
     try:
-        int(s, 0)
-        return True
+        with os.fdopen(fd, 'wb') as f:
+            f.write(fileBytes)
+        mode = os.stat(filename).st_mode & 0o7777 if os.path.exists(filename) else getNewFileMode()
+        os.chmod(tempPath, mode)
+        os.replace(tempPath, filename)
     except:
-        return False
+        os.remove(tempPath)
+        raise
 
-def _RepresentsFloat(s):
+BUILTIN_PREPROCESSOR = 'builtin'
+
+def preprocess(filepath, preprocessor=None, includePaths=None, defines=None, cache=None):
+    return preprocessWithDependencies(filepath, preprocessor, includePaths, defines, cache)[0]
+
+# Line markers (# 12 "file.h" ...) in the output of an external preprocessor
+LINE_MARKER_REGEX = re.compile(r'^#(?:line)? *\d+ +"((?:[^"\\]|\\.)*)"', re.MULTILINE)
+
+# Returns (text, dependencies) where dependencies are the absolute paths of
+# every file read while preprocessing. External preprocessors don't report
+# them so they're taken from the line markers in their output.
+def preprocessWithDependencies(filepath, preprocessor=None, includePaths=None, defines=None, cache=None):
+    if preprocessor == BUILTIN_PREPROCESSOR:
+        return preprocessWithCache(filepath, includePaths, defines, cache)
+
+    includePaths = includePaths if includePaths != None else []
+    defines = defines if defines != None else {}
+    command = ["cpp" if preprocessor == None else preprocessor]
+    command += ['-I' + path for path in includePaths]
+    command += ['-D%s=%s' % (name, value) for name, value in defines.items()]
     try:
-        float(s.rstrip('f'))
-        return True
-    except:
-        return False
+        process = Popen(command + [filepath], stdout=PIPE, stderr=PIPE)
+    except OSError:
+        # No preprocessor installed, the best we can do is strip comments
+        with open(filepath, 'r') as f:
+            return removeComments(f.read()), [os.path.abspath(filepath)]
+    (output, err) = process.communicate()
+    if process.returncode != 0:
+        raise PreprocessorError("%s failed on %s:\n%s" % (command[0], filepath, err.decode('latin8')))
+    text = output.decode('latin8').replace('\r\n', '\n')
+    dependencies = [os.path.abspath(filepath)]
+    for name in dict.fromkeys(LINE_MARKER_REGEX.findall(text)):
+        # Skip cpp's pseudo files like <built-in> and <command-line>
+        path = os.path.abspath(name.replace('\\\\', '\\'))
+        if not path in dependencies and os.path.isfile(path):
+            dependencies.append(path)
+    return text, dependencies
 
-# Write as MSCSB format
-def writeToFile(msc):
-    global refs, args
-    currentPos = 0x10
-    for script in msc.scripts:
-        currentPos += script.size()
-
-    # Calculate string buffer size based on the longest string
-    maxStringLength = 0
-    for string in msc.strings:
-        if len(string) > maxStringLength:
-            maxStringLength = len(string)
-    if maxStringLength % 0x10 != 0:
-        maxStringLength += 0x10 - (maxStringLength % 0x10)
-
-    # Write file header
-    fileBytes = MSC_MAGIC
-    fileBytes += struct.pack('<L', currentPos)
-    fileBytes += struct.pack('<L', 0x10 if not 'main' in refs.functions else refs.scriptPositions[refs.functions.index('main')])
-    fileBytes += struct.pack('<L', len(msc.scripts))
-    fileBytes += struct.pack('<L', 0x16)#This probably doesn't matter?
-    fileBytes += struct.pack('<L', maxStringLength)
-    fileBytes += struct.pack('<L', len(msc.strings))
-    fileBytes += struct.pack('<L', 0)
-    fileBytes += struct.pack('<L', 0)
-    fileBytes += b'\x00' * 0x10
-
-    # Write each script
+def getCompilerOptions(args):
+    return {
+        "autocast" : args.autocast,
+        "usePushShort" : args.usePushShort,
+        "astCache" : AstCache(getCacheDir('ast'), args.astCacheSize * 1024 * 1024) if args.useAstCache else None,
+        "fragmentCache" : FragmentCache(getCacheDir('functions'), args.astCacheSize * 1024 * 1024) if args.incremental else None,
+        "peepholeRules" : None if args.peephole else [],
+        "irPasses" : getIRPasses(args),
+        "foldConstants" : args.foldConstants,
+        "reduceStrength" : args.reduceStrength,
+        "branchConditions" : args.branchConditions,
+        "switchStrategy" : args.switchStrategy,
+        "shareSlots" : args.shareSlots,
+        "inlineThreshold" : args.inlineThreshold,
+        "removeUnused" : args.removeUnused,
+        "tailCalls" : args.tailCalls,
+        "profileGenerate" : args.profileGenerate,
+        "costTable" : getCostTable(args)
+    }
+
+def getIRPasses(args):
+    if not args.irPasses:
+        return []
+    return [irPass for irPass in ir.DEFAULT_PASSES if not irPass.__name__ in args.disabledIRPasses]
+
+def getCostTable(args):
+    if not args.costReport:
+        return None
+    return cost_analysis.loadCostTable(args.costTable) if args.costTable != None else cost_analysis.DEFAULT_COSTS
+
+def getProfileOptions(args):
+    return {
+        "use" : args.profileUse,
+        "path" : args.profileFile,
+        "frames" : args.profileFrames
+    }
+
+# The profile made for or used by the output filename
+def getProfileFilename(filename, profileOptions):
+    if profileOptions.get("path") != None:
+        return profileOptions["path"]
+    return os.path.splitext(filename)[0] + profiling.PROFILE_EXTENSION
+
+def getPreprocessorOptions(args):
+    defines = {}
+    for define in args.defines:
+        name, _, value = define.partition('=')
+        defines[name] = value if value != '' else '1'
+    cache = None
+    if args.preprocessor == BUILTIN_PREPROCESSOR and args.usePreprocessorCache:
+        cache = PreprocessorCache(getCacheDir('preprocessor'))
+    return {
+        "preprocessor" : args.preprocessor,
+        "includePaths" : args.includePaths,
+        "defines" : defines,
+        "cache" : cache
+    }
+
+def getOutputFilename(file, args):
+    if args.filename != None:
+        return args.filename
+    if file == '-':
+        return 'output.mscsb'
+    return os.path.basename(os.path.splitext(file)[0]) + '.mscsb'
+
+# Number of instructions and bytes of code in a compiled file
+def getCodeSize(msc):
+    instructions = 0
+    size = 0
     for script in msc.scripts:
-        for cmd in script:
+        for cmd in script.cmds:
             if type(cmd) == Command:
-                for i in range(len(cmd.parameters)):
-                    if type(cmd.parameters[i]) == float:
-                        cmd.parameters[i] = struct.unpack('>L', struct.pack('>f', cmd.parameters[i]))[0]
-                fileBytes += cmd.write()
-
-    # Write padding
-    if len(fileBytes) % 0x10 != 0:
-        fileBytes += b'\x00' * (0x10 - (len(fileBytes) % 0x10))
-
-    # Write script positions (may be unused tbh)
-    for i in range(len(msc.scripts)):
-        fileBytes += struct.pack('<L',refs.scriptPositions[i])
-
-    # Write more padding
-    if len(fileBytes) % 0x10 != 0:
-        fileBytes += b'\x00' * (0x10 - (len(fileBytes) % 0x10))
-
-    # Write the strings (+ padding)
-    for string in msc.strings:
-        fileBytes += string.encode('utf-8')
-        fileBytes += b'\x00' * (maxStringLength - len(string))
-
-    # Write to file
-    filename = 'output.mscsb' if args.filename == None else args.filename
-    with open(filename, 'wb') as f:
-        f.write(fileBytes)
-
-def compileAST(ast):
-    global args, msc, refs
-    refs = FileRefs()
-    msc = MscFile()
-    for decl in ast.ext:
-        if isinstance(decl, c_ast.Decl):
-            if decl.init != None:
-                raise CompilerError("Error at %s: Global Variables cannot have an initial value, instead include the declaration in another function." % str(decl.coord))
-            if decl.name in refs.globalVariables:
-                raise CompilerError("Error at %s: Global variable %s cannot be redeclared." % (str(decl.coord),decl.name))
-            else:
-                refs.globalVariables.append(decl.name)
-                refs.globalVariableTypes[decl.name] = decl.type.type.names[-1]
-        elif isinstance(decl, c_ast.FuncDef):
-            if decl.decl.name in refs.functions:
-                raise CompilerError("Error at %s: Function %s cannot be redeclared." % (str(decl.coord),decl.name))
-            else:
-                refs.functions.append(decl.decl.name)
-                refs.functionTypes[decl.decl.name] = decl.decl.type.type.type.names[0]
-        else:
-            raise CompilerError("Error at %s: unsupported statement, structure or declaration. Use --ignore-invalid to avoid this error." % str(decl.coord))
-
-    for decl in ast.ext:
-        if isinstance(decl, c_ast.FuncDef):
-            newScript = MscScript()
-            newScript.cmds = compileScript(decl)
-            msc.scripts.append(newScript)
-    resolveReferences(msc)
-    writeToFile(msc)
-
-# Parse and compile from a string
-def compileString(fileText):
-    global args, msc, refs
-    parser = c_parser.CParser()
-    text = removeComments(fileText)
-    ast = parser.parse(text, filename='<none>')
-    compileAST(ast)
-
-def compileFile(filepath):
-    with open(filepath, 'r') as f:
-        return compileString(f.read())
-
-def preprocess(filepath):
-    global args
+                instructions += 1
+                size += COMMAND_STRUCTS[cmd.command].size
+    return instructions, size
+
+def getReports(args):
+    return [report for report, enabled in [("fold", args.foldReport), ("peephole", args.peepholeReport),
+                                           ("ir", args.irReport), ("inline", args.inlineReport),
+                                           ("relax", args.relaxReport), ("cost", args.costReport)] if enabled]
+
+# Print what the optimizations did in the last compile
+def printReports(file, compiler, reports):
+    if "fold" in reports:
+        print("%s: constant folding\n%s" % (file, str(compiler.foldStats)))
+    if "peephole" in reports:
+        print("%s: peephole optimizer\n%s" % (file, str(compiler.peepholeStats)))
+    if "ir" in reports:
+        print("%s: IR passes\n%s" % (file, str(compiler.irStats)))
+    if "inline" in reports:
+        print("%s: %s" % (file, str(compiler.inlineStats)))
+    if "relax" in reports:
+        print("%s: %i bytes saved by shortening function references" % (file, compiler.relaxedBytes))
+    if "cost" in reports:
+        print("%s: static cost\n%s" % (file, cost_analysis.formatReport(compiler.costAnalysis)))
+    if len(reports) > 0:
+        print("%s: %i instructions, %i bytes of code" % ((file,) + getCodeSize(compiler.msc)))
+
+# Compile a single file with an existing compiler, returns the time taken.
+# With profiling on the output is run and the profile is saved next to it.
+def compileToFile(compiler, file, filename, preprocessorOptions=None, reports=None, profileOptions=None):
+    preprocessorOptions = preprocessorOptions if preprocessorOptions != None else {}
+    reports = reports if reports != None else []
+    profileOptions = profileOptions if profileOptions != None else {}
+    start = time.perf_counter()
+    profilePath = getProfileFilename(filename, profileOptions)
+    if profileOptions.get("use", False):
+        compiler.profile = profiling.Profile.load(profilePath)
+    writeToFile(filename, compiler.compile(preprocess(file, **preprocessorOptions)))
+    if compiler.profileGenerate:
+        warn = lambda message: sys.stderr.write("Warning: %s: %s\n" % (file, message))
+        profiling.generateProfile(compiler, profileOptions.get("frames", profiling.PROFILE_FRAMES), warn=warn).save(profilePath)
+    printReports(file, compiler, reports)
+    return time.perf_counter() - start
+
+# Each worker process of a batch build keeps its own compiler so the xml info
+# only has to be parsed once per worker rather than once per file
+_workerCompiler = None
+
+def _initWorker(xmlPath, compilerOptions):
+    global _workerCompiler
+    _workerCompiler = Compiler(MscXmlInfo(xmlPath), **compilerOptions)
+
+def _compileInWorker(file, filename, preprocessorOptions, reports, profileOptions):
+    return compileToFile(_workerCompiler, file, filename, preprocessorOptions, reports, profileOptions)
+
+# Compile every file to its own output, returns a list of (file, seconds, error)
+def compileFiles(args, xmlPath):
+    results = []
+    preprocessorOptions = getPreprocessorOptions(args)
+    profileOptions = getProfileOptions(args)
+    if args.jobs == 1 or len(args.files) == 1:
+        compiler = Compiler(MscXmlInfo(xmlPath), **getCompilerOptions(args))
+        for file in args.files:
+            try:
+                results.append((file, compileToFile(compiler, file, getOutputFilename(file, args), preprocessorOptions, getReports(args), profileOptions), None))
+            except Exception as e:
+                results.append((file, 0.0, e))
+    else:
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_initWorker, initargs=(xmlPath, getCompilerOptions(args))) as executor:
+            futures = [(file, executor.submit(_compileInWorker, file, getOutputFilename(file, args), preprocessorOptions, getReports(args), profileOptions)) for file in args.files]
+            for file, future in futures:
+                try:
+                    results.append((file, future.result(), None))
+                except Exception as e:
+                    results.append((file, 0.0, e))
+    return results
+
+# How often watch mode checks for changed files, and how long they have to
+# stay unchanged before rebuilding so a save that writes several files (or
+# one file in several steps) only triggers a single build
+WATCH_POLL_INTERVAL = 0.2
+WATCH_DEBOUNCE = 0.1
+
+def getModifiedTimes(paths):
+    times = {}
+    for path in paths:
+        try:
+            times[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            # Missing files (mid save or deleted) count as a change too
+            times[path] = None
+    return times
+
+# Compile a single file for watch mode, returns (timings, dependencies)
+def compileWatched(compiler, file, filename, preprocessorOptions):
+    start = time.perf_counter()
+    text, dependencies = preprocessWithDependencies(file, **preprocessorOptions)
+    timings = {"preprocess" : time.perf_counter() - start}
+    fileBytes = compiler.compile(text)
+    timings.update(compiler.timings)
+    writeStart = time.perf_counter()
+    writeToFile(filename, fileBytes)
+    timings["write"] = time.perf_counter() - writeStart
+    return timings, dependencies
+
+# Build every file, then keep rebuilding the ones affected by changes to them
+# or anything they #include until interrupted. A single compiler is kept for
+# the whole session so rebuilds reuse its parser and in memory caches.
+def watchFiles(args, xmlPath):
+    compiler = Compiler(MscXmlInfo(xmlPath), **getCompilerOptions(args))
+    preprocessorOptions = getPreprocessorOptions(args)
+    # Files each input depends on, known after its first successful build
+    dependencies = {file : [os.path.abspath(file)] for file in args.files}
+
+    def build(files):
+        start = time.perf_counter()
+        totals = {}
+        failed = 0
+        for file in files:
+            try:
+                timings, fileDependencies = compileWatched(compiler, file, getOutputFilename(file, args), preprocessorOptions)
+            except Exception as e:
+                failed += 1
+                sys.stderr.write("Error compiling %s: %s\n" % (file, str(e)))
+                continue
+            dependencies[file] = fileDependencies
+            printReports(file, compiler, getReports(args))
+            for phase, seconds in timings.items():
+                totals[phase] = totals.get(phase, 0.0) + seconds
+        print("[%s] Built %i/%i file(s) in %.1fms%s" %
+              (time.strftime('%H:%M:%S'), len(files) - failed, len(files),
+               (time.perf_counter() - start) * 1000, " (%s)" % formatTimings(totals) if totals else ""))
+        sys.stdout.flush()
+
+    def getWatchedPaths():
+        return set(path for paths in dependencies.values() for path in paths)
+
+    build(args.files)
+    modifiedTimes = getModifiedTimes(getWatchedPaths())
+    print("Watching %i file(s) for changes, press ctrl+c to stop" % len(modifiedTimes))
+    sys.stdout.flush()
     try:
-        process = Popen(["cpp" if args.preprocessor == None else args.preprocessor, filepath], stdout=PIPE)
-        (output, err) = process.communicate()
-        exit_code = process.wait()
-        if output != None:
-            output = output.decode('latin8').replace('\r\n', '\n')
-            return output
-    except:
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            latest = getModifiedTimes(modifiedTimes)
+            if latest == modifiedTimes:
+                continue
+            while True:
+                time.sleep(WATCH_DEBOUNCE)
+                current = getModifiedTimes(modifiedTimes)
+                if current == latest:
+                    break
+                latest = current
+
+            changed = set(path for path in modifiedTimes if latest[path] != modifiedTimes[path])
+            build([file for file in args.files if any(path in changed for path in dependencies[file])])
+
+            # Files changed during the build still differ from latest and get
+            # picked up on the next poll, newly included files start watched
+            # from their current state
+            watchedPaths = getWatchedPaths()
+            modifiedTimes = {path : latest[path] for path in watchedPaths if path in latest}
+            modifiedTimes.update(getModifiedTimes(watchedPaths - set(latest)))
+    except KeyboardInterrupt:
         pass
+    return 0
 
-    with open(filepath, 'r') as f:
-        return removeComments(f.read())
+def getSocketPath(args):
+    return args.socketPath if args.socketPath != None else os.path.join(getCacheDir(), 'server.sock')
+
+def formatTimings(timings):
+    return ', '.join("%s %.1fms" % (phase, timings[phase] * 1000)
+                     for phase in ("preprocess", "parse", "codegen", "write") if phase in timings)
+
+# Handler for requests to the compile server (see server.py). Requests either
+# give the path of a file to compile or send the source in the payload, which
+# is preprocessed with the builtin preprocessor since there is no file for an
+# external one to read. Each connection's thread gets its own compiler.
+def getServerHandler(args, xmlPath):
+    xmlInfo = MscXmlInfo(xmlPath)
+    preprocessorOptions = getPreprocessorOptions(args)
+    compilers = threading.local()
+
+    def handleRequest(request, payload):
+        compiler = getattr(compilers, 'compiler', None)
+        if compiler == None:
+            compiler = compilers.compiler = Compiler(xmlInfo, **getCompilerOptions(args))
+        start = time.perf_counter()
+        if "path" in request:
+            text = preprocess(request["path"], **preprocessorOptions)
+        else:
+            preprocessor = Preprocessor(preprocessorOptions["includePaths"], preprocessorOptions["defines"])
+            text = preprocessor.preprocessString(payload.decode('utf-8'), request.get("filename", "<none>"))
+        preprocessed = time.perf_counter()
+        try:
+            fileBytes = compiler.compile(text)
+        except Exception as e:
+            return {"ok" : False, "error" : str(e)}, b''
+        timings = dict(compiler.timings)
+        timings["preprocess"] = preprocessed - start
+        return {"ok" : True, "timings" : timings}, fileBytes
+
+    return handleRequest
+
+# Compile files through a running server, returns a list of (file, seconds, error)
+def compileWithServer(args):
+    requests = []
+    for file in args.files:
+        if file == '-':
+            requests.append(({"filename" : "<stdin>"}, sys.stdin.read().encode('utf-8')))
+        else:
+            requests.append(({"path" : os.path.abspath(file)}, b''))
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    results = []
+    for file, (header, fileBytes, roundTrip) in zip(args.files, server.sendRequests(getSocketPath(args), requests, jobs)):
+        if not header["ok"]:
+            results.append((file, roundTrip, CompilerError(header["error"])))
+            continue
+        writeStart = time.perf_counter()
+        writeToFile(getOutputFilename(file, args), fileBytes)
+        header["timings"]["write"] = time.perf_counter() - writeStart
+        print("%s: %.1fms (%s)" % (file, roundTrip * 1000, formatTimings(header["timings"])))
+        results.append((file, roundTrip, None))
+    return results
 
 # Compile contents of the file to a string
-def main(arguments):
-    global args, xmlInfo
-    args = arguments
+def main(args):
     # Use path passed by argument if it exists,
     # else use the path found from getXmlInfoPath()
     # if no XmlInfo file is found, xmlPath will be None
     # MscXmlInfo(None) (aka filename=None) will be an empty MscXmlInfo object
     xmlPath = args.xmlPath if args.xmlPath != None else getXmlInfoPath()
-    xmlInfo = MscXmlInfo(xmlPath)
-    for s in xmlInfo.syscalls:
-        syscalls[s.name] = s.id
-    for file in args.files:
-        if args.filename == None:
-            args.filename = os.path.basename(os.path.splitext(file)[0]) + '.mscsb'
-        compileString(preprocess(file))
+    if (args.profileGenerate or args.profileUse) and (args.server or args.connect or args.watch):
+        sys.stderr.write("Error: -fprofile-generate and -fprofile-use can't be used with --server, --connect or --watch\n")
+        return 1
+    if args.server:
+        try:
+            server.serve(getSocketPath(args), getServerHandler(args, xmlPath))
+        except server.ServerError as e:
+            sys.stderr.write("Error: %s\n" % str(e))
+            return 1
+        return 0
+    if len(args.files) == 0:
+        sys.stderr.write("Error: no input files\n")
+        return 1
+    if args.filename != None and len(args.files) > 1:
+        sys.stderr.write("Error: -o can only be used when compiling a single file\n")
+        return 1
+
+    if args.watch:
+        if args.connect or '-' in args.files:
+            sys.stderr.write("Error: --watch can't be used with --connect or stdin input\n")
+            return 1
+        return watchFiles(args, xmlPath)
+
+    start = time.perf_counter()
+    try:
+        results = compileWithServer(args) if args.connect else compileFiles(args, xmlPath)
+    except server.ServerError as e:
+        sys.stderr.write("Error: %s\n" % str(e))
+        return 1
+    wallTime = time.perf_counter() - start
+
+    failed = 0
+    for file, seconds, error in results:
+        if error != None:
+            failed += 1
+            sys.stderr.write("Error compiling %s: %s\n" % (file, str(error)))
+    if len(args.files) > 1:
+        compileTime = sum(seconds for _, seconds, _ in results)
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        print("Compiled %i/%i files with %i job(s) in %.2fs (%.2fs compiling, %.1fms per file)" %
+              (len(results) - failed, len(results), min(jobs, len(args.files)), wallTime, compileTime,
+               1000 * compileTime / max(len(results) - failed, 1)))
+    return 1 if failed else 0
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Compile msC to MSC bytecode")
-    parser.add_argument('files', metavar='files', type=str, nargs='+',
-                        help='files to compile')
-    parser.add_argument('-o', dest='filename', help='Filename to output to')
-    parser.add_argument('-pp', dest='preprocessor', help='Preprocessor to use')
+    parser.add_argument('files', metavar='files', type=str, nargs='*',
+                        help='files to compile (- reads from stdin with --connect)')
+    parser.add_argument('-o', dest='filename', help='Filename to output to (only valid with a single input file)')
+    parser.add_argument('-pp', dest='preprocessor', help='Preprocessor to use (\'builtin\' to preprocess without an external program)')
+    parser.add_argument('-I', dest='includePaths', action='append', default=[], help='Add a directory to search for #include files')
+    parser.add_argument('-D', dest='defines', action='append', default=[], help='Define a macro (NAME or NAME=VALUE)')
+    parser.add_argument('--no-pp-cache', dest='usePreprocessorCache', action='store_false', help='Don\'t cache the output of the builtin preprocessor')
     parser.add_argument('-a', '--autocast', dest='autocast', action='store_true', help='Autocast between int and float types when relevant (Note: don\'t use with decompiled files)')
     parser.add_argument('-i', '--pushInt', dest='usePushShort', action='store_false', help='Disable using pushShort as a space saver')
     parser.add_argument('-x', '--xmlPath', dest='xmlPath', help="Path to load overload MSC xml info")
-    main(parser.parse_args())
+    parser.add_argument('--no-ast-cache', dest='useAstCache', action='store_false', help='Don\'t cache parsed files between runs')
+    parser.add_argument('--no-incremental', dest='incremental', action='store_false', help='Recompile every function instead of reusing unchanged ones from the last build')
+    parser.add_argument('--ast-cache-size', dest='astCacheSize', type=int, default=256, help='Maximum size of the parse and function caches in MB (default 256 each)')
+    parser.add_argument('--no-fold', dest='foldConstants', action='store_false', help='Don\'t fold constant expressions')
+    parser.add_argument('--fold-report', dest='foldReport', action='store_true', help='Print how many expressions were folded and the size of the code')
+    parser.add_argument('--no-strength-reduction', dest='reduceStrength', action='store_false', help='Don\'t turn assignments like x = x + 1 into x++')
+    parser.add_argument('--no-branch-conditions', dest='branchConditions', action='store_false', help='Compile && and || in conditions to a 0 or 1 that is then tested')
+    parser.add_argument('--switch-strategy', dest='switchStrategy', choices=SWITCH_STRATEGIES, default="tree", help='How switch statements find their case, a binary search over the case values (tree) or testing them in order (linear)')
+    parser.add_argument('--no-slot-sharing', dest='shareSlots', action='store_false', help='Give every local variable its own slot instead of reusing slots of variables that are no longer used')
+    parser.add_argument('--inline-threshold', dest='inlineThreshold', type=int, default=INLINE_THRESHOLD, help='Inline calls to functions with at most this many AST nodes, 0 to turn inlining off (default: %i)' % INLINE_THRESHOLD)
+    parser.add_argument('--inline-report', dest='inlineReport', action='store_true', help='Print how many calls were inlined and how much bigger the code got')
+    parser.add_argument('--no-tail-calls', dest='tailCalls', action='store_false', help='Compile functions calling themselves as their last step as calls rather than jumps back to the start')
+    parser.add_argument('--keep-unused', dest='removeUnused', action='store_false', help='Keep functions main never calls or refers to and globals nothing uses')
+    parser.add_argument('--relax-report', dest='relaxReport', action='store_true', help='Print how many bytes were saved by using pushShort for function references')
+    parser.add_argument('--cost-report', dest='costReport', action='store_true', help='Print the maximum stack depth and estimated cost of each function, most expensive first')
+    parser.add_argument('--cost-table', dest='costTable', help='Json file of command names to costs for --cost-report')
+    parser.add_argument('-fprofile-generate', dest='profileGenerate', action='store_true', help='Add profiling probes, run the output on the emulator and save what they counted to a .profile file named after the output')
+    parser.add_argument('-fprofile-use', dest='profileUse', action='store_true', help='Optimize using the profile made by -fprofile-generate')
+    parser.add_argument('--profile-file', dest='profileFile', help='Profile to write or read instead of the one named after the output')
+    parser.add_argument('--profile-frames', dest='profileFrames', type=int, default=profiling.PROFILE_FRAMES, help='Frames to run the main loop for when profiling (default: %i)' % profiling.PROFILE_FRAMES)
+    parser.add_argument('--no-peephole', dest='peephole', action='store_false', help='Don\'t run the peephole optimizer')
+    parser.add_argument('--peephole-report', dest='peepholeReport', action='store_true', help='Print how often each peephole rule applied and how many bytes it saved')
+    parser.add_argument('--no-ir', dest='irPasses', action='store_false', help='Don\'t run any of the passes over the basic blocks of each function')
+    parser.add_argument('--no-ir-pass', dest='disabledIRPasses', action='append', default=[], choices=sorted(ir.PASSES),
+                        help='Don\'t run this pass over the basic blocks of each function (can be given more than once)')
+    parser.add_argument('--ir-report', dest='irReport', action='store_true', help='Print how many changes each pass over the basic blocks made and how long it took')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help='Number of files to compile in parallel (0 uses every cpu)')
+    parser.add_argument('-w', '--watch', dest='watch', action='store_true', help='Rebuild whenever an input file or anything it includes changes')
+    parser.add_argument('--server', dest='server', action='store_true', help='Keep a compiler running and compile files sent to it with --connect')
+    parser.add_argument('--connect', dest='connect', action='store_true', help='Compile using a server started with --server')
+    parser.add_argument('--socket', dest='socketPath', help='Unix socket used by --server and --connect')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,192 @@
+from msc import Command, COMMAND_STRUCTS
+
+# Peephole optimizer for a script's commands before references are resolved,
+# so jumps still point at Label objects rather than offsets. Anything in the
+# stream that isn't a Command is a label.
+#
+# A rule is a function rule(cmds, i, context) which looks at the window of
+# commands starting at cmds[i] and either returns None or (count, replacement)
+# to replace cmds[i:i+count] with the list replacement. Rules are tried in
+# order at every position and the whole pass is repeated until nothing
+# changes, so rules can rely on each other's results.
+
+# Unconditional jumps, control never falls through them
+JUMPS = [0x4, 0x36]
+# Branches taken if the popped condition is false (if) or true (ifNot)
+BRANCHES = [0x34, 0x35]
+# Nothing after these runs unless it's jumped to
+TERMINATORS = JUMPS + [0x6, 0x7]
+
+NOT = 0x2b
+OPPOSITE_BRANCH = {0x34 : 0x35, 0x35 : 0x34}
+# Integer comparisons and their negation, floats aren't included since
+# !(a < b) isn't a >= b when either is NaN
+OPPOSITE_COMPARISON = {
+    0x25 : 0x26,
+    0x26 : 0x25,
+    0x27 : 0x2a,
+    0x2a : 0x27,
+    0x28 : 0x29,
+    0x29 : 0x28
+}
+
+def isCommand(cmd):
+    return type(cmd) == Command
+
+def commandSize(cmds):
+    return sum(COMMAND_STRUCTS[cmd.command].size for cmd in cmds if isCommand(cmd))
+
+# Where every label is and which ones are jumped to (or otherwise used, like
+# the return address pushed by try). Rebuilt before every pass.
+class PeepholeContext:
+    def __init__(self, cmds):
+        self.labelIndex = {}
+        self.referenced = set()
+        for i, cmd in enumerate(cmds):
+            if isCommand(cmd):
+                for param in cmd.parameters:
+                    if not isinstance(param, (int, float, str)):
+                        self.referenced.add(param)
+            else:
+                self.labelIndex[cmd] = i
+
+    # Named labels can be the target of a goto, which refers to them by name
+    def isReferenced(self, label):
+        return label.name != None or label in self.referenced
+
+    # The first command at or after index i, skipping labels
+    def nextCommand(self, cmds, i):
+        while i < len(cmds):
+            if isCommand(cmds[i]):
+                return cmds[i]
+            i += 1
+        return None
+
+    # Follow a label through any chain of unconditional jumps
+    def finalTarget(self, cmds, label):
+        seen = set()
+        while not label in seen and label in self.labelIndex:
+            seen.add(label)
+            cmd = self.nextCommand(cmds, self.labelIndex[label])
+            if cmd == None or not cmd.command in JUMPS or isinstance(cmd.parameters[0], str):
+                break
+            label = cmd.parameters[0]
+        return label
+
+# A jump or branch to a label that just jumps again goes straight to the end
+# of the chain
+def threadJumps(cmds, i, context):
+    cmd = cmds[i]
+    if not isCommand(cmd) or not (cmd.command in JUMPS or cmd.command in BRANCHES):
+        return None
+    target = cmd.parameters[0]
+    if isinstance(target, str):
+        return None
+    finalTarget = context.finalTarget(cmds, target)
+    if finalTarget is target:
+        return None
+    return 1, [Command(cmd.command, [finalTarget], cmd.pushBit)]
+
+# A jump to a label right after it does nothing
+def removeJumpToNext(cmds, i, context):
+    cmd = cmds[i]
+    if not isCommand(cmd) or not cmd.command in JUMPS:
+        return None
+    j = i + 1
+    while j < len(cmds) and not isCommand(cmds[j]):
+        if cmds[j] is cmd.parameters[0]:
+            return 1, []
+        j += 1
+    return None
+
+# not after an integer comparison becomes the opposite comparison
+def foldNotCompare(cmds, i, context):
+    cmd = cmds[i]
+    if not isCommand(cmd) or not cmd.command in OPPOSITE_COMPARISON or not cmd.pushBit or i + 1 >= len(cmds):
+        return None
+    nextCmd = cmds[i + 1]
+    if not isCommand(nextCmd) or nextCmd.command != NOT:
+        return None
+    return 2, [Command(OPPOSITE_COMPARISON[cmd.command], [], nextCmd.pushBit)]
+
+# not followed by a branch becomes the opposite branch
+def invertNotBranch(cmds, i, context):
+    cmd = cmds[i]
+    if not isCommand(cmd) or cmd.command != NOT or not cmd.pushBit or i + 1 >= len(cmds):
+        return None
+    branch = cmds[i + 1]
+    if not isCommand(branch) or not branch.command in BRANCHES:
+        return None
+    return 2, [Command(OPPOSITE_BRANCH[branch.command], list(branch.parameters), branch.pushBit)]
+
+# Nothing between a jump or return and the next label that's used can run.
+# The end of the script is kept since it marks where the script stops.
+def removeDeadCode(cmds, i, context):
+    cmd = cmds[i]
+    if not isCommand(cmd) or not cmd.command in TERMINATORS:
+        return None
+    j = i + 1
+    while j < len(cmds):
+        if isCommand(cmds[j]):
+            if cmds[j].command == 0x3:
+                break
+        elif context.isReferenced(cmds[j]):
+            break
+        j += 1
+    if j == i + 1:
+        return None
+    return j - i, [cmd]
+
+DEFAULT_RULES = [threadJumps, removeJumpToNext, foldNotCompare, invertNotBranch, removeDeadCode]
+
+# Hit counts and bytes saved per rule
+class PeepholeStats:
+    def __init__(self):
+        self.hits = {}
+        self.bytesSaved = {}
+
+    def record(self, ruleName, bytesSaved):
+        self.hits[ruleName] = self.hits.get(ruleName, 0) + 1
+        self.bytesSaved[ruleName] = self.bytesSaved.get(ruleName, 0) + bytesSaved
+
+    def add(self, other):
+        for ruleName, hits in other.hits.items():
+            self.hits[ruleName] = self.hits.get(ruleName, 0) + hits
+            self.bytesSaved[ruleName] = self.bytesSaved.get(ruleName, 0) + other.bytesSaved[ruleName]
+
+    def totalBytesSaved(self):
+        return sum(self.bytesSaved.values())
+
+    def __str__(self):
+        lines = ["%-18s %6i hits %8i bytes saved" % (ruleName, self.hits[ruleName], self.bytesSaved[ruleName])
+                 for ruleName in sorted(self.hits)]
+        lines.append("%-18s %6i hits %8i bytes saved" % ("total", sum(self.hits.values()), self.totalBytesSaved()))
+        return '\n'.join(lines)
+
+# Run the rules over cmds until none of them apply, returns the new list of
+# commands. Labels that nothing refers to anymore are dropped.
+def optimize(cmds, rules=DEFAULT_RULES, stats=None):
+    if stats == None:
+        stats = PeepholeStats()
+    changed = True
+    while changed:
+        changed = False
+        context = PeepholeContext(cmds)
+        out = []
+        i = 0
+        while i < len(cmds):
+            for rule in rules:
+                result = rule(cmds, i, context)
+                if result != None:
+                    count, replacement = result
+                    stats.record(rule.__name__, commandSize(cmds[i:i + count]) - commandSize(replacement))
+                    out += replacement
+                    i += count
+                    changed = True
+                    break
+            else:
+                out.append(cmds[i])
+                i += 1
+        context = PeepholeContext(out)
+        cmds = [cmd for cmd in out if isCommand(cmd) or context.isReferenced(cmd)]
+    return cmds
@@ -0,0 +1,678 @@
+import re
+import os
+import sys
+import json
+import hashlib
+import tempfile
+
+class PreprocessorError(Exception):
+    def __init__(self,*args,**kwargs):
+        Exception.__init__(self,*args,**kwargs)
+
+# Characters that can change the state of the comment stripper, and the
+# characters that can end a string or char literal
+_COMMENT_STATE_CHARS = re.compile('["\'/]')
+_LITERAL_END_CHARS = {
+    '"' : re.compile('[\\\\"\\n]'),
+    "'" : re.compile("[\\\\'\\n]")
+}
+
+# Strip // and /* */ comments in a single pass. Outside of a comment the only
+# interesting characters are quotes (start of a literal, which is skipped as a
+# whole, escapes included) and slashes (possible start of a comment), so the
+# scanner jumps straight between those instead of looking at every character.
+# Block comments are replaced by the newlines they contained (or a space) so
+# tokens aren't joined and line numbers in errors stay correct.
+def removeComments(text):
+    out = []
+    copiedTo = 0
+    pos = 0
+    length = len(text)
+    while True:
+        match = _COMMENT_STATE_CHARS.search(text, pos)
+        if match == None:
+            break
+        pos = match.start()
+        char = text[pos]
+        if char != '/':
+            endChars = _LITERAL_END_CHARS[char]
+            pos += 1
+            while True:
+                match = endChars.search(text, pos)
+                if match == None:
+                    pos = length
+                    break
+                pos = match.end()
+                if match.group() == '\\':
+                    # Skip whatever is escaped
+                    pos += 1
+                else:
+                    # Closing quote, or the newline ending an unterminated literal
+                    break
+        elif text.startswith('//', pos):
+            end = text.find('\n', pos)
+            if end == -1:
+                end = length
+            out.append(text[copiedTo:pos])
+            copiedTo = pos = end
+        elif text.startswith('/*', pos):
+            end = text.find('*/', pos + 2)
+            end = length if end == -1 else end + 2
+            out.append(text[copiedTo:pos])
+            out.append('\n' * text.count('\n', pos, end) or ' ')
+            copiedTo = pos = end
+        else:
+            pos += 1
+    out.append(text[copiedTo:])
+    return ''.join(out)
+
+_TOKEN_REGEX = re.compile(r'''
+     (?P<ws>[ \t\r\f\v]+)
+    |(?P<nl>\n)
+    |(?P<id>[A-Za-z_]\w*)
+    |(?P<num>\.?\d(?:[eEpP][+-]|[\w.])*)
+    |(?P<str>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+    |(?P<punct>\.\.\.|<<=|>>=|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^]=|\#\#|.)
+''', re.X)
+
+class Token:
+    __slots__ = ('kind', 'value', 'space', 'hideset')
+
+    def __init__(self, kind, value, space=False, hideset=frozenset()):
+        self.kind = kind
+        self.value = value
+        # Whether the token had whitespace before it, only matters for #
+        self.space = space
+        # Names of the macros this token came out of, those can't be expanded
+        # again when the token is rescanned
+        self.hideset = hideset
+
+    def copy(self, space=None, hideset=None):
+        return Token(self.kind, self.value,
+                     self.space if space == None else space,
+                     self.hideset if hideset == None else hideset)
+
+    def __repr__(self):
+        return "Token(%s, %r)" % (self.kind, self.value)
+
+def tokenize(text):
+    tokens = []
+    space = False
+    for match in _TOKEN_REGEX.finditer(text):
+        kind = match.lastgroup
+        if kind == 'ws':
+            space = True
+            continue
+        tokens.append(Token(kind, match.group(), space))
+        space = False
+    return tokens
+
+class Macro:
+    def __init__(self, name, params, body, variadic=False):
+        self.name = name
+        # None for object-like macros, a list of names for function-like ones
+        self.params = params
+        self.body = body
+        self.variadic = variadic
+
+def _stringify(tokens):
+    text = ""
+    for i, tok in enumerate(tokens):
+        if i != 0 and tok.space:
+            text += " "
+        if tok.kind == 'str':
+            text += tok.value.replace('\\', '\\\\').replace('"', '\\"')
+        else:
+            text += tok.value
+    return Token('str', '"' + text + '"')
+
+def _parseIntLiteral(value):
+    value = value.rstrip('uUlL')
+    if len(value) > 1 and value[0] == '0' and value[1] not in 'xXbB':
+        return int(value, 8)
+    return int(value, 0)
+
+def _charValue(value):
+    # Only needed for #if, so only simple escapes are supported
+    body = value[1:-1]
+    escapes = {'n' : 10, 't' : 9, 'r' : 13, '0' : 0, '\\' : 92, "'" : 39, '"' : 34, 'a' : 7, 'b' : 8, 'f' : 12, 'v' : 11}
+    if body.startswith('\\'):
+        if body[1:] in escapes:
+            return escapes[body[1:]]
+        if body[1] == 'x':
+            return int(body[2:], 16)
+        return int(body[1:], 8)
+    return ord(body)
+
+def _cDiv(a, b):
+    if b == 0:
+        raise PreprocessorError("Division by zero in #if")
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+_BINARY_PRECEDENCE = {
+    '||' : 1, '&&' : 2, '|' : 3, '^' : 4, '&' : 5,
+    '==' : 6, '!=' : 6,
+    '<' : 7, '<=' : 7, '>' : 7, '>=' : 7,
+    '<<' : 8, '>>' : 8,
+    '+' : 9, '-' : 9,
+    '*' : 10, '/' : 10, '%' : 10
+}
+
+_BINARY_OPERATIONS = {
+    '||' : lambda a, b: int(bool(a) or bool(b)),
+    '&&' : lambda a, b: int(bool(a) and bool(b)),
+    '|'  : lambda a, b: a | b,
+    '^'  : lambda a, b: a ^ b,
+    '&'  : lambda a, b: a & b,
+    '==' : lambda a, b: int(a == b),
+    '!=' : lambda a, b: int(a != b),
+    '<'  : lambda a, b: int(a < b),
+    '<=' : lambda a, b: int(a <= b),
+    '>'  : lambda a, b: int(a > b),
+    '>=' : lambda a, b: int(a >= b),
+    '<<' : lambda a, b: a << b,
+    '>>' : lambda a, b: a >> b,
+    '+'  : lambda a, b: a + b,
+    '-'  : lambda a, b: a - b,
+    '*'  : lambda a, b: a * b,
+    '/'  : _cDiv,
+    '%'  : lambda a, b: a - _cDiv(a, b) * b
+}
+
+# Evaluates the integer constant expression of an #if once macros and
+# defined() have been replaced
+class _ConditionEvaluator:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos].value if self.pos < len(self.tokens) else None
+
+    def next(self):
+        if self.pos >= len(self.tokens):
+            raise PreprocessorError("Unexpected end of #if expression")
+        self.pos += 1
+        return self.tokens[self.pos - 1]
+
+    def expect(self, value):
+        if self.next().value != value:
+            raise PreprocessorError("Expected '%s' in #if expression" % value)
+
+    def evaluate(self):
+        value = self.ternary()
+        if self.pos != len(self.tokens):
+            raise PreprocessorError("Unexpected '%s' in #if expression" % self.peek())
+        return value
+
+    def ternary(self):
+        cond = self.binary(1)
+        if self.peek() == '?':
+            self.next()
+            ifTrue = self.ternary()
+            self.expect(':')
+            ifFalse = self.ternary()
+            return ifTrue if cond else ifFalse
+        return cond
+
+    def binary(self, minPrecedence):
+        left = self.unary()
+        while self.peek() in _BINARY_PRECEDENCE and _BINARY_PRECEDENCE[self.peek()] >= minPrecedence:
+            op = self.next().value
+            right = self.binary(_BINARY_PRECEDENCE[op] + 1)
+            left = _BINARY_OPERATIONS[op](left, right)
+        return left
+
+    def unary(self):
+        tok = self.next()
+        if tok.value == '(':
+            value = self.ternary()
+            self.expect(')')
+            return value
+        elif tok.value == '!':
+            return int(not self.unary())
+        elif tok.value == '~':
+            return ~self.unary()
+        elif tok.value == '-':
+            return -self.unary()
+        elif tok.value == '+':
+            return self.unary()
+        elif tok.kind == 'num':
+            try:
+                return _parseIntLiteral(tok.value)
+            except ValueError:
+                raise PreprocessorError("Invalid integer '%s' in #if expression" % tok.value)
+        elif tok.kind == 'str' and tok.value.startswith("'"):
+            return _charValue(tok.value)
+        raise PreprocessorError("Unexpected '%s' in #if expression" % tok.value)
+
+# A C preprocessor supporting #include, #define (object and function-like,
+# with # and ##), #undef, #if/#ifdef/#ifndef/#elif/#else/#endif, #error and
+# #pragma once. Used in place of an external cpp so no subprocess is needed.
+class Preprocessor:
+    MAX_INCLUDE_DEPTH = 200
+
+    def __init__(self, includePaths=None, defines=None):
+        self.includePaths = list(includePaths) if includePaths != None else []
+        self.macros = {}
+        for name, value in (defines if defines != None else {}).items():
+            self.define(name, value)
+        # Every file read while preprocessing, including the main file
+        self.dependencies = []
+        self._onceFiles = set()
+        self._includeDepth = 0
+
+    def define(self, name, value="1"):
+        self.macros[name] = Macro(name, None, tokenize(str(value)))
+
+    def preprocessFile(self, filepath):
+        out = []
+        self._processFile(os.path.abspath(filepath), out)
+        return ''.join(out)
+
+    # Includes are searched for relative to currentDir, or the directory of
+    # filename if it isn't given
+    def preprocessString(self, text, filename='<none>', currentDir=None):
+        if currentDir == None:
+            currentDir = os.path.dirname(os.path.abspath(filename)) if filename != '<none>' else os.getcwd()
+        out = []
+        self._processText(text, filename, currentDir, out)
+        return ''.join(out)
+
+    def _findInclude(self, name, currentDir, isQuoted):
+        searchPaths = ([currentDir] if isQuoted else []) + self.includePaths
+        for path in searchPaths:
+            fullPath = os.path.abspath(os.path.join(path, name))
+            if os.path.isfile(fullPath):
+                return fullPath
+        return None
+
+    def _processFile(self, filepath, out):
+        if filepath in self._onceFiles:
+            return
+        if self._includeDepth > Preprocessor.MAX_INCLUDE_DEPTH:
+            raise PreprocessorError("#include nested too deeply in %s" % filepath)
+        if not filepath in self.dependencies:
+            self.dependencies.append(filepath)
+        with open(filepath, 'r') as f:
+            text = f.read()
+        self._includeDepth += 1
+        try:
+            self._processText(text, filepath, os.path.dirname(filepath), out)
+        finally:
+            self._includeDepth -= 1
+
+    def _processText(self, text, filename, currentDir, out):
+        # Join lines ending in a backslash, keeping track of which source line
+        # each logical line started on
+        lines = []
+        physicalLines = removeComments(text.replace('\r\n', '\n')).split('\n')
+        if physicalLines[-1] == '':
+            physicalLines.pop()
+        i = 0
+        while i < len(physicalLines):
+            start = i
+            line = physicalLines[i]
+            while line.endswith('\\') and i + 1 < len(physicalLines):
+                i += 1
+                line = line[:-1] + physicalLines[i]
+            lines.append((start + 1, line))
+            i += 1
+
+        # Stack of [parentActive, anyBranchTaken, seenElse] for each open #if
+        conditions = []
+        active = True
+        # Source line the next line of output corresponds to, None when a line
+        # marker is needed before any more output
+        outputLine = [None]
+        chunk = []
+
+        def flushChunk():
+            if all(line.strip() == '' for _, line in chunk):
+                # Nothing worth outputting, a line marker before the next
+                # output will take care of the line numbers
+                del chunk[:]
+                return
+            startLine = chunk[0][0]
+            if outputLine[0] != startLine:
+                out.append('# %i "%s"\n' % (startLine, filename))
+            text = self._render(self._expand(tokenize('\n'.join(line for _, line in chunk) + '\n'), filename))
+            out.append(text)
+            outputLine[0] = startLine + text.count('\n')
+            del chunk[:]
+
+        for lineNumber, line in lines:
+            stripped = line.lstrip()
+            if not stripped.startswith('#'):
+                if active:
+                    chunk.append((lineNumber, line))
+                continue
+            flushChunk()
+            where = "%s:%i" % (filename, lineNumber)
+            match = re.match(r'#\s*(\w*)(.*)$', stripped)
+            directive, rest = match.group(1), match.group(2).strip()
+
+            if directive in ('if', 'ifdef', 'ifndef'):
+                if not active:
+                    conditions.append([False, True, False])
+                else:
+                    if directive == 'if':
+                        value = self._evaluateCondition(rest, where)
+                    else:
+                        value = (rest.split()[0] in self.macros) if rest else False
+                        if directive == 'ifndef':
+                            value = not value
+                    conditions.append([True, value, False])
+                    active = value
+                continue
+            elif directive in ('elif', 'else', 'endif'):
+                if len(conditions) == 0:
+                    raise PreprocessorError("%s: #%s without #if" % (where, directive))
+                parentActive, taken, seenElse = conditions[-1]
+                if directive == 'endif':
+                    # Whatever was active before the #if is active again
+                    conditions.pop()
+                    active = parentActive
+                    continue
+                if seenElse:
+                    raise PreprocessorError("%s: #%s after #else" % (where, directive))
+                if directive == 'else':
+                    conditions[-1][2] = True
+                    active = parentActive and not taken
+                    conditions[-1][1] = True
+                else:
+                    if parentActive and not taken:
+                        active = self._evaluateCondition(rest, where)
+                        conditions[-1][1] = active
+                    else:
+                        active = False
+                continue
+
+            if not active:
+                continue
+
+            if directive == 'define':
+                self._define(rest, where)
+            elif directive == 'undef':
+                self.macros.pop(rest.split()[0] if rest else '', None)
+            elif directive == 'include':
+                self._include(rest, where, currentDir, out)
+                outputLine[0] = None
+            elif directive == 'error':
+                raise PreprocessorError("%s: #error %s" % (where, rest))
+            elif directive == 'warning':
+                sys.stderr.write("%s: warning: %s\n" % (where, rest))
+            elif directive == 'pragma':
+                if rest.strip() == 'once':
+                    self._onceFiles.add(filename)
+            elif directive in ('', 'line'):
+                pass
+            else:
+                raise PreprocessorError("%s: Unknown preprocessor directive #%s" % (where, directive))
+        flushChunk()
+        if len(conditions) != 0:
+            raise PreprocessorError("%s: Unterminated #if" % filename)
+
+    def _include(self, rest, where, currentDir, out):
+        if not rest.startswith(('"', '<')):
+            # Computed include, expand macros first
+            rest = self._render(self._expand(tokenize(rest), where)).strip()
+        match = re.match(r'(?:"([^"]+)"|<([^>]+)>)', rest)
+        if match == None:
+            raise PreprocessorError("%s: Invalid #include %s" % (where, rest))
+        name = match.group(1) or match.group(2)
+        path = self._findInclude(name, currentDir, match.group(1) != None)
+        if path == None:
+            raise PreprocessorError("%s: Include file %s not found" % (where, name))
+        self._processFile(path, out)
+
+    def _define(self, rest, where):
+        match = re.match(r'([A-Za-z_]\w*)(\()?', rest)
+        if match == None:
+            raise PreprocessorError("%s: Invalid macro name in #define" % where)
+        name = match.group(1)
+        if match.group(2) != None:
+            end = rest.find(')', match.end())
+            if end == -1:
+                raise PreprocessorError("%s: Missing ')' in parameter list of macro %s" % (where, name))
+            params = [p.strip() for p in rest[match.end():end].split(',') if p.strip() != '']
+            variadic = len(params) > 0 and params[-1] == '...'
+            if variadic:
+                params[-1] = '__VA_ARGS__'
+            body = tokenize(rest[end + 1:])
+            self.macros[name] = Macro(name, params, body, variadic)
+        else:
+            self.macros[name] = Macro(name, None, tokenize(rest[match.end():]))
+
+    def _evaluateCondition(self, text, where):
+        tokens = tokenize(text)
+        # Replace defined X and defined(X) before expanding anything
+        replaced = []
+        i = 0
+        while i < len(tokens):
+            if tokens[i].value == 'defined':
+                if i + 1 < len(tokens) and tokens[i + 1].value == '(':
+                    if i + 3 >= len(tokens) or tokens[i + 3].value != ')':
+                        raise PreprocessorError("%s: Invalid use of defined" % where)
+                    name = tokens[i + 2].value
+                    i += 4
+                elif i + 1 < len(tokens):
+                    name = tokens[i + 1].value
+                    i += 2
+                else:
+                    raise PreprocessorError("%s: Invalid use of defined" % where)
+                replaced.append(Token('num', '1' if name in self.macros else '0'))
+            else:
+                replaced.append(tokens[i])
+                i += 1
+        expanded = []
+        for tok in self._expand(replaced, where):
+            # Identifiers left after expansion evaluate to 0
+            expanded.append(Token('num', '0') if tok.kind == 'id' else tok)
+        try:
+            return _ConditionEvaluator(expanded).evaluate() != 0
+        except PreprocessorError as e:
+            raise PreprocessorError("%s: %s" % (where, str(e)))
+
+    # Expand every macro in a list of tokens. The tokens still to be scanned
+    # are kept reversed so the result of an expansion can be pushed back and
+    # rescanned together with whatever follows it.
+    def _expand(self, tokens, where):
+        out = []
+        pending = tokens[::-1]
+        while len(pending) > 0:
+            tok = pending.pop()
+            if tok.kind != 'id' or not tok.value in self.macros or tok.value in tok.hideset:
+                out.append(tok)
+                continue
+            macro = self.macros[tok.value]
+            if macro.params == None:
+                replacement = self._substitute(macro, {}, tok.hideset | {macro.name}, tok.space, where)
+                pending.extend(reversed(replacement))
+                continue
+
+            # Function-like macros are only invoked when followed by a (
+            j = len(pending) - 1
+            while j >= 0 and pending[j].kind == 'nl':
+                j -= 1
+            if j < 0 or pending[j].value != '(':
+                out.append(tok)
+                continue
+            skippedNewlines = len(pending) - 1 - j
+            del pending[j:]
+            args, closeParen, argNewlines = self._collectArgs(pending, macro, where)
+            # Keep the line count the same as the source, the expansion stays
+            # on the line the call started on
+            pending.extend([Token('nl', '\n')] * (skippedNewlines + argNewlines))
+            hideset = (tok.hideset & closeParen.hideset) | {macro.name}
+            replacement = self._substitute(macro, args, hideset, tok.space, where)
+            pending.extend(reversed(replacement))
+        return out
+
+    def _collectArgs(self, pending, macro, where):
+        args = [[]]
+        depth = 0
+        newlines = 0
+        while True:
+            if len(pending) == 0:
+                raise PreprocessorError("%s: Unterminated call to macro %s" % (where, macro.name))
+            tok = pending.pop()
+            if tok.kind == 'nl':
+                newlines += 1
+                continue
+            if tok.value == '(':
+                depth += 1
+            elif tok.value == ')':
+                if depth == 0:
+                    break
+                depth -= 1
+            elif tok.value == ',' and depth == 0 and not (macro.variadic and len(args) >= len(macro.params)):
+                args.append([])
+                continue
+            args[-1].append(tok)
+
+        params = macro.params
+        if len(params) == 0 and args == [[]]:
+            args = []
+        elif macro.variadic and len(args) == len(params) - 1:
+            args.append([])
+        if len(args) != len(params):
+            raise PreprocessorError("%s: Macro %s takes %i argument(s) but %i were given" %
+                                    (where, macro.name, len(params), len(args)))
+        return dict(zip(params, args)), tok, newlines
+
+    def _substitute(self, macro, args, hideset, space, where):
+        body = macro.body
+        result = []
+        expandedArgs = {}
+        # Whether the last thing substituted was an empty argument, which
+        # leaves nothing for a following ## to paste onto
+        placemarker = False
+        i = 0
+        while i < len(body):
+            tok = body[i]
+            if tok.value == '#' and macro.params != None and i + 1 < len(body) and body[i + 1].value in args:
+                result.append(_stringify(args[body[i + 1].value]))
+                placemarker = False
+                i += 2
+                continue
+            if tok.value == '##' and (len(result) > 0 or placemarker) and i + 1 < len(body):
+                # Paste the last token with the first token of what follows
+                i += 1
+                right = body[i]
+                rightTokens = args[right.value] if right.kind == 'id' and right.value in args else [right]
+                if placemarker:
+                    result.extend(rightTokens)
+                    placemarker = len(rightTokens) == 0
+                elif len(rightTokens) > 0:
+                    left = result.pop()
+                    pasted = tokenize(left.value + rightTokens[0].value)
+                    if len(pasted) != 1:
+                        raise PreprocessorError("%s: Pasting '%s' and '%s' doesn't give a valid token" %
+                                                (where, left.value, rightTokens[0].value))
+                    result.append(pasted[0].copy(space=left.space))
+                    result.extend(rightTokens[1:])
+                i += 1
+                continue
+            if tok.kind == 'id' and tok.value in args:
+                nextIsPaste = i + 1 < len(body) and body[i + 1].value == '##'
+                if nextIsPaste:
+                    # Operands of ## aren't expanded
+                    argTokens = args[tok.value]
+                else:
+                    if not tok.value in expandedArgs:
+                        expandedArgs[tok.value] = self._expand(args[tok.value], where)
+                    argTokens = expandedArgs[tok.value]
+                for j, argTok in enumerate(argTokens):
+                    result.append(argTok.copy(space=tok.space) if j == 0 else argTok)
+                placemarker = len(argTokens) == 0
+            else:
+                result.append(tok)
+                placemarker = False
+            i += 1
+        return [t.copy(space=space if j == 0 else None, hideset=t.hideset | hideset) for j, t in enumerate(result)]
+
+    def _render(self, tokens):
+        out = []
+        lineStart = True
+        for tok in tokens:
+            if tok.kind == 'nl':
+                out.append('\n')
+                lineStart = True
+            else:
+                if not lineStart:
+                    out.append(' ')
+                out.append(tok.value)
+                lineStart = False
+        return ''.join(out)
+
+def hashFile(filepath):
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Content addressed cache of preprocessed output. For each main file (and set
+# of include paths/defines) a manifest records the hash of every file that was
+# read while preprocessing it. If all of those still hash the same the stored
+# output is used and preprocessing is skipped entirely.
+class PreprocessorCache:
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _manifestPath(self, filepath, includePaths, defines):
+        includePaths = includePaths if includePaths != None else []
+        defines = defines if defines != None else {}
+        key = json.dumps([PreprocessorCache.VERSION, os.path.abspath(filepath),
+                          [os.path.abspath(p) for p in includePaths], sorted(defines.items())])
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _outputPath(self, outputHash):
+        return os.path.join(self.directory, outputHash + '.i')
+
+    def _writeAtomic(self, path, data):
+        fd, tempPath = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tempPath, path)
+        except:
+            os.remove(tempPath)
+            raise
+
+    # Returns (text, dependencies) or None if there is no valid entry
+    def get(self, filepath, includePaths=None, defines=None):
+        try:
+            with open(self._manifestPath(filepath, includePaths, defines), 'r') as f:
+                manifest = json.load(f)
+            for path, fileHash in manifest["dependencies"]:
+                if hashFile(path) != fileHash:
+                    return None
+            with open(self._outputPath(manifest["output"]), 'rb') as f:
+                return f.read().decode('utf-8'), [path for path, _ in manifest["dependencies"]]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, filepath, text, dependencies, includePaths=None, defines=None):
+        data = text.encode('utf-8')
+        outputHash = hashlib.sha256(data).hexdigest()
+        self._writeAtomic(self._outputPath(outputHash), data)
+        manifest = {
+            "dependencies" : [[path, hashFile(path)] for path in dependencies],
+            "output" : outputHash
+        }
+        self._writeAtomic(self._manifestPath(filepath, includePaths, defines), json.dumps(manifest).encode('utf-8'))
+
+# Preprocess a file with the built in preprocessor, using the cache if one is
+# given. Returns the text and the list of files it depends on.
+def preprocessWithCache(filepath, includePaths=None, defines=None, cache=None):
+    if cache != None:
+        cached = cache.get(filepath, includePaths, defines)
+        if cached != None:
+            return cached
+    preprocessor = Preprocessor(includePaths, defines)
+    text = preprocessor.preprocessFile(filepath)
+    if cache != None:
+        cache.put(filepath, text, preprocessor.dependencies, includePaths, defines)
+    return text, preprocessor.dependencies
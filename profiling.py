@@ -0,0 +1,158 @@
+import json, hashlib
+from pycparser import c_ast
+from msc import ThreadedMscVM, MscVMError, Command, toSigned, VM_INT_OPERATIONS
+
+# Profile guided optimization. A file compiled with profiling on has probes
+# in it, a push of the probe's id (and for switches the value being switched
+# on) followed by a call to PROFILE_SYSCALL, at the start of every function,
+# before and inside the true side of every if and before every switch. It's
+# run on the emulator and what the probes counted is saved as a profile,
+# which a later compile uses to lay out ifs, order switch tests and choose
+# what to inline.
+#
+# Ifs and switches are found in a profile by their function and their
+# position in the function (after folding), a function that changed since
+# its profile was made has its branch and case counts ignored.
+
+# Only the emulator knows this syscall, files compiled with probes aren't
+# meant for the game
+PROFILE_SYSCALL = 0xFF
+PROFILE_EXTENSION = ".profile"
+# Frames to run the main loop (set with set_main) for when profiling, and how
+# many instructions to give up after
+PROFILE_FRAMES = 60
+PROFILE_MAX_INSTRUCTIONS = 10000000
+
+PROBE_CALL = "call"
+PROBE_BRANCH = "branch"
+PROBE_TAKEN = "taken"
+PROBE_SWITCH = "switch"
+
+# Ids of the ifs and switches of a function's body by their position in it
+def getProfileSites(body):
+    sites = {}
+    def visit(node):
+        if isinstance(node, (c_ast.If, c_ast.Switch)):
+            sites[id(node)] = len(sites)
+        for _, child in node.children():
+            visit(child)
+    visit(body)
+    return sites
+
+class Profile:
+    def __init__(self, functions=None, frames=0):
+        # For each function its fingerprint, how many times it was called,
+        # [times reached, times true] for each if and {value : times} for
+        # each switch
+        self.functions = functions if functions != None else {}
+        self.frames = frames
+
+    @staticmethod
+    def load(path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return Profile(data["functions"], data["frames"])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({"functions" : self.functions, "frames" : self.frames}, f, indent=1, sort_keys=True)
+
+    def digest(self):
+        return hashlib.sha256(json.dumps([self.functions, self.frames], sort_keys=True).encode('utf-8')).hexdigest()
+
+    # The counts of a function if it hasn't changed since they were recorded
+    def getFunction(self, name, fingerprint):
+        function = self.functions.get(name)
+        if function == None or function["fingerprint"] != fingerprint:
+            return None
+        return function
+
+    # Calls don't depend on the function's own code, so they're used even if
+    # it changed. None if the function isn't in the profile.
+    def getCalls(self, name):
+        return self.functions[name]["calls"] if name in self.functions else None
+
+    # Called more than once, and at least once a frame if there was a main loop
+    def isHot(self, name):
+        calls = self.getCalls(name)
+        return calls != None and calls > 1 and calls >= self.frames
+
+def getBranchCounts(function, ordinal):
+    if function == None or not str(ordinal) in function["branches"]:
+        return None
+    return function["branches"][str(ordinal)]
+
+def getCaseCounts(function, ordinal):
+    if function == None or not str(ordinal) in function["switches"]:
+        return None
+    return dict((int(value), count) for value, count in function["switches"][str(ordinal)].items())
+
+# Run a compiler's last compile (made with profileGenerate) on the emulator,
+# main and then the main loop for frames, and return what its probes counted.
+# Syscalls all give 0. Running out of instructions or into something the
+# emulator can't do ends the run early with what was counted so far.
+def generateProfile(compiler, frames=PROFILE_FRAMES, maxInstructions=PROFILE_MAX_INSTRUCTIONS, warn=None):
+    functions = {}
+    for name, fingerprint, kind, ordinal in compiler.profileProbes:
+        function = functions.setdefault(name, {"fingerprint" : fingerprint, "calls" : 0, "branches" : {}, "switches" : {}})
+        if kind == PROBE_BRANCH:
+            function["branches"][str(ordinal)] = [0, 0]
+        elif kind == PROBE_SWITCH:
+            function["switches"][str(ordinal)] = {}
+
+    def probe(vm, args):
+        name, fingerprint, kind, ordinal = compiler.profileProbes[args[0]]
+        function = functions[name]
+        if kind == PROBE_CALL:
+            function["calls"] += 1
+        elif kind == PROBE_BRANCH or kind == PROBE_TAKEN:
+            function["branches"][str(ordinal)][0 if kind == PROBE_BRANCH else 1] += 1
+        else:
+            counts = function["switches"][str(ordinal)]
+            counts[str(args[1])] = counts.get(str(args[1]), 0) + 1
+
+    vm = ThreadedMscVM(compiler.msc, syscalls={PROFILE_SYSCALL : probe}, printf=lambda vm, formatString, args: None,
+                       maxInstructions=maxInstructions)
+    framesRun = 0
+    try:
+        vm.run()
+        while vm.mainLoop != None and framesRun < frames:
+            vm.runMainLoop()
+            framesRun += 1
+    except MscVMError as e:
+        if warn != None:
+            warn("profiling stopped early: %s" % str(e))
+    return Profile(functions, framesRun)
+
+# Run switch dispatch code for a value, returns the label it jumps out to and
+# how many instructions it took. Only the commands dispatch code uses are
+# handled, the variable being switched on is the only one read.
+def runDispatch(cmds, value):
+    labelIndex = dict((cmd, i) for i, cmd in enumerate(cmds) if type(cmd) != Command)
+    stack = []
+    executed = 0
+    i = 0
+    while True:
+        cmd = cmds[i]
+        i += 1
+        if type(cmd) != Command:
+            continue
+        executed += 1
+        if cmd.command == 0xb:
+            stack.append(value)
+        elif cmd.command in [0xa, 0xd]:
+            stack.append(toSigned(cmd.parameters[0]))
+        elif cmd.command in VM_INT_OPERATIONS:
+            b, a = stack.pop(), stack.pop()
+            stack.append(VM_INT_OPERATIONS[cmd.command](a, b))
+        else:
+            jump = cmd.command == 0x4 or (cmd.command == 0x34 and stack.pop() == 0) or (cmd.command == 0x35 and stack.pop() != 0)
+            if jump:
+                target = cmd.parameters[0]
+                if not target in labelIndex:
+                    return target, executed
+                i = labelIndex[target]
+
+# Instructions the dispatch code takes over every value it was profiled with
+def getDispatchCost(cmds, valueCounts):
+    return sum(runDispatch(cmds, value)[1] * count for value, count in valueCounts.items())
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import signal
+import socket
+import struct
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+# Every message is a json header and a binary payload (source text for a
+# request, the compiled file for a response), each preceded by its length:
+#
+#     u32 headerLength, u32 payloadLength, header, payload
+_LENGTHS = struct.Struct('>II')
+
+class ServerError(Exception):
+    def __init__(self,*args,**kwargs):
+        Exception.__init__(self,*args,**kwargs)
+
+def _receiveExactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+def sendMessage(sock, header, payload=b''):
+    headerBytes = json.dumps(header).encode('utf-8')
+    sock.sendall(_LENGTHS.pack(len(headerBytes), len(payload)) + headerBytes + payload)
+
+# Returns (header, payload) or None if the other side closed the connection
+def receiveMessage(sock):
+    lengths = _receiveExactly(sock, _LENGTHS.size)
+    if lengths == None:
+        return None
+    headerLength, payloadLength = _LENGTHS.unpack(lengths)
+    header = _receiveExactly(sock, headerLength)
+    payload = _receiveExactly(sock, payloadLength)
+    if header == None or payload == None:
+        return None
+    return json.loads(header.decode('utf-8')), payload
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A connection can be reused for any number of requests
+        while True:
+            message = receiveMessage(self.request)
+            if message == None:
+                return
+            start = time.perf_counter()
+            try:
+                header, payload = self.server.handleRequest(*message)
+            except Exception as e:
+                header, payload = {"ok" : False, "error" : str(e)}, b''
+            header["serverTime"] = time.perf_counter() - start
+            sendMessage(self.request, header, payload)
+
+class CompileServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # handleRequest(header, payload) -> (header, payload) is called on the
+    # connection's own thread, so it has to be thread safe
+    def __init__(self, socketPath, handleRequest):
+        self.socketPath = socketPath
+        self.handleRequest = handleRequest
+        _removeStaleSocket(socketPath)
+        socketserver.UnixStreamServer.__init__(self, socketPath, _RequestHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+def _removeStaleSocket(socketPath):
+    if not os.path.exists(socketPath):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except OSError:
+        # Nothing is listening, left over from a server that didn't exit cleanly
+        os.remove(socketPath)
+        return
+    finally:
+        sock.close()
+    raise ServerError("A server is already running on %s" % socketPath)
+
+def _stopServer(signum, frame):
+    raise KeyboardInterrupt()
+
+def serve(socketPath, handleRequest):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ServerError("Server mode needs unix domain sockets, which aren't available on this platform")
+    # Stop (and clean up the socket) on SIGTERM as well as ctrl+c
+    signal.signal(signal.SIGTERM, _stopServer)
+    with CompileServer(socketPath, handleRequest) as server:
+        print("Listening on %s" % socketPath)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+class CompileClient:
+    def __init__(self, socketPath):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(socketPath)
+        except OSError as e:
+            self.sock.close()
+            raise ServerError("Couldn't connect to a server on %s: %s" % (socketPath, str(e)))
+
+    def request(self, header, payload=b''):
+        sendMessage(self.sock, header, payload)
+        message = receiveMessage(self.sock)
+        if message == None:
+            raise ServerError("Server closed the connection")
+        return message
+
+    def close(self):
+        self.sock.close()
+
+# Send a list of (header, payload) requests over up to `jobs` connections at
+# once. Returns (responseHeader, responsePayload, roundTripSeconds) for each
+# request, in order.
+def sendRequests(socketPath, requests, jobs=1):
+    local = threading.local()
+    clients = []
+    clientsLock = threading.Lock()
+
+    def send(request):
+        client = getattr(local, 'client', None)
+        if client == None:
+            client = local.client = CompileClient(socketPath)
+            with clientsLock:
+                clients.append(client)
+        start = time.perf_counter()
+        header, payload = client.request(*request)
+        return header, payload, time.perf_counter() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            return list(executor.map(send, requests))
+    finally:
+        for client in clients:
+            client.close()
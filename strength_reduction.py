@@ -0,0 +1,189 @@
+from pycparser import c_ast
+from folding import mapChildren, parseInt
+
+# Rewrites assignments into the forms with a dedicated instruction:
+#
+#     x = x op e, x = e op x  ->  x op= e   (op commutative for the second)
+#     x += 1, x = x + 1       ->  x++
+#     x -= 1, x = x - 1       ->  x--
+#     ++x, --x                ->  x++, x--  (as statements)
+#
+# x = x op e reads x before evaluating e while x op= e reads it after, so it's
+# only rewritten if e can't change x. The rewrite also has to leave the
+# result the same after autocasting, so the type of e has to be known and
+# match the type of x.
+
+# Compound assignments the game has an instruction for, by variable type
+COMPOUND_OPERATIONS = {
+    "int" : ["+", "-", "*", "/", "%", "&", "|", "^"],
+    "float" : ["+", "-", "*", "/"]
+}
+COMMUTATIVE_OPERATIONS = ["+", "*", "&", "|", "^"]
+COMPARISONS = ["==", "!=", "<", "<=", ">", ">=", "&&", "||"]
+INCREMENTS = {"+" : "p++", "-" : "p--"}
+# Children of each node that are statements rather than expressions
+STATEMENT_SLOTS = {
+    c_ast.Compound : ["block_items"],
+    c_ast.If : ["iftrue", "iffalse"],
+    c_ast.While : ["stmt"],
+    c_ast.DoWhile : ["stmt"],
+    c_ast.For : ["stmt", "next"],
+    c_ast.Label : ["stmt"],
+    c_ast.Case : ["stmts"],
+    c_ast.Default : ["stmts"]
+}
+
+# The types msclang knows about, anything that isn't a float is an int
+def getVariableType(typeName):
+    return "float" if typeName == "float" else "int"
+
+# Types of the parameters and every variable declared in a function. A name
+# declared in different blocks with different types could be either, so its
+# type is None.
+def getLocalTypes(func):
+    types = {}
+    def declare(name, typeName):
+        variableType = getVariableType(typeName)
+        types[name] = variableType if types.get(name, variableType) == variableType else None
+    if func.decl.type.args != None:
+        for param in func.decl.type.args.params:
+            declare(param.name, param.type.type.names[-1])
+    def visit(node):
+        if isinstance(node, c_ast.Decl) and node.name != None:
+            declare(node.name, node.type.type.names[-1])
+        for _, child in node.children():
+            visit(child)
+    visit(func.body)
+    return types
+
+class StrengthReducer:
+    def __init__(self, localTypes, globalTypes, functionTypes, globalConstants, autocast=False):
+        self.localTypes = localTypes
+        self.globalTypes = globalTypes
+        self.functionTypes = functionTypes
+        self.globalConstants = globalConstants
+        self.autocast = autocast
+        self.rewrites = 0
+
+    # A local can shadow a global in just one block, so a name that's both
+    # only has a type if they agree
+    def getVariableType(self, name):
+        if name in self.localTypes and name in self.globalTypes:
+            localType = self.localTypes[name]
+            return localType if localType == getVariableType(self.globalTypes[name]) else None
+        if name in self.localTypes:
+            return self.localTypes[name]
+        if name in self.globalTypes:
+            return getVariableType(self.globalTypes[name])
+        return None
+
+    # "int", "float" or None if it can't be known before compiling
+    def getType(self, node):
+        if isinstance(node, c_ast.Constant):
+            if node.type == "int":
+                return "int"
+            if node.type == "float" or node.type == "double":
+                return "float"
+            return None
+        if isinstance(node, c_ast.ID):
+            variableType = self.getVariableType(node.name)
+            if variableType != None:
+                return variableType
+            if node.name in self.globalConstants:
+                return "float" if type(self.globalConstants[node.name]) == float else "int"
+            return None
+        if isinstance(node, c_ast.BinaryOp):
+            if node.op in COMPARISONS:
+                return "int"
+            left, right = self.getType(node.left), self.getType(node.right)
+            if left == None or right == None:
+                return None
+            if not node.op in ["+", "-", "*", "/"]:
+                # The rest always use the int instruction
+                return "int"
+            return "float" if "float" in [left, right] else "int"
+        if isinstance(node, c_ast.UnaryOp):
+            if node.op in ["!", "~"]:
+                return "int"
+            if node.op == "-":
+                return self.getType(node.expr)
+            return None
+        if isinstance(node, c_ast.Cast):
+            return getVariableType(node.to_type.type.type.names[-1])
+        if isinstance(node, c_ast.FuncCall) and isinstance(node.name, c_ast.ID) and node.name.name in self.functionTypes:
+            return getVariableType(self.functionTypes[node.name.name])
+        return None
+
+    # Whether evaluating node could change the variable name. Functions can
+    # only change globals.
+    def canModify(self, node, name):
+        if isinstance(node, c_ast.Assignment) and isinstance(node.lvalue, c_ast.ID) and node.lvalue.name == name:
+            return True
+        if isinstance(node, c_ast.UnaryOp) and node.op in ["p++", "p--", "++", "--"] and isinstance(node.expr, c_ast.ID) and node.expr.name == name:
+            return True
+        if isinstance(node, c_ast.FuncCall) and (not name in self.localTypes or name in self.globalTypes):
+            return True
+        return any(self.canModify(child, name) for _, child in node.children())
+
+    def isOne(self, node, variableType):
+        if not isinstance(node, c_ast.Constant):
+            return False
+        try:
+            if node.type == "int":
+                value = parseInt(node.value)
+            elif node.type == "float" or node.type == "double":
+                value = float(node.value.rstrip('fF'))
+            else:
+                return False
+        except ValueError:
+            return False
+        # Without autocast an int added to a float (or the other way around)
+        # isn't converted first, so only a matching 1 counts
+        return value == 1 and (self.getType(node) == variableType or self.autocast)
+
+    def rewrite(self, node):
+        node = mapChildren(node, self.rewrite)
+        if isinstance(node, c_ast.Assignment):
+            return self.rewriteAssignment(node)
+        if type(node) in STATEMENT_SLOTS:
+            return mapChildren(node, self.rewriteStatement, [name for name in node.__slots__ if not name in STATEMENT_SLOTS[type(node)]])
+        return node
+
+    def rewriteAssignment(self, node):
+        if not isinstance(node.lvalue, c_ast.ID):
+            return node
+        name = node.lvalue.name
+        variableType = self.getVariableType(name)
+        if variableType == None:
+            return node
+
+        if node.op == "=":
+            value = node.rvalue
+            if not isinstance(value, c_ast.BinaryOp):
+                return node
+            if isinstance(value.left, c_ast.ID) and value.left.name == name:
+                op, value = value.op, value.right
+            elif isinstance(value.right, c_ast.ID) and value.right.name == name and value.op in COMMUTATIVE_OPERATIONS:
+                op, value = value.op, value.left
+            else:
+                return node
+            if (not op in COMPOUND_OPERATIONS[variableType] or self.getType(value) != variableType or
+                self.canModify(value, name)):
+                return node
+        else:
+            op, value = node.op[:-1], node.rvalue
+            if not (op in INCREMENTS and self.isOne(value, variableType)):
+                return node
+
+        self.rewrites += 1
+        if op in INCREMENTS and self.isOne(value, variableType):
+            return c_ast.UnaryOp(INCREMENTS[op], node.lvalue, node.coord)
+        return c_ast.Assignment(op + "=", node.lvalue, value, node.coord)
+
+    # A prefix increment whose value isn't used is the same as a postfix one,
+    # which doesn't have to push the new value
+    def rewriteStatement(self, node):
+        if isinstance(node, c_ast.UnaryOp) and node.op in ["++", "--"]:
+            self.rewrites += 1
+            return c_ast.UnaryOp("p" + node.op, node.expr, node.coord)
+        return node
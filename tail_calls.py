@@ -0,0 +1,49 @@
+from pycparser import c_ast
+
+# Finding self tail calls, calls a function makes to itself where nothing
+# is left to do after the call but return its value. The compiler turns them
+# into setting the parameters and jumping back to the start of the function
+# so the call stack doesn't grow.
+#
+# Calls to other functions aren't included, there's no instruction to
+# replace the current script's frame with another script's.
+
+def isSelfCall(node, name, paramCount):
+    return (isinstance(node, c_ast.FuncCall) and isinstance(node.name, c_ast.ID) and node.name.name == name and
+            len(node.args.exprs if node.args != None else []) == paramCount)
+
+# Ids of the self calls in func's body (or the body passed in place of it)
+# that are tail calls: return f(...) anywhere, and for void functions a call
+# that's the last thing the function does or is followed by return;
+def getTailCalls(func, body=None):
+    name = func.decl.name
+    paramCount = len(func.decl.type.args.params) if func.decl.type.args != None else 0
+    isVoid = func.decl.type.type.type.names[0] == "void"
+    calls = set()
+
+    def visitStatement(node, isTail):
+        if isinstance(node, c_ast.Compound):
+            items = node.block_items if node.block_items != None else []
+            for i, item in enumerate(items):
+                beforeReturn = i + 1 < len(items) and isinstance(items[i + 1], c_ast.Return) and items[i + 1].expr == None
+                visitStatement(item, (isTail and i == len(items) - 1) or beforeReturn)
+        elif isinstance(node, c_ast.If):
+            visitStatement(node.iftrue, isTail)
+            if node.iffalse != None:
+                visitStatement(node.iffalse, isTail)
+        elif isVoid and isTail and isSelfCall(node, name, paramCount):
+            calls.add(id(node))
+        elif node != None:
+            for _, child in node.children():
+                visitStatement(child, False)
+
+    def visitReturns(node):
+        if isinstance(node, c_ast.Return) and isSelfCall(node.expr, name, paramCount):
+            calls.add(id(node.expr))
+        for _, child in node.children():
+            visitReturns(child)
+
+    body = body if body != None else func.body
+    visitStatement(body, True)
+    visitReturns(body)
+    return calls
@@ -0,0 +1,54 @@
+import os, sys, glob, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from msclang import Compiler
+from msc import MscVM, formatPrintf
+
+UNIT_TESTS = sorted(glob.glob(os.path.join(ROOT, "unit_tests", "*.c")))
+
+def readFile(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+# Run msclang.py with args in cwd, caching into cacheDir rather than the
+# user's cache. Returns the finished process.
+def runMsclang(args, cwd, cacheDir, **kwargs):
+    env = dict(os.environ, MSCLANG_CACHE_DIR=str(cacheDir))
+    return subprocess.run([sys.executable, os.path.join(ROOT, "msclang.py")] + args, cwd=str(cwd), env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, **kwargs)
+
+# Every optimization turned off
+UNOPTIMIZED = {
+    "peepholeRules" : [],
+    "foldConstants" : False,
+    "reduceStrength" : False,
+    "branchConditions" : False,
+    "switchStrategy" : "linear",
+    "shareSlots" : False,
+    "inlineThreshold" : 0,
+    "removeUnused" : False,
+    "tailCalls" : False,
+    "irPasses" : []
+}
+
+# Compile source and run it on the emulator, returns what it printed and
+# the compiler. A main loop set with set_main is run for frames frames.
+def run(source, frames=3, **options):
+    compiler = Compiler(**options)
+    compiler.compile(source)
+    output = []
+    vm = MscVM(compiler.msc, printf=lambda vm, formatString, args: output.append(formatPrintf(formatString, args, vm.msc.strings)),
+               maxInstructions=1000000)
+    vm.run()
+    if vm.mainLoop != None:
+        vm.runMainLoop(frames)
+    return output, compiler
+
+# Run source compiled with options and with every optimization off and
+# check both print the same, returns what was printed
+def assertSameAsUnoptimized(source, frames=3, **options):
+    expected, _ = run(source, frames, **dict(UNOPTIMIZED, autocast=options.get("autocast", False)))
+    output, _ = run(source, frames, **options)
+    assert output == expected
+    return output
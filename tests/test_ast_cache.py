@@ -0,0 +1,51 @@
+import os
+from helpers import UNIT_TESTS, readFile
+from msclang import Compiler
+from ast_cache import AstCache
+
+def test_hits(tmp_path):
+    cache = AstCache(str(tmp_path))
+    compiler = Compiler(astCache=cache)
+    sources = [readFile(path) for path in UNIT_TESTS]
+    expected = [Compiler().compile(source) for source in sources]
+    assert [compiler.compile(source) for source in sources] == expected
+    assert (cache.hits, cache.misses) == (0, len(sources))
+    # A new cache over the same directory is what the next run sees
+    cache = AstCache(str(tmp_path))
+    assert [Compiler(astCache=cache).compile(source) for source in sources] == expected
+    assert (cache.hits, cache.misses) == (len(sources), 0)
+
+def test_key():
+    cache = AstCache("unused")
+    key = cache.getKey("void main(){}", "version", 1)
+    assert cache.getKey("void main(){}", "version", 1) == key
+    assert cache.getKey("void main(){ }", "version", 1) != key
+    assert cache.getKey("void main(){}", "other version", 1) != key
+    assert cache.getKey("void main(){}", "version", 2) != key
+
+# A broken entry is a miss, not an error
+def test_corrupt_entry(tmp_path):
+    cache = AstCache(str(tmp_path))
+    source = readFile(UNIT_TESTS[0])
+    expected = Compiler(astCache=cache).compile(source)
+    for name in os.listdir(str(tmp_path)):
+        with open(os.path.join(str(tmp_path), name), 'wb') as f:
+            f.write(b'not a pickle')
+    cache = AstCache(str(tmp_path))
+    assert Compiler(astCache=cache).compile(source) == expected
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert Compiler(astCache=cache).compile(source) == expected
+    assert cache.hits == 1
+
+def test_evict(tmp_path):
+    cache = AstCache(str(tmp_path))
+    for i in range(10):
+        cache.put("key%i" % i, "x" * 200)
+        # Entries written in the same tick would tie on their times
+        os.utime(cache._path("key%i" % i), (i, i))
+    cache.maxSize = 1000
+    assert cache.get("key0") == "x" * 200
+    cache.evict()
+    remaining = sorted(name for name in os.listdir(str(tmp_path)))
+    assert sum(os.path.getsize(os.path.join(str(tmp_path), name)) for name in remaining) <= 1000
+    assert "key0.ast" in remaining and "key9.ast" in remaining and not "key1.ast" in remaining
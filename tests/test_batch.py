@@ -0,0 +1,42 @@
+import os
+import shutil
+from helpers import UNIT_TESTS, runMsclang, readFile
+from msclang import Compiler
+
+def getOutputs(directory):
+    outputs = {}
+    for name in os.listdir(str(directory)):
+        if name.endswith(".mscsb"):
+            with open(os.path.join(str(directory), name), 'rb') as f:
+                outputs[name] = f.read()
+    return outputs
+
+def compileInto(directory, cacheDir, jobs, files):
+    directory.mkdir()
+    for path in files:
+        shutil.copy(path, str(directory))
+    names = [os.path.basename(path) for path in files]
+    return runMsclang(["-pp", "builtin", "-j", str(jobs)] + names, directory, cacheDir)
+
+# Every file gets the same output whether compiled one after another or in
+# parallel, and the same as compiling it on its own
+def test_parallel(tmp_path):
+    serial = compileInto(tmp_path / "serial", tmp_path / "cache1", 1, UNIT_TESTS)
+    parallel = compileInto(tmp_path / "parallel", tmp_path / "cache2", 3, UNIT_TESTS)
+    assert serial.returncode == 0 and parallel.returncode == 0
+    assert "Compiled %i/%i files with 3 job(s)" % (len(UNIT_TESTS), len(UNIT_TESTS)) in parallel.stdout
+    outputs = getOutputs(tmp_path / "serial")
+    assert len(outputs) == len(UNIT_TESTS)
+    assert getOutputs(tmp_path / "parallel") == outputs
+    single = Compiler().compile(readFile(UNIT_TESTS[0]))
+    assert outputs[os.path.basename(UNIT_TESTS[0])[:-2] + ".mscsb"] == single
+
+# A file that fails doesn't stop the others
+def test_failure(tmp_path):
+    broken = tmp_path / "broken.c"
+    broken.write_text("void main(){\n    undefined();\n")
+    result = compileInto(tmp_path / "out", tmp_path / "cache", 2, UNIT_TESTS[:3] + [str(broken)])
+    assert result.returncode == 1
+    assert "Error compiling broken.c" in result.stderr
+    assert "Compiled 3/4 files" in result.stdout
+    assert len(getOutputs(tmp_path / "out")) == 3
@@ -0,0 +1,55 @@
+from helpers import assertSameAsUnoptimized
+
+def test_conditions():
+    assertSameAsUnoptimized("""
+void main(){
+    for (int i = 0; i < 8; i++){
+        int a = i & 1;
+        int b = i & 2;
+        int c = i & 4;
+        if (a && b || !c){
+            printf("%i yes", i);
+        } else {
+            printf("%i no", i);
+        }
+        if (!(a || b) && c){
+            printf("%i both", i);
+        }
+        printf("%i", (a || c) ? 1 : 2);
+    }
+}""")
+
+# The right side of && and || only runs when it has to
+def test_short_circuit():
+    output = assertSameAsUnoptimized("""
+int calls;
+int check(int value){
+    calls++;
+    return value;
+}
+void main(){
+    calls = 0;
+    if (check(0) && check(1)){
+        printf("wrong");
+    }
+    if (check(1) || check(0)){
+        printf("right");
+    }
+    int i = 0;
+    while (i < 3 && check(1)){
+        i++;
+    }
+    printf("%i", calls);
+}""")
+    assert output == ["right", "5"]
+
+def test_conditions_as_values():
+    assertSameAsUnoptimized("""
+void main(){
+    int a = 3;
+    int b = 0;
+    int x = a && b;
+    int y = a || b;
+    int z = !a || !b;
+    printf("%i %i %i", x, y, z);
+}""")
@@ -0,0 +1,29 @@
+import time
+from preprocessor import removeComments
+
+def test_line_comments():
+    assert removeComments("int x; // comment\nint y;//\n") == "int x; \nint y;\n"
+    assert removeComments("x = a / b; // c / d") == "x = a / b; "
+
+# Block comments keep their newlines so line numbers don't change, and one
+# on a single line still separates the tokens around it
+def test_block_comments():
+    assert removeComments("int/* a */x;") == "int x;"
+    assert removeComments("a /* one\ntwo\nthree */ b") == "a \n\n b"
+    assert removeComments("a /* // */ b // /* c\nd") == "a   b \nd"
+    assert removeComments("a /* not closed\n b") == "a \n"
+
+def test_literals():
+    assert removeComments('printf("// not a comment");') == 'printf("// not a comment");'
+    assert removeComments('s = "/* still */ a string"; /* gone */') == 's = "/* still */ a string";  '
+    assert removeComments('s = "escaped \\" // quote"; // gone') == 's = "escaped \\" // quote"; '
+    assert removeComments("c = '\"'; // gone\nd = '\\''; /* gone */") == "c = '\"'; \nd = '\\'';  "
+    # An unterminated literal ends at the end of its line
+    assert removeComments('s = "open\n// gone') == 's = "open\n'
+
+# Inputs that made the old regex backtrack take linear time
+def test_linear():
+    for text in ['"' + '\\"' * 20000, "/*" + "*" * 40000, "'" * 40000, "/" * 40000]:
+        start = time.perf_counter()
+        removeComments(text)
+        assert time.perf_counter() - start < 1
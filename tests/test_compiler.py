@@ -0,0 +1,52 @@
+import threading
+from helpers import UNIT_TESTS, readFile
+from msclang import Compiler, CompilerError, FileRefs
+
+def compileAll(compiler):
+    return [compiler.compile(readFile(path)) for path in UNIT_TESTS]
+
+# Nothing from one compile is left behind for the next
+def test_reuse():
+    expected = compileAll(Compiler())
+    compiler = Compiler()
+    compileAll(compiler)
+    assert compileAll(compiler) == expected
+    assert list(reversed([compiler.compile(readFile(path)) for path in reversed(UNIT_TESTS)])) == expected
+
+def test_error_does_not_leak():
+    compiler = Compiler()
+    source = readFile(UNIT_TESTS[0])
+    expected = compiler.compile(source)
+    try:
+        compiler.compile("int g;\nint g;\nvoid main(){\n}")
+        assert False
+    except CompilerError:
+        pass
+    assert compiler.compile(source) == expected
+
+# Compilers in different threads don't share any state
+def test_threads():
+    expected = compileAll(Compiler())
+    results = [None] * 4
+    def compileInThread(i):
+        results[i] = compileAll(Compiler())
+    threads = [threading.Thread(target=compileInThread, args=(i,)) for i in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(result == expected for result in results)
+
+def test_options_per_compiler():
+    source = 'void main(){\n    printf("%i", 1);\n}'
+    short = Compiler().compile(source)
+    long = Compiler(usePushShort=False).compile(source)
+    assert short != long
+    assert Compiler().compile(source) == short
+
+def test_refs_not_shared():
+    first = FileRefs()
+    first.functions.append("main")
+    first.globalVariableTypes["g"] = "int"
+    second = FileRefs()
+    assert second.functions == [] and second.globalVariableTypes == {}
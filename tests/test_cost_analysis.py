@@ -0,0 +1,108 @@
+import json
+from helpers import runMsclang
+from msc import Command
+from msclang import Compiler
+import cost_analysis
+
+# Give commands positions 4 bytes apart from 0x10
+def placed(cmds):
+    for i, cmd in enumerate(cmds):
+        cmd.commandPosition = 0x10 + i * 4
+    return cmds
+
+# while (1) { nop }
+LOOP = [Command(0x2, [0, 0]), Command(0xd, [1], True), Command(0x35, [0x24]), Command(0x0), Command(0x4, [0x14]), Command(0x3)]
+
+SOURCE = """
+int square(int x){
+    return x * x;
+}
+int fact(int n){
+    if (n < 2){
+        return 1;
+    }
+    return n * fact(n - 1);
+}
+void main(){
+    int total = 0;
+    for (int i = 0; i < 3; i++){
+        total += square(i);
+    }
+    printf("%i %i", total, fact(4));
+}
+"""
+
+def analyze(source=SOURCE):
+    compiler = Compiler(costTable=cost_analysis.DEFAULT_COSTS, inlineThreshold=0)
+    compiler.compile(source)
+    return dict((result.name, result) for result in compiler.costAnalysis)
+
+def test_blocks_and_loops():
+    cmds = placed(LOOP)
+    blocks, successors = cost_analysis.getBasicBlocks(cmds)
+    assert blocks == [(0, 0), (1, 2), (3, 4), (5, 5)]
+    assert successors == [[1], [3, 2], [1], []]
+    assert cost_analysis.getLoops(successors) == [(1, set([1, 2]))]
+    result = cost_analysis.analyzeScript("loop", cmds)
+    assert result.blocks == [(0x10, 1, 0), (0x14, 2, 1), (0x1C, 2, 1), (0x24, 1, 0)]
+    assert result.loops == [(0x14, 1, 4)]
+    assert result.cost == 1 + 2 * 10 + 2 * 10 + 1
+    assert cost_analysis.analyzeScript("empty", []).cost == 0
+
+def test_stack_depth():
+    assert cost_analysis.getMaxStackDepth(placed(LOOP)) == (1, True)
+    # One path leaves a value on the stack that the other doesn't
+    assert cost_analysis.getMaxStackDepth(placed([Command(0x2, [0, 0]), Command(0xd, [1], True), Command(0x34, [0x20]),
+                                                  Command(0xd, [2], True), Command(0x3)])) == (1, False)
+    # Popping more than was pushed
+    assert cost_analysis.getMaxStackDepth(placed([Command(0x2, [0, 0]), Command(0x33), Command(0x3)])) == (0, False)
+
+def test_analyze_file():
+    results = analyze()
+    square, fact, main = results["square"], results["fact"], results["main"]
+    assert square.calls == [] and square.inclusiveCost == square.cost
+    # Recursion only counts once
+    assert len(fact.calls) == 1 and fact.inclusiveCost == fact.cost
+    # square is called in the loop, fact once
+    assert sorted(weight for position, weight in main.calls) == [1, 10]
+    assert main.inclusiveCost == main.cost + 10 * square.cost + fact.cost
+    assert len(main.loops) == 1 and main.loops[0][1] == 1
+    assert all(result.stackConsistent for result in results.values())
+    assert all(result.maxStackDepth > 0 for result in results.values())
+
+def test_cost_table(tmp_path):
+    path = str(tmp_path / "costs.json")
+    with open(path, 'w') as f:
+        json.dump({"printf" : 20, "0x33" : 3}, f)
+    costs = cost_analysis.loadCostTable(path)
+    assert costs[0x2c] == 20 and costs[0x33] == 3
+    assert costs[0x2d] == cost_analysis.DEFAULT_COSTS[0x2d]
+    assert not 0x33 in cost_analysis.DEFAULT_COSTS
+    compiler = Compiler(costTable=costs, inlineThreshold=0)
+    compiler.compile(SOURCE)
+    main = [result for result in compiler.costAnalysis if result.name == "main"][0]
+    assert main.cost == analyze()["main"].cost + 20 - cost_analysis.DEFAULT_COSTS[0x2c]
+
+def test_report():
+    results = list(analyze().values())
+    lines = cost_analysis.formatReport(results).split('\n')
+    assert lines[0].split() == ["function", "cost", "inclusive", "stack", "blocks", "loops"]
+    assert [line.split()[0] for line in lines[1:] if not line.startswith(' ')] == ["main", "fact", "square"]
+    assert lines[2].startswith("    loop at 0x")
+    assert len(cost_analysis.formatReport(results, 1).split('\n')) == 3
+    broken = cost_analysis.analyzeScript("broken", placed([Command(0x2, [0, 0]), Command(0x33), Command(0x3)]))
+    report = cost_analysis.formatReport([broken])
+    assert report.split('\n')[1].split()[3] == "0*"
+    assert report.endswith("pop more than was pushed")
+
+def test_command_line(tmp_path):
+    (tmp_path / "script.c").write_text(SOURCE)
+    result = runMsclang(["--cost-report", "--inline-threshold", "0", "script.c"], tmp_path, tmp_path / "cache")
+    assert result.returncode == 0, result.stderr
+    lines = result.stdout.split('\n')
+    assert lines[0] == "script.c: static cost"
+    assert lines[2].split()[:3] == ["main", str(analyze()["main"].cost), str(analyze()["main"].inclusiveCost)]
+    (tmp_path / "costs.json").write_text('{"printf" : 20}')
+    result = runMsclang(["--cost-report", "--cost-table", "costs.json", "--inline-threshold", "0", "script.c"], tmp_path, tmp_path / "cache")
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split('\n')[2].split()[1] == str(analyze()["main"].cost + 20 - cost_analysis.DEFAULT_COSTS[0x2c])
@@ -0,0 +1,70 @@
+from helpers import run, assertSameAsUnoptimized
+
+def getScriptCount(source, **options):
+    _, compiler = run(source, **options)
+    return len(compiler.msc.scripts)
+
+# Functions only reachable through a pointer (&f or just f) are kept
+def test_function_pointers_are_kept():
+    source = """
+void viaAddress(){
+    printf("address");
+}
+void viaName(){
+    printf("name");
+}
+void main(){
+    int a = &viaAddress;
+    int b = viaName;
+    (*a)();
+    (*b)();
+}"""
+    output = assertSameAsUnoptimized(source)
+    assert output == ["address", "name"]
+    assert getScriptCount(source) == 3
+
+def test_main_loop_is_kept():
+    source = """
+void mainLoop(){
+    printf("frame");
+}
+void main(){
+    set_main(mainLoop);
+}"""
+    output = assertSameAsUnoptimized(source, frames=2)
+    assert output == ["frame", "frame"]
+    assert getScriptCount(source) == 2
+
+# Anything only used by code main can't reach goes, including the strings
+# and globals it uses
+def test_unreachable_code_is_removed():
+    source = """
+int unused;
+int used;
+void helper(){
+    unused = 1;
+    printf("never");
+}
+void unreachable(){
+    helper();
+}
+void main(){
+    used = 5;
+    printf("%i", used);
+}"""
+    output = assertSameAsUnoptimized(source)
+    assert output == ["5"]
+    _, compiler = run(source)
+    assert len(compiler.msc.scripts) == 1
+    assert compiler.msc.strings == ["%i"]
+    assert compiler.refs.globalVariables == ["used"]
+
+def test_keep_unused():
+    source = """
+void unreachable(){
+    printf("never");
+}
+void main(){
+    printf("main");
+}"""
+    assert getScriptCount(source, removeUnused=False) == 2
@@ -0,0 +1,43 @@
+from helpers import run, assertSameAsUnoptimized
+
+def test_int_expressions():
+    output = assertSameAsUnoptimized("""
+void main(){
+    int i = 7;
+    printf("%i %i %i %i %i", 2 + 3 * 4, 0x7fffffff + 1, -(-i), i * 1 + 0, (i & 0) | (0 * i));
+}""")
+    assert output == ["14 -2147483648 7 7 0"]
+
+# Without autocast the game multiplies the float by the bits of the int
+def test_identities_leave_floats_alone():
+    assertSameAsUnoptimized("""
+void main(){
+    float f = 2.5;
+    printf("%f %f %f %f %f", f * 1, f / 1, 1 * f, f * 0, f - 0);
+}""")
+
+def test_identities_with_autocast():
+    output = assertSameAsUnoptimized("""
+void main(){
+    float f = 2.5;
+    printf("%f %f %f", f * 1, f / 1, 1 * f);
+}""", autocast=True)
+    assert output == ["2.500000 2.500000 2.500000"]
+
+def test_float_constants():
+    assertSameAsUnoptimized("""
+void main(){
+    float f = 1.5 * 2.0 + 0.25;
+    printf("%f %f %i", f, 1.0 / 3.0, 1.5 < 2.5);
+}""")
+
+def test_division_by_zero_is_left_alone():
+    _, compiler = run("""
+void main(){
+    int i = 1;
+    if (i == 0){
+        printf("%i", 1 / 0);
+    }
+    printf("done");
+}""")
+    assert compiler.foldStats.counts.get("constant", 0) == 0
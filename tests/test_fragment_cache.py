@@ -0,0 +1,55 @@
+from helpers import UNIT_TESTS, readFile, run
+from msclang import Compiler
+from ast_cache import FragmentCache
+
+def test_unit_tests(tmp_path):
+    sources = [readFile(path) for path in UNIT_TESTS]
+    expected = [Compiler().compile(source) for source in sources]
+    cache = FragmentCache(str(tmp_path))
+    compiler = Compiler(fragmentCache=cache)
+    assert [compiler.compile(source) for source in sources] == expected
+    assert cache.hits == 0
+    # Compiling again reuses every function, from memory then from disk
+    misses = cache.misses
+    assert [compiler.compile(source) for source in sources] == expected
+    cache = FragmentCache(str(tmp_path))
+    assert [Compiler(fragmentCache=cache).compile(source) for source in sources] == expected
+    assert (cache.hits, cache.misses) == (misses, 0)
+
+SOURCE = """
+int g;
+int twice(int x){
+    return x * %s;
+}
+void show(){
+    printf("%%i", g);
+}
+void main(){
+    g = twice(3);
+    show();
+}"""
+
+def compileWith(cache, source):
+    hits, misses = cache.hits, cache.misses
+    output, _ = run(source, fragmentCache=cache)
+    return output, cache.hits - hits, cache.misses - misses
+
+# Only the functions that changed, or that something inlined into them
+# changed in, are compiled again
+def test_changes(tmp_path):
+    cache = FragmentCache(str(tmp_path))
+    assert compileWith(cache, SOURCE % "2") == (["6"], 0, 3)
+    assert compileWith(cache, SOURCE % "2") == (["6"], 3, 0)
+    # twice is inlined into main, so main is compiled again with it
+    assert compileWith(cache, SOURCE % "5") == (["15"], 1, 2)
+    assert compileWith(cache, SOURCE % "5") == (["15"], 3, 0)
+
+def test_options(tmp_path):
+    cache = FragmentCache(str(tmp_path))
+    compileWith(cache, SOURCE % "2")
+    assert run(SOURCE % "2", fragmentCache=cache, inlineThreshold=0)[0] == ["6"]
+    assert cache.hits == 0
+    # Another global moves g, so nothing using it can be reused
+    hits = cache.hits
+    assert compileWith(cache, "int other;\n" + SOURCE % "2")[0] == ["6"]
+    assert cache.hits == hits
@@ -0,0 +1,61 @@
+from helpers import run, assertSameAsUnoptimized
+
+def test_inlined_calls():
+    output = assertSameAsUnoptimized("""
+int square(int x){
+    return x * x;
+}
+float half(float f){
+    return f / 2.0;
+}
+void show(int value){
+    printf("%i", value);
+}
+void main(){
+    int a = 3;
+    int b = square(a + 1);
+    show(b);
+    printf("%f %i", half(5.0), square(a) + 1);
+}""")
+    assert output == ["16", "2.500000 10"]
+
+# Every call starts with fresh locals, inlined or not
+def test_uninitialized_locals_start_at_zero():
+    output = assertSameAsUnoptimized("""
+int count(){
+    int c;
+    c++;
+    return c;
+}
+void main(){
+    for (int i = 0; i < 3; i++){
+        printf("c%i", count());
+    }
+    printf("c%i", count());
+}""")
+    assert output == ["c1", "c1", "c1", "c1"]
+
+# Arguments are evaluated once, before the body runs
+def test_arguments_read_before_the_body():
+    output = assertSameAsUnoptimized("""
+int g;
+int reset(int a, int b){
+    g = 10;
+    return a - b + a;
+}
+void main(){
+    g = 3;
+    int x = reset(g, g * 2);
+    printf("%i %i", x, g);
+}""")
+    assert output == ["0 10"]
+
+def test_calls_are_inlined():
+    _, compiler = run("""
+int twice(int x){
+    return x * 2;
+}
+void main(){
+    printf("%i", twice(4));
+}""", foldConstants=False)
+    assert compiler.inlineStats.callSites == 1
@@ -0,0 +1,124 @@
+from helpers import run, assertSameAsUnoptimized
+import ir
+
+# The inner loop is the last thing in the outer loop so it falls into the
+# outer loop's header, which gets a preheader put in front of it
+NESTED_LOOPS = """
+int g;
+int h3(int v){
+    return v & 7;
+}
+void main(){
+    int i = 0;
+    int a = 0;
+    g = 17;
+    while (i < 4){
+        int j = 0;
+        a = 1;
+        printf("g=%i", g + a);
+        i++;
+        while (j < 2){
+            int x = 9;
+            int y = h3(x);
+            a = 0;
+            g += y + a * 5;
+            j++;
+        }
+    }
+}"""
+
+def test_nested_loops():
+    output = assertSameAsUnoptimized(NESTED_LOOPS)
+    assert output == ["g=18", "g=20", "g=22", "g=24"]
+
+def test_nested_loops_each_pass():
+    for irPass in ir.DEFAULT_PASSES:
+        assert assertSameAsUnoptimized(NESTED_LOOPS, irPasses=[irPass]) == ["g=18", "g=20", "g=22", "g=24"]
+
+def test_hoisted():
+    source = """
+void main(){
+    int i = 0;
+    int total = 0;
+    int n = 6;
+    while (i < 10){
+        int step = n * 3;
+        total += step;
+        i++;
+    }
+    printf("%i", total);
+}"""
+    output = assertSameAsUnoptimized(source)
+    assert output == ["180"]
+    _, compiler = run(source)
+    assert compiler.irStats.changes.get("hoistInvariants", 0) > 0
+
+# A variable copied and then changed in a loop keeps its own value
+def test_copies_in_loop():
+    output = assertSameAsUnoptimized("""
+void main(){
+    int i = 0;
+    int a = 1;
+    int b = 0;
+    while (i < 5){
+        b = a;
+        a = a + b;
+        i++;
+        printf("%i %i", a, b);
+    }
+}""")
+    assert output == ["2 1", "4 2", "8 4", "16 8", "32 16"]
+
+# Stores that are never read are removed but the ones that are read aren't,
+# even when they're only read on some paths
+def test_dead_stores():
+    source = """
+int check(int n){
+    int unused = n * 7;
+    int result = n;
+    if (n > 3){
+        result = n - 3;
+    }
+    unused = 2;
+    return result;
+}
+void main(){
+    for (int i = 0; i < 6; i++){
+        printf("%i", check(i));
+    }
+}"""
+    output = assertSameAsUnoptimized(source, inlineThreshold=0)
+    assert output == ["0", "1", "2", "3", "1", "2"]
+    _, compiler = run(source, inlineThreshold=0)
+    assert compiler.irStats.changes.get("removeDeadCode", 0) > 0
+
+# Code after a return is never reached
+def test_unreachable():
+    output = assertSameAsUnoptimized("""
+int first(int n){
+    while (1){
+        return n + 1;
+    }
+    printf("unreachable");
+    return 0;
+}
+void main(){
+    printf("%i", first(4));
+}""", inlineThreshold=0)
+    assert output == ["5"]
+
+# The end of a script stays even when every path returns before it
+def test_end_kept():
+    source = """
+int first(int n){
+    return n + 1;
+    printf("unreachable");
+}
+void main(){
+    printf("%i", first(4));
+}"""
+    assert assertSameAsUnoptimized(source, inlineThreshold=0) == ["5"]
+    _, compiler = run(source, inlineThreshold=0)
+    script = compiler.msc.scripts[compiler.refs.functions.index("first")]
+    commands = [cmd.command for cmd in script.cmds if hasattr(cmd, "command")]
+    assert commands[-1] == 0x3 and not 0x2c in commands
@@ -0,0 +1,52 @@
+import os
+import stat
+import pytest
+from helpers import UNIT_TESTS, readFile, run
+from msc import MscFile, MscVM, Command, formatPrintf, floatToBits
+from msclang import Compiler, writeToFile, getNewFileMode
+
+# Floats are kept as they are until written out, and read back as their bits
+def getCommands(msc):
+    return [[(cmd.command, [floatToBits(p) if type(p) == float else p for p in cmd.parameters], cmd.pushBit)
+             for cmd in script.cmds if type(cmd) == Command] for script in msc.scripts]
+
+# Reading a compiled file back gives the same scripts and strings, which
+# run the same
+@pytest.mark.parametrize("path", UNIT_TESTS, ids=os.path.basename)
+def test_read_back(path):
+    expected, compiler = run(readFile(path))
+    msc = MscFile()
+    msc.readFromBytes(Compiler().compile(readFile(path)), '<')
+    assert msc.strings == compiler.msc.strings
+    assert getCommands(msc) == getCommands(compiler.msc)
+    output = []
+    vm = MscVM(msc, printf=lambda vm, formatString, args: output.append(formatPrintf(formatString, args, vm.msc.strings)),
+               maxInstructions=1000000)
+    vm.run()
+    if vm.mainLoop != None:
+        vm.runMainLoop(3)
+    assert output == expected
+
+def getMode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+def test_write(tmp_path):
+    path = str(tmp_path / "out.mscsb")
+    writeToFile(path, b'first')
+    assert readFile(path) == 'first'
+    assert getMode(path) == getNewFileMode()
+    # Replacing a file keeps its mode
+    os.chmod(path, 0o640)
+    writeToFile(path, b'second')
+    assert readFile(path) == 'second'
+    assert getMode(path) == 0o640
+    assert os.listdir(str(tmp_path)) == ["out.mscsb"]
+
+# A failed write leaves the old file as it was and nothing else behind
+def test_failed_write(tmp_path):
+    path = str(tmp_path / "out.mscsb")
+    writeToFile(path, b'first')
+    with pytest.raises(TypeError):
+        writeToFile(path, "not bytes")
+    assert readFile(path) == 'first'
+    assert os.listdir(str(tmp_path)) == ["out.mscsb"]
@@ -0,0 +1,18 @@
+import threading
+from helpers import UNIT_TESTS, readFile
+from msclang import Compiler, getParser
+
+def test_one_parser_per_thread():
+    parser = getParser()
+    assert getParser() is parser
+    others = []
+    thread = threading.Thread(target=lambda: others.append(getParser()))
+    thread.start()
+    thread.join()
+    assert others[0] is not parser
+
+# A parser that has already parsed something gives the same tree as a new one
+def test_reused_parser():
+    sources = [readFile(path) for path in UNIT_TESTS]
+    first = [str(Compiler().parse(source)) for source in sources]
+    assert [str(Compiler().parse(source)) for source in sources] == first
@@ -0,0 +1,87 @@
+import os
+import pytest
+from helpers import UNIT_TESTS, readFile, run, assertSameAsUnoptimized
+import peephole
+from msc import Command
+from msclang import Label
+
+def describe(cmds, labels):
+    names = dict((label, name) for name, label in labels.items())
+    return [names[cmd] if type(cmd) == Label else
+            (cmd.command, [names.get(p, p) if type(p) == Label else p for p in cmd.parameters]) for cmd in cmds]
+
+def optimize(cmds, labels):
+    stats = peephole.PeepholeStats()
+    return describe(peephole.optimize(cmds, peephole.DEFAULT_RULES, stats), labels), stats
+
+def test_thread_jumps():
+    labels = {"a" : Label(), "b" : Label()}
+    out, stats = optimize([Command(0x2, [0, 0]), Command(0x34, [labels["a"]]), Command(0xd, [1], True), Command(0x7),
+                           labels["a"], Command(0x4, [labels["b"]]), Command(0xd, [2], True), Command(0x7),
+                           labels["b"], Command(0x7), Command(0x3)], labels)
+    # Nothing jumps to a anymore, so what comes after it can't run
+    assert out == [(0x2, [0, 0]), (0x34, ["b"]), (0xd, [1]), (0x7, []), "b", (0x7, []), (0x3, [])]
+    assert stats.hits["threadJumps"] == 1 and stats.hits["removeDeadCode"] == 2
+
+def test_jump_to_next():
+    labels = {"a" : Label()}
+    out, stats = optimize([Command(0x2, [0, 0]), Command(0x4, [labels["a"]]), labels["a"], Command(0x3)], labels)
+    assert out == [(0x2, [0, 0]), (0x3, [])]
+    assert stats.bytesSaved["removeJumpToNext"] == 5
+
+def test_not():
+    labels = {"a" : Label()}
+    out, stats = optimize([Command(0x2, [0, 0]), Command(0xb, [0, 0], True), Command(0xd, [1], True), Command(0x27, [], True),
+                           Command(0x2b, [], True), Command(0x34, [labels["a"]]), Command(0x6), labels["a"],
+                           Command(0xb, [0, 0], True), Command(0x2b, [], True), Command(0x34, [labels["a"]]), Command(0x3)], labels)
+    assert out == [(0x2, [0, 0]), (0xb, [0, 0]), (0xd, [1]), (0x2a, []), (0x34, ["a"]), (0x6, []), "a",
+                   (0xb, [0, 0]), (0x35, ["a"]), (0x3, [])]
+    # Float comparisons aren't inverted, NaN compares false both ways
+    out, stats = optimize([Command(0x2, [0, 0]), Command(0xb, [0, 0], True), Command(0xb, [0, 1], True), Command(0x48, [], True),
+                           Command(0x2b, [], True), Command(0x34, [labels["a"]]), labels["a"], Command(0x3)], labels)
+    assert (0x48, []) in out and (0x35, ["a"]) in out
+
+# Code that's only reached through a label that's jumped to stays, the end of
+# the script always stays
+def test_dead_code():
+    labels = {"a" : Label(), "unused" : Label()}
+    out, stats = optimize([Command(0x2, [0, 0]), Command(0x34, [labels["a"]]), Command(0x6), Command(0xd, [1], True),
+                           labels["unused"], Command(0x7), labels["a"], Command(0x7), Command(0x3)], labels)
+    assert out == [(0x2, [0, 0]), (0x34, ["a"]), (0x6, []), "a", (0x7, []), (0x3, [])]
+
+# Every script keeps the one begin and end that frame it, those are never
+# redundant since begin sets up the locals and end marks where it stops
+@pytest.mark.parametrize("path", UNIT_TESTS, ids=os.path.basename)
+def test_unit_tests(path):
+    assertSameAsUnoptimized(readFile(path), peepholeRules=peephole.DEFAULT_RULES)
+    _, compiler = run(readFile(path))
+    for script in compiler.msc.scripts:
+        commands = [cmd.command for cmd in script.cmds if type(cmd) == Command]
+        assert commands[0] == 0x2 and commands[-1] == 0x3
+        assert commands.count(0x2) == 1 and commands.count(0x3) == 1
+
+# The jump over the else after a return is dead
+def test_stats():
+    source = """
+int pick(int x){
+    if (x){
+        return 1;
+    }
+    else {
+        return 2;
+    }
+}
+void main(){
+    int i = 0;
+    while (1){
+        if (i > 2){
+            break;
+        }
+        printf("%i", pick(i));
+        i++;
+    }
+}"""
+    assert assertSameAsUnoptimized(source) == ["2", "1", "1"]
+    _, compiler = run(source, foldConstants=False, branchConditions=False, irPasses=[], inlineThreshold=0)
+    assert compiler.peepholeStats.hits == {"removeDeadCode" : 1}
+    assert compiler.peepholeStats.totalBytesSaved() == 5
@@ -0,0 +1,136 @@
+import os
+import pytest
+from helpers import run
+from preprocessor import Preprocessor, PreprocessorCache, PreprocessorError, preprocessWithCache
+
+# The output without line markers or blank lines
+def getLines(text, defines=None):
+    output = Preprocessor(defines=defines).preprocessString(text)
+    return [line for line in output.split('\n') if line.strip() != '' and not line.startswith('#')]
+
+def test_macros():
+    assert getLines("""
+#define SIZE 4
+#define ADD(a, b) ((a) + (b))
+#define NAME(x) #x
+#define ALL(...) f(__VA_ARGS__)
+int x = ADD(SIZE, 2);
+char *s = NAME(hello world);
+ALL(1, 2, 3);
+""") == ['int x = ( ( 4 ) + ( 2 ) ) ;', 'char * s = "hello world" ;', 'f ( 1 , 2 , 3 ) ;']
+
+def test_paste():
+    assert getLines("""
+#define CAT(a, b) a##b
+#define CAT3(a, b, c) a##b##c
+CAT(x, y) CAT(1, 2) CAT3(p, q, r)
+""") == ['xy 12 pqr']
+
+# An empty argument to ## is a placemarker, the other operand is left as it is
+def test_paste_empty():
+    assert getLines("""
+#define D(a, b) [a##b]
+#define C(a, b) x a##b
+#define CAT(a, b) a##b
+#define CAT3(a, b, c) a##b##c
+D(,y)
+C(,y)
+CAT(, x)
+CAT(x,)
+CAT3(,,z) CAT3(p,,z) CAT3(,q,)
+""") == ['[ y ]', 'x y', 'x', 'x', 'z pz q']
+
+def test_paste_invalid():
+    with pytest.raises(PreprocessorError):
+        getLines("""
+#define P(a) [##a
+P(x)
+""")
+
+def test_conditions():
+    source = """
+#if defined(A) && VALUE > 2
+big
+#elif defined A
+small
+#else
+none
+#endif
+#ifndef A
+not defined
+#endif
+"""
+    assert getLines(source) == ['none', 'not defined']
+    assert getLines(source, {"A" : 1, "VALUE" : 1}) == ['small']
+    assert getLines(source, {"A" : 1, "VALUE" : 3}) == ['big']
+    with pytest.raises(PreprocessorError):
+        getLines("#if 1\n")
+    with pytest.raises(PreprocessorError):
+        getLines("#error stop\n")
+
+# Line numbers match the source so errors point at the right line, a call
+# over several lines is expanded on the line it starts on
+def test_line_numbers():
+    output = Preprocessor().preprocessString("""#define F(a, b) a + b
+/* a comment
+   over two lines */
+F(1,
+  2)
+after
+""")
+    lines = output.split('\n')
+    start = int(lines[0].split()[1])
+    assert lines[0].startswith('#')
+    assert start + lines.index('1 + 2') - 1 == 4
+    assert start + lines.index('after') - 1 == 6
+
+def test_include(tmp_path):
+    (tmp_path / "include").mkdir()
+    (tmp_path / "include" / "values.h").write_text("#pragma once\n#define VALUE 7\nint value = VALUE;\n")
+    (tmp_path / "local.h").write_text('#include <values.h>\n#include "include/values.h"\n')
+    (tmp_path / "main.c").write_text('#include "local.h"\nint other = VALUE;\n')
+    preprocessor = Preprocessor([str(tmp_path / "include")])
+    output = preprocessor.preprocessFile(str(tmp_path / "main.c"))
+    assert [line for line in output.split('\n') if line.strip() != '' and not line.startswith('#')] == \
+        ['int value = 7 ;', 'int other = 7 ;']
+    assert sorted(preprocessor.dependencies) == sorted(str(tmp_path / name) for name in ["main.c", "local.h", "include/values.h"])
+    with pytest.raises(PreprocessorError):
+        Preprocessor().preprocessFile(str(tmp_path / "main.c"))
+
+# Each preprocessor starts from the defaults, not what an earlier one defined
+def test_defaults_not_shared():
+    first = Preprocessor()
+    first.define("X", 1)
+    first.includePaths.append("somewhere")
+    second = Preprocessor()
+    assert second.macros == {} and second.includePaths == []
+
+def test_cache(tmp_path):
+    cache = PreprocessorCache(str(tmp_path / "cache"))
+    os.makedirs(cache.directory)
+    (tmp_path / "values.h").write_text("#define VALUE 1\n")
+    main = str(tmp_path / "main.c")
+    with open(main, "w") as f:
+        f.write('#include "values.h"\nint x = VALUE;\n')
+    assert cache.get(main) == None
+    text, dependencies = preprocessWithCache(main, cache=cache)
+    assert "int x = 1 ;" in text
+    assert cache.get(main) == (text, dependencies)
+    # Different defines are cached separately
+    assert cache.get(main, defines={"OTHER" : 1}) == None
+    # Changing an included file invalidates the entry
+    (tmp_path / "values.h").write_text("#define VALUE 2\n")
+    assert cache.get(main) == None
+    text, _ = preprocessWithCache(main, cache=cache)
+    assert "int x = 2 ;" in text
+    assert cache.get(main)[0] == text
+
+def test_compile():
+    output, _ = run(Preprocessor().preprocessString("""
+#define SQUARE(x) ((x) * (x))
+#define CAT(a, b) a##b
+void main(){
+    int CAT(, value) = SQUARE(3);
+    printf("%i", value);
+}"""))
+    assert output == ["9"]
@@ -0,0 +1,120 @@
+import os
+from helpers import run, runMsclang, UNOPTIMIZED
+from msclang import Compiler
+import profiling
+
+SOURCE = """
+int count;
+
+int pick(int x){
+    if (x > 2){
+        return 1;
+    }
+    return 0;
+}
+
+void loop(){
+    count++;
+    switch (count % 3){
+        case 0:
+            printf("zero");
+            break;
+        case 1:
+            printf("one");
+            break;
+        default:
+            printf("other");
+            break;
+    }
+    for (int i = 0; i < 4; i++){
+        printf("%d", pick(i));
+    }
+}
+
+void main(){
+    count = 0;
+    set_main(loop);
+}
+"""
+
+def makeProfile(source=SOURCE, frames=5):
+    compiler = Compiler(profileGenerate=True)
+    compiler.compile(source)
+    return profiling.generateProfile(compiler, frames)
+
+def test_generate():
+    profile = makeProfile()
+    assert profile.frames == 5
+    assert profile.getCalls("main") == 1
+    assert profile.getCalls("loop") == 5
+    assert profile.getCalls("pick") == 20
+    assert profile.getCalls("missing") == None
+    pick = profile.functions["pick"]
+    assert profiling.getBranchCounts(pick, 0) == [20, 5]
+    assert profiling.getBranchCounts(pick, 1) == None
+    assert profiling.getCaseCounts(profile.functions["loop"], 0) == {0 : 1, 1 : 2, 2 : 2}
+    # Called at least once a frame
+    assert profile.isHot("pick") and profile.isHot("loop")
+    assert not profile.isHot("main")
+
+def test_changed_function():
+    profile = makeProfile()
+    fingerprint = profile.functions["pick"]["fingerprint"]
+    assert profile.getFunction("pick", fingerprint) == profile.functions["pick"]
+    # A function that changed keeps its calls but not its counts
+    assert profile.getFunction("pick", "changed") == None
+    assert profile.getCalls("pick") == 20
+
+def test_save_and_load(tmp_path):
+    profile = makeProfile()
+    path = str(tmp_path / "script.profile")
+    profile.save(path)
+    loaded = profiling.Profile.load(path)
+    assert loaded.functions == profile.functions
+    assert loaded.frames == profile.frames
+    assert loaded.digest() == profile.digest()
+    assert makeProfile(frames=2).digest() != profile.digest()
+
+def test_defaults_not_shared():
+    profile = profiling.Profile()
+    profile.functions["main"] = {"calls" : 1}
+    assert profiling.Profile().functions == {}
+
+def test_stops_early():
+    compiler = Compiler(profileGenerate=True)
+    compiler.compile("""
+void main(){
+    while (1){
+    }
+}""")
+    warnings = []
+    profile = profiling.generateProfile(compiler, maxInstructions=1000, warn=warnings.append)
+    assert warnings == ["profiling stopped early: Ran more than 1000 instructions"]
+    assert profile.getCalls("main") == 1 and profile.frames == 0
+
+# Using a profile changes how the code is laid out but not what it does
+def test_use():
+    profile = makeProfile()
+    expected, _ = run(SOURCE, 5, **UNOPTIMIZED)
+    output, compiler = run(SOURCE, 5, profile=profile)
+    assert output == expected
+    assert compiler.compile(SOURCE) != Compiler().compile(SOURCE)
+
+def test_command_line(tmp_path):
+    (tmp_path / "script.c").write_text(SOURCE)
+    cache = tmp_path / "cache"
+    result = runMsclang(["-fprofile-generate", "script.c"], tmp_path, cache)
+    assert result.returncode == 0, result.stderr
+    profile = profiling.Profile.load(str(tmp_path / "script.profile"))
+    assert profile.frames == profiling.PROFILE_FRAMES
+    assert profile.getCalls("loop") == profiling.PROFILE_FRAMES
+    result = runMsclang(["-fprofile-use", "script.c"], tmp_path, cache)
+    assert result.returncode == 0, result.stderr
+    with open(str(tmp_path / "script.mscsb"), 'rb') as f:
+        assert f.read() == Compiler(profile=profile).compile(SOURCE)
+    # The profile is named after the output unless given
+    result = runMsclang(["-fprofile-use", "script.c", "-o", "other.mscsb"], tmp_path, cache)
+    assert result.returncode != 0
+    result = runMsclang(["-fprofile-use", "--profile-file", "script.profile", "script.c", "-o", "other.mscsb"], tmp_path, cache)
+    assert result.returncode == 0, result.stderr
+    assert os.path.exists(str(tmp_path / "other.mscsb"))
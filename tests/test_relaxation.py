@@ -0,0 +1,77 @@
+from helpers import run, assertSameAsUnoptimized
+
+# The push of the function's position right before each call, as
+# (command, position)
+def getCallTargets(compiler):
+    targets = []
+    for script in compiler.msc.scripts:
+        cmds = [cmd for cmd in script.cmds if hasattr(cmd, "command")]
+        for previous, cmd in zip(cmds, cmds[1:]):
+            if cmd.command in [0x2f, 0x30, 0x31] and previous.command in [0xa, 0xd]:
+                targets.append((previous.command, previous.parameters[0]))
+    return targets
+
+SOURCE = """
+int g;
+void first(){
+    g++;
+}
+void big(){
+    %s
+}
+void last(){
+    printf("last %%i", g);
+}
+void main(){
+    g = 0;
+    first();
+    big();
+    int f = last;
+    (*f)();
+    last();
+}"""
+
+def test_references_shortened():
+    source = SOURCE % "g++;"
+    output = assertSameAsUnoptimized(source, inlineThreshold=0)
+    assert output == ["last 2", "last 2"]
+    _, compiler = run(source, inlineThreshold=0)
+    targets = getCallTargets(compiler)
+    assert len(targets) > 0
+    assert all(command == 0xd for command, position in targets)
+    assert all(position in compiler.refs.scriptPositions for command, position in targets)
+    assert compiler.relaxedBytes > 0
+
+def test_no_pushshort():
+    source = SOURCE % "g++;"
+    output, compiler = run(source, inlineThreshold=0, usePushShort=False)
+    assert output == ["last 2", "last 2"]
+    assert compiler.relaxedBytes == 0
+    assert all(command == 0xa for command, position in getCallTargets(compiler))
+
+# Functions that end up past 0xFFFF are still called with a pushInt
+def test_references_past_pushshort_range():
+    source = SOURCE % ("g++;\n" * 20000)
+    output = assertSameAsUnoptimized(source, inlineThreshold=0)
+    assert output == ["last 20001", "last 20001"]
+    _, compiler = run(source, inlineThreshold=0)
+    targets = getCallTargets(compiler)
+    assert any(command == 0xd and position <= 0xFFFF for command, position in targets)
+    assert any(command == 0xa and position > 0xFFFF for command, position in targets)
+    assert all(position in compiler.refs.scriptPositions for command, position in targets)
+
+# set_main keeps the function's position to call every frame
+def test_set_main():
+    source = """
+int frame;
+void loop(){
+    frame++;
+    printf("frame %i", frame);
+}
+void main(){
+    frame = 0;
+    set_main(loop);
+}"""
+    output = assertSameAsUnoptimized(source)
+    assert output == ["frame 1", "frame 2", "frame 3"]
+    assert run(source, usePushShort=False)[0] == output
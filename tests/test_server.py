@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import threading
+import subprocess
+import pytest
+from helpers import ROOT, UNIT_TESTS, readFile, runMsclang
+import server
+from msclang import Compiler
+
+pytestmark = pytest.mark.skipif(not hasattr(server.socket, 'AF_UNIX'), reason="needs unix domain sockets")
+
+# A server on its own thread with handleRequest, stopped once the test is done
+@pytest.fixture
+def startServer(tmp_path):
+    servers = []
+    def start(handleRequest):
+        compileServer = server.CompileServer(str(tmp_path / "server.sock"), handleRequest)
+        thread = threading.Thread(target=compileServer.serve_forever)
+        thread.start()
+        servers.append((compileServer, thread))
+        return compileServer.socketPath
+    yield start
+    for compileServer, thread in servers:
+        compileServer.shutdown()
+        compileServer.server_close()
+        thread.join()
+
+def echo(header, payload):
+    if header.get("fail"):
+        raise ValueError("failed")
+    return {"ok" : True, "name" : header["name"]}, payload[::-1]
+
+def test_requests(startServer):
+    socketPath = startServer(echo)
+    client = server.CompileClient(socketPath)
+    # One connection can be used for any number of requests
+    for i in range(3):
+        header, payload = client.request({"name" : i}, b'abc' * i)
+        assert header["ok"] and header["name"] == i and payload == b'cba' * i
+    header, payload = client.request({"fail" : True})
+    assert not header["ok"] and header["error"] == "failed" and payload == b''
+    client.close()
+    requests = [({"name" : i}, str(i).encode('utf-8')) for i in range(20)]
+    responses = server.sendRequests(socketPath, requests, 4)
+    assert [(header["name"], payload) for header, payload, seconds in responses] == [(i, str(i).encode('utf-8')[::-1]) for i in range(20)]
+
+def test_socket(tmp_path, startServer):
+    socketPath = str(tmp_path / "server.sock")
+    with pytest.raises(server.ServerError):
+        server.CompileClient(socketPath)
+    # A socket left behind by a server that didn't exit cleanly is replaced
+    stale = server.socket.socket(server.socket.AF_UNIX, server.socket.SOCK_STREAM)
+    stale.bind(socketPath)
+    stale.close()
+    startServer(echo)
+    with pytest.raises(server.ServerError):
+        server.CompileServer(socketPath, echo)
+
+def waitFor(path):
+    for _ in range(200):
+        if os.path.exists(path):
+            return
+        time.sleep(0.05)
+    assert False
+
+# Compiling through a running server gives the same files as compiling directly
+def test_connect(tmp_path):
+    socketPath = str(tmp_path / "server.sock")
+    env = dict(os.environ, MSCLANG_CACHE_DIR=str(tmp_path / "cache"))
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "msclang.py"), "--server", "--socket", socketPath, "-pp", "builtin"],
+                               env=env, stdout=subprocess.DEVNULL)
+    try:
+        waitFor(socketPath)
+        for path in UNIT_TESTS:
+            shutil.copy(path, str(tmp_path))
+        names = [os.path.basename(path) for path in UNIT_TESTS]
+        result = runMsclang(["--connect", "--socket", socketPath, "-j", "3"] + names, tmp_path, tmp_path / "cache")
+        assert result.returncode == 0
+        for path, name in zip(UNIT_TESTS, names):
+            with open(str(tmp_path / (name[:-2] + ".mscsb")), 'rb') as f:
+                assert f.read() == Compiler().compile(readFile(path))
+        (tmp_path / "broken.c").write_text("void main(){\n")
+        result = runMsclang(["--connect", "--socket", socketPath, "broken.c"], tmp_path, tmp_path / "cache")
+        assert result.returncode == 1 and "Error compiling broken.c" in result.stderr
+        result = runMsclang(["--connect", "--socket", socketPath, "-"], tmp_path, tmp_path / "cache",
+                            input='#define VALUE 1\nvoid main(){\n    printf("%i", VALUE);\n}\n')
+        assert result.returncode == 0 and os.path.exists(str(tmp_path / "output.mscsb"))
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(10)
+    assert not os.path.exists(socketPath)
@@ -0,0 +1,60 @@
+from helpers import run, assertSameAsUnoptimized
+
+def test_locals_in_separate_blocks():
+    source = """
+void main(){
+    {
+        int a = 1;
+        int b = a + 2;
+        printf("%i", b);
+    }
+    {
+        int c = 5;
+        int d = c * 2;
+        printf("%i", d);
+    }
+}"""
+    assertSameAsUnoptimized(source)
+    _, compiler = run(source, inlineThreshold=0, irPasses=[])
+    assert compiler.msc.scripts[0].cmds[0].parameters[1] < 4
+
+# A local read before it's written in a loop keeps its value from the last
+# time round, so it can't share a slot with anything written in the loop
+def test_value_carried_round_a_loop():
+    assertSameAsUnoptimized("""
+void main(){
+    int before = 9;
+    printf("%i", before);
+    int last;
+    for (int i = 0; i < 4; i++){
+        int temp = i * 3;
+        printf("%i %i", last, temp);
+        last = temp;
+    }
+}""")
+
+def test_arguments_keep_their_slots():
+    assertSameAsUnoptimized("""
+int mix(int a, int b, int c){
+    int x = a * 2;
+    int y = b + x;
+    int z = y - c;
+    return z + a;
+}
+void main(){
+    printf("%i %i", mix(1, 2, 3), mix(7, -1, 4));
+}""", inlineThreshold=0)
+
+def test_copies_and_shadowing():
+    assertSameAsUnoptimized("""
+void main(){
+    int x = 3;
+    int y = x;
+    {
+        int x = y + 1;
+        int z = x;
+        printf("%i %i", x, z);
+    }
+    y = y + x;
+    printf("%i %i", x, y);
+}""")
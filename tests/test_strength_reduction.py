@@ -0,0 +1,85 @@
+from helpers import run, assertSameAsUnoptimized
+
+def test_compound_assignments():
+    assertSameAsUnoptimized("""
+void main(){
+    int x = 5;
+    x = x + 1;
+    x = x * 3;
+    x = 2 * x;
+    x = 100 - x;
+    x = x - 1;
+    ++x;
+    x += 1;
+    printf("%i", x);
+}""")
+
+def test_float_compound_assignments():
+    assertSameAsUnoptimized("""
+void main(){
+    float f = 1.5;
+    f = f + 1.0;
+    f = f * 2.0;
+    f = f - 1.0;
+    f = f / 4.0;
+    printf("%f", f);
+}""")
+
+# x = x + e reads x before e runs, so e changing x keeps the assignment
+def test_right_side_changing_the_variable():
+    output = assertSameAsUnoptimized("""
+int g;
+int bump(){
+    g = g + 10;
+    return 1;
+}
+void main(){
+    g = 1;
+    g = g + bump();
+    printf("%i", g);
+}""")
+    assert output == ["2"]
+
+def test_mixed_types_with_autocast():
+    assertSameAsUnoptimized("""
+void main(){
+    float f = 1.5;
+    int i = 2;
+    f = f + i;
+    i = i + 1;
+    f = f + 1;
+    printf("%f %i", f, i);
+}""", autocast=True)
+
+def test_increments_are_used():
+    _, compiler = run("""
+void main(){
+    int x = 0;
+    x = x + 1;
+    printf("%i", x);
+}""", inlineThreshold=0, irPasses=[])
+    assert any(cmd.command == 0x14 for cmd in compiler.msc.scripts[0].cmds if hasattr(cmd, "command"))
+
+# ++x and --x only push the new value when something uses it, with or
+# without strength reduction
+def test_prefix_statements():
+    source = """
+int g;
+void main(){
+    int x = 1;
+    ++x;
+    g = x;
+    for (int i = 0; i < 3; ++i){
+        printf("%i %i", ++x, g);
+    }
+    --x;
+    printf("%i", x);
+}"""
+    assert assertSameAsUnoptimized(source) == ["3 2", "4 2", "5 2", "4"]
+    for reduceStrength in [True, False]:
+        output, compiler = run(source, reduceStrength=reduceStrength)
+        assert output == ["3 2", "4 2", "5 2", "4"]
+        cmds = [cmd for cmd in compiler.msc.scripts[0].cmds if hasattr(cmd, "command")]
+        # A pushVar without its push bit is a value nothing uses
+        assert all(cmd.pushBit for cmd in cmds if cmd.command == 0xb)
+        assert len([cmd for cmd in cmds if cmd.command in [0x14, 0x15]]) == 4
@@ -0,0 +1,73 @@
+from helpers import run, assertSameAsUnoptimized
+
+# Prints the case each value from -2 to 20 goes to
+SWITCH = """
+int get(int i){
+    return i;
+}
+void main(){
+    for (int i = -2; i < 21; i++){
+        switch (%s){
+            %s
+        }
+        printf("/");
+    }
+}"""
+
+def runSwitch(cases, value="i", **options):
+    source = SWITCH % (value, cases)
+    output = assertSameAsUnoptimized(source, **options)
+    assert output == assertSameAsUnoptimized(source, **dict(options, switchStrategy="linear"))
+    return output
+
+def test_few_cases():
+    output = runSwitch("""
+            case 0: printf("a"); break;
+            case 1: printf("b"); break;
+            case 3: printf("c"); break;
+            default: printf("d");""")
+    assert "".join(output).startswith("d/d/a/b/d/c/")
+
+def test_fallthrough_with_default_in_the_middle():
+    output = runSwitch("""
+            case 1: printf("a");
+            case 2: printf("b"); break;
+            default: printf("d");
+            case 5: printf("e");
+            case 6: printf("f"); break;
+            case 8: printf("g");""")
+    assert "".join(output).startswith("def/def/def/ab/b/def/def/ef/f/def/g/")
+
+def test_default_sharing_a_case():
+    runSwitch("""
+            case 0: printf("a");
+            case 4:
+            default: printf("d"); break;
+            case 7: printf("e");""")
+
+def test_ranges_and_many_cases():
+    runSwitch("""
+            case -1: case 0: case 1: case 2: printf("a"); break;
+            case 4: printf("b");
+            case 5: printf("c"); break;
+            case 6: case 7: printf("d"); return;
+            case 9: printf("e"); break;
+            case 11: case 12: case 13: printf("f");
+            case 15: printf("g"); break;
+            case 17: printf("h"); break;
+            case 19: printf("i"); break;""")
+
+def test_no_default_and_a_call():
+    runSwitch("""
+            case 3: printf("a"); break;
+            case 2: printf("b");""", value="get(i) * 2")
+
+def test_few_cases_are_tested_inline():
+    source = SWITCH % ("i", """
+            case 0: printf("a"); break;
+            case 1: printf("b"); break;
+            default: printf("d");""")
+    _, compiler = run(source)
+    # Nothing jumps straight to the default, it's reached by the last test failing
+    jumps = [cmd for cmd in compiler.msc.scripts[-1].cmds if hasattr(cmd, "command") and cmd.command == 0x4]
+    assert len(jumps) == 2
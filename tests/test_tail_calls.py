@@ -0,0 +1,89 @@
+from helpers import run, assertSameAsUnoptimized
+
+def test_accumulator():
+    output = assertSameAsUnoptimized("""
+int sum(int n, int total){
+    if (n == 0){
+        return total;
+    }
+    return sum(n - 1, total + n);
+}
+void main(){
+    printf("%i", sum(100, 0));
+}""")
+    assert output == ["5050"]
+
+# Every argument is evaluated before any parameter changes
+def test_swapped_parameters():
+    output = assertSameAsUnoptimized("""
+int gcd(int a, int b){
+    if (b == 0){
+        return a;
+    }
+    return gcd(b, a % b);
+}
+void swapCount(int a, int b, int n){
+    printf("%i %i", a, b);
+    if (n > 0){
+        swapCount(b, a, n - 1);
+    }
+}
+void main(){
+    printf("%i", gcd(48, 180));
+    swapCount(1, 2, 3);
+}""")
+    assert output == ["12", "1 2", "2 1", "1 2", "2 1"]
+
+def test_float_parameters():
+    assertSameAsUnoptimized("""
+float halve(float f, int n){
+    if (n == 0){
+        return f;
+    }
+    return halve(f / 2.0, n - 1);
+}
+void main(){
+    printf("%f", halve(100.0, 3));
+}""")
+
+def test_uninitialized_locals_are_reset():
+    output = assertSameAsUnoptimized("""
+void count(int n){
+    int seen;
+    seen++;
+    printf("%i", seen);
+    if (n > 0){
+        count(n - 1);
+    }
+}
+void main(){
+    count(2);
+}""")
+    assert output == ["1", "1", "1"]
+
+# A call whose result is used afterwards isn't a tail call
+def test_calls_that_are_not_tail_calls():
+    assertSameAsUnoptimized("""
+int factorial(int n){
+    if (n <= 1){
+        return 1;
+    }
+    return n * factorial(n - 1);
+}
+void main(){
+    printf("%i", factorial(6));
+}""")
+
+def test_deep_recursion_runs_without_calls():
+    _, compiler = run("""
+int down(int n){
+    if (n == 0){
+        return 0;
+    }
+    return down(n - 1);
+}
+void main(){
+    printf("%i", down(5));
+}""", inlineThreshold=0)
+    down = compiler.msc.scripts[0]
+    assert not any(hasattr(cmd, "command") and cmd.command == 0x2f for cmd in down.cmds)
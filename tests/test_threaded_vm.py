@@ -0,0 +1,58 @@
+import os
+import pytest
+from helpers import UNIT_TESTS, UNOPTIMIZED, readFile
+from msc import MscVM, ThreadedMscVM, MscVMError, MscFile, MscScript, Command, formatPrintf
+from msclang import Compiler
+
+# Run msc on an engine, returns what it printed, the value it returned (or
+# the error it raised), what it printed over 3 frames of its main loop and
+# how many of each command it ran
+def runOn(engine, msc, **options):
+    output = []
+    vm = engine(msc, printf=lambda vm, formatString, args: output.append(formatPrintf(formatString, args, vm.msc.strings)),
+                **options)
+    try:
+        result = vm.run()
+        if vm.mainLoop != None:
+            vm.runMainLoop(3)
+    except MscVMError as e:
+        result = str(e)
+    return output, result, vm.stats.counts
+
+def assertSameOnBothEngines(msc, **options):
+    expected = runOn(MscVM, msc, **options)
+    assert runOn(ThreadedMscVM, msc, **options) == expected
+    return expected
+
+@pytest.mark.parametrize("path", UNIT_TESTS, ids=os.path.basename)
+def test_unit_tests(path):
+    for options in [{}, UNOPTIMIZED]:
+        compiler = Compiler(**options)
+        compiler.compile(readFile(path))
+        assertSameOnBothEngines(compiler.msc)
+
+# A file of one script with these commands
+def makeFile(cmds):
+    script = MscScript()
+    for i, cmd in enumerate(cmds):
+        cmd.commandPosition = 0x10 + i * 4
+    script.cmds = cmds
+    msc = MscFile()
+    msc.scripts.append(script)
+    msc.entryPoint = 0x10
+    return msc
+
+def test_errors():
+    output, result, counts = assertSameOnBothEngines(makeFile([Command(0x2, [0, 0]), Command(0x33), Command(0x3)]))
+    assert result == "Stack underflow or bad variable at 0x14"
+    output, result, counts = assertSameOnBothEngines(makeFile([Command(0x2, [0, 0]), Command(0x1), Command(0x3)]))
+    assert result.startswith("Can't run") and result.endswith("at 0x14")
+    output, result, counts = assertSameOnBothEngines(makeFile([Command(0x2, [0, 0]), Command(0x4, [0x10])]), maxInstructions=100)
+    assert result == "Ran more than 100 instructions"
+    output, result, counts = assertSameOnBothEngines(makeFile([Command(0x2, [0, 0]), Command(0xd, [0x40], True), Command(0x2f, [0])]))
+    assert result == "No instruction at 0x40"
+
+# Going on past the last command is an error, not a different IndexError
+def test_past_the_end():
+    output, result, counts = assertSameOnBothEngines(makeFile([Command(0x2, [0, 0]), Command(0xd, [1], True)]))
+    assert result == "Stack underflow or bad variable at 0x14"
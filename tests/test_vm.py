@@ -0,0 +1,106 @@
+import os
+import pytest
+from helpers import UNIT_TESTS, UNOPTIMIZED, readFile, run
+from msc import MscVM, MscVMError, formatPrintf
+from msclang import Compiler
+
+EXPECTED = {
+    "printf.c" : ["Hello world!"],
+    "functions.c" : ["sin(3.0f) = 0.145313"],
+    "func_ptr.c" : ["test"],
+    "if.c" : ["If test passed.", "Else test passed.", "Else if test passed."],
+    "while.c" : ["oof", "oof", "oof", "OOF", "OOF", "OOF"],
+    "for.c" : [str(i) for i in range(10)],
+    "switch.c" : ["Case 0 hit", "Case 1 hit", "Hit default case", "Case 3 hit", "Hit default case"],
+    "set_main.c" : ["Test", "Test", "Test"],
+    "ternary.c" : ["Should be 8 - 5 + (true ? 3 : 4) = 8"],
+    "negative-optimization.c" : ["-3.000000"],
+    "bitwise_math.c" : ["10 & 2 = 2", "10 | 2 = 10", "10 ^ 2 = 8", "10 << 2 = 40", "10 >> 2 = 2", "~10 = -11"]
+}
+
+@pytest.mark.parametrize("name", sorted(EXPECTED))
+def test_unit_tests(name):
+    path = [path for path in UNIT_TESTS if os.path.basename(path) == name][0]
+    assert run(readFile(path), **UNOPTIMIZED)[0] == EXPECTED[name]
+
+def runSource(source, **options):
+    compiler = Compiler()
+    compiler.compile(source)
+    output = []
+    vm = MscVM(compiler.msc, printf=lambda vm, formatString, args: output.append(formatPrintf(formatString, args, vm.msc.strings)),
+               **options)
+    return vm, vm.run(), output
+
+# Division and modulo truncate towards 0 like C, ints wrap at 32 bits
+def test_arithmetic():
+    vm, result, output = runSource("""
+void main(){
+    int big = 2147483647;
+    int negative = -7;
+    printf("%i %i %i %i", negative / 2, negative % 2, 7 / -2, big + 1);
+    float f = 7.0;
+    printf("%f %i", f / 2.0, 5 > 3);
+}""")
+    assert output == ["-3 -1 -3 -2147483648", "3.500000 1"]
+
+def test_syscalls():
+    calls = []
+    def syscall(vm, args):
+        calls.append(args)
+        return sum(args)
+    vm, result, output = runSource("""
+void main(){
+    printf("%i", sys_2(3, 4));
+    sys_3(1);
+}""", syscalls={2 : syscall})
+    assert calls == [[3, 4]]
+    assert output == ["7"]
+    # Syscalls passed to one vm aren't seen by another
+    assert MscVM(vm.msc).syscalls == {}
+
+def test_return_value_and_stats():
+    vm, result, output = runSource("""
+int main(){
+    int total = 0;
+    for (int i = 0; i < 5; i++){
+        total += i;
+    }
+    return total;
+}""")
+    assert result == 10
+    assert vm.stats.counts[0x14] == 5
+    assert vm.stats.instructions() == sum(vm.stats.counts.values())
+    vm.run()
+    assert vm.stats.counts[0x14] == 10
+
+def test_main_loop():
+    vm, result, output = runSource("""
+int frame;
+void loop(){
+    frame++;
+    printf("%i", frame);
+}
+void main(){
+    frame = 0;
+    set_main(loop);
+}""")
+    assert output == []
+    vm.runMainLoop(3)
+    assert output == ["1", "2", "3"]
+
+def test_errors():
+    compiler = Compiler()
+    compiler.compile("""
+void main(){
+    while (1){
+    }
+}""")
+    vm = MscVM(compiler.msc, maxInstructions=1000)
+    with pytest.raises(MscVMError, match="Ran more than 1000 instructions"):
+        vm.run()
+    # The instruction over the limit isn't run so it isn't counted
+    assert vm.stats.instructions() == 1000
+    with pytest.raises(MscVMError, match="No main loop set"):
+        runSource("void main(){\n}")[0].runMainLoop()
+    with pytest.raises(MscVMError, match="No instruction at 0x1234"):
+        runSource("void main(){\n}")[0].run(0x1234)
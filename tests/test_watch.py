@@ -0,0 +1,62 @@
+import os
+import sys
+import signal
+import subprocess
+from helpers import ROOT
+from msclang import Compiler, preprocessWithDependencies, getModifiedTimes, BUILTIN_PREPROCESSOR
+
+MAIN = '#include "values.h"\nvoid main(){\n    printf("%i", VALUE);\n}\n'
+# What main.c compiles to once VALUE is replaced
+EXPANDED = 'void main(){\n    printf("%%i", %i);\n}\n'
+OTHER = 'void main(){\n    printf("other");\n}\n'
+
+def test_dependencies(tmp_path):
+    (tmp_path / "values.h").write_text("#define VALUE 1\n")
+    (tmp_path / "main.c").write_text(MAIN)
+    main = str(tmp_path / "main.c")
+    expected = [main, str(tmp_path / "values.h")]
+    text, dependencies = preprocessWithDependencies(main, BUILTIN_PREPROCESSOR)
+    assert dependencies == expected
+    # cpp also reports the headers it always includes
+    text, dependencies = preprocessWithDependencies(main)
+    assert dependencies[0] == main and set(expected) <= set(dependencies)
+    missing = str(tmp_path / "missing.c")
+    assert getModifiedTimes([main, missing]) == {main : os.stat(main).st_mtime_ns, missing : None}
+
+def getBytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+# Changing a header only rebuilds the files that include it
+def test_watch(tmp_path):
+    (tmp_path / "values.h").write_text("#define VALUE 1\n")
+    (tmp_path / "main.c").write_text(MAIN)
+    (tmp_path / "other.c").write_text(OTHER)
+    env = dict(os.environ, MSCLANG_CACHE_DIR=str(tmp_path / "cache"))
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "msclang.py"), "-w", "-pp", "builtin", "main.c", "other.c"],
+                               cwd=str(tmp_path), env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    try:
+        assert "Built 2/2 file(s)" in process.stdout.readline()
+        assert "Watching 3 file(s)" in process.stdout.readline()
+        main, other = str(tmp_path / "main.mscsb"), str(tmp_path / "other.mscsb")
+        assert getBytes(main) == Compiler().compile(EXPANDED % 1)
+        otherTime = os.stat(other).st_mtime_ns
+
+        (tmp_path / "values.h").write_text("#define VALUE 2\n")
+        assert "Built 1/1 file(s)" in process.stdout.readline()
+        assert getBytes(main) == Compiler().compile(EXPANDED % 2)
+        assert os.stat(other).st_mtime_ns == otherTime
+
+        # A failed build keeps watching and picks up the fix
+        (tmp_path / "other.c").write_text("void main(){\n")
+        assert "Built 0/1 file(s)" in process.stdout.readline()
+        (tmp_path / "other.c").write_text(OTHER.replace("other", "fixed"))
+        assert "Built 1/1 file(s)" in process.stdout.readline()
+        assert getBytes(other) == Compiler().compile(OTHER.replace("other", "fixed"))
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait(10)
+    assert process.returncode == 0